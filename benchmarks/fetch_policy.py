@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Compares the full and narrow fetch policies.
+
+Creates an upstream repository with a large number of stale feature branches
+and tags, clones it and times fetching the configured branches with both
+policies. Usage::
+
+    python benchmarks/fetch_policy.py [BRANCHES] [ROUNDS]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import gitctl.backend
+import gitctl.fetch
+
+BRANCHES = ['development', 'staging', 'production']
+
+def setup(path, count):
+    """Creates the upstream repository with ``count`` stale branches and
+    tags and returns a clone of it.
+    """
+    upstream = gitctl.backend.Repository(os.path.join(path, 'upstream.git'))
+    os.makedirs(upstream.path)
+    upstream.call('init', '-q')
+    upstream.call('commit', '-q', '--allow-empty', '-m', 'Initial commit')
+    head = upstream.rev_parse('HEAD')
+    refs = ['create refs/heads/%s %s' % (branch, head) for branch in BRANCHES]
+    for i in range(count):
+        refs.append('create refs/heads/feature/stale-%05d %s' % (i, head))
+        refs.append('create refs/tags/release-%05d %s' % (i, head))
+    stdin = open(os.path.join(path, 'refs.txt'), 'w')
+    stdin.write('\n'.join(refs) + '\n')
+    stdin.close()
+    os.system('cd %s && git update-ref --stdin < %s' % (upstream.path, stdin.name))
+    gitctl.backend.git(path, 'clone', '-q', '--bare', upstream.path, 'clone.git')
+    return gitctl.backend.Repository(os.path.join(path, 'clone.git'))
+
+def measure(clone, config, rounds):
+    """Returns the best wall clock time of ``rounds`` fetches."""
+    best = None
+    for i in range(rounds):
+        # Start each round without any remote branches or tags
+        os.system('cd %s && git for-each-ref --format="delete %%(refname)" refs/remotes refs/tags '
+                  '| git update-ref --stdin' % clone.path)
+        started = time.time()
+        result = clone.git(*gitctl.fetch.fetch_command(clone, config, 0))
+        elapsed = time.time() - started
+        if not result.ok:
+            raise gitctl.backend.GitError(('fetch',), result)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 5000
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 3
+    path = tempfile.mkdtemp()
+    try:
+        clone = setup(path, count)
+        clone.call('config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*')
+        config = {'upstream' : 'origin',
+                  'fetch-tags' : False,
+                  'branches' : [('origin/%s' % branch, branch) for branch in BRANCHES]}
+        print 'Upstream with %s stale branches and %s tags, best of %s rounds' % (count, count, rounds)
+        for policy in ('full', 'narrow'):
+            config['fetch-policy'] = policy
+            elapsed = measure(clone, config, rounds)
+            refs = len(clone.call('for-each-ref', '--format=%(refname)', 'refs/remotes', 'refs/tags').splitlines())
+            print '%-8s %8.3fs %8s refs fetched' % (policy, elapsed, refs)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
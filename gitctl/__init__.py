@@ -1,5 +1,6 @@
 import sys
 import logging
+import gitctl.backend
 import gitctl.parser
 import gitctl.notification
 
@@ -36,7 +37,19 @@ def main():
     logging.getLogger('gitctl').addHandler(make_handler(sys.stderr, '%(levelname)s %(message)s', logging.DEBUG))
 
     args = gitctl.parser.parser.parse_args()
-    args.func(args)
+    version = gitctl.backend.version()
+    if version is None or version < gitctl.backend.MIN_VERSION:
+        logging.getLogger('gitctl').critical('gitctl requires git %s or later, found %s.',
+                                             '.'.join(map(str, gitctl.backend.MIN_VERSION)),
+                                             version and '.'.join(map(str, version)) or 'none')
+        sys.exit(1)
+    try:
+        status = args.func(args)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    # Only "gitctl sh" returns an exit status
+    if isinstance(status, int):
+        sys.exit(status)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""Subprocess based git backend.
+
+Every git invocation returns a ``Result`` with the exit status and the
+captured output. ``run_many`` drives any number of git processes from a
+single thread by multiplexing their pipes, so a large number of repositories
+can be handled at once without a thread per repository.
+"""
+import os
+import re
+import time
+import errno
+import select
+import resource
+import subprocess
+
+import gitctl.refs
+import gitctl.gitconfig
+import gitctl.index
+import gitctl.commitgraph
+
+# More changed files than this are compared by a full git diff instead of
+# passing the paths on the command line.
+MAX_CHANGED_PATHS = 100
+
+# File descriptors kept free for everything but the pipes of run_many
+RESERVED_FDS = 64
+
+# The oldest git that has all the commands and options gitctl uses, the
+# last one being ``git sparse-checkout set --cone``
+MIN_VERSION = (2, 35)
+
+class GitError(Exception):
+    """Raised when a git command returns a non-zero exit status."""
+
+    def __init__(self, command, result):
+        Exception.__init__(self, command, result)
+        self.command = command
+        self.result = result
+
+    def __str__(self):
+        return '%s returned exit status %s: %s' % (
+            ' '.join(self.command), self.result.status, self.result.stderr.strip())
+
+class Result(object):
+    """The outcome of a git command."""
+
+    __slots__ = ('status', 'stdout', 'stderr')
+
+    def __init__(self, status, stdout, stderr):
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return '<Result status=%s stdout=%r stderr=%r>' % (self.status, self.stdout, self.stderr)
+
+class State(object):
+    """The state of a repository as of a single probe.
+
+    ``head`` is the SHA1 of HEAD (None on an unborn branch), ``branch`` the
+    checked out branch (None if detached) and ``refs`` the dictionary of all
+    the refs. ``upstream``, ``ahead``, ``behind`` and ``untracked`` (the
+    number of untracked files) are None unless they were asked for.
+    """
+
+    __slots__ = ('head', 'branch', 'upstream', 'ahead', 'behind', 'staged', 'unstaged', 'untracked', 'refs')
+
+    def __init__(self, head, branch, staged, unstaged, refs, upstream=None, ahead=None, behind=None, untracked=None):
+        self.head = head
+        self.branch = branch
+        self.staged = staged
+        self.unstaged = unstaged
+        self.refs = refs
+        self.upstream = upstream
+        self.ahead = ahead
+        self.behind = behind
+        self.untracked = untracked
+
+    @property
+    def dirty(self):
+        """True if there are uncommitted changes to tracked files."""
+        return self.staged or self.unstaged
+
+    def branches(self, remote=False):
+        """Returns the set of local branch names or remote branch names if
+        ``remote`` is True.
+        """
+        prefix = remote and 'refs/remotes/' or 'refs/heads/'
+        return set(name[len(prefix):] for name in self.refs if name.startswith(prefix))
+
+    def __repr__(self):
+        return '<State head=%s branch=%s staged=%s unstaged=%s>' % (self.head, self.branch, self.staged, self.unstaged)
+
+def parse_status(output):
+    """Parses the output of ``git status --porcelain=v2 --branch`` into a
+    dictionary of the State fields other than ``refs``.
+    """
+    fields = dict(head=None, branch=None, upstream=None, ahead=None, behind=None,
+                  staged=False, unstaged=False, untracked=0)
+    for line in output.splitlines():
+        if line.startswith('# branch.oid '):
+            value = line[len('# branch.oid '):]
+            fields['head'] = value != '(initial)' and value or None
+        elif line.startswith('# branch.head '):
+            value = line[len('# branch.head '):]
+            fields['branch'] = value != '(detached)' and value or None
+        elif line.startswith('# branch.upstream '):
+            fields['upstream'] = line[len('# branch.upstream '):]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line[len('# branch.ab '):].split()
+            if ahead != '+?':
+                fields['ahead'], fields['behind'] = int(ahead[1:]), int(behind[1:])
+        elif line.startswith('1 ') or line.startswith('2 '):
+            # The XY field tells the staged and the unstaged status
+            fields['staged'] = fields['staged'] or line[2] != '.'
+            fields['unstaged'] = fields['unstaged'] or line[3] != '.'
+        elif line.startswith('u '):
+            fields['staged'] = fields['unstaged'] = True
+        elif line.startswith('? '):
+            fields['untracked'] += 1
+    return fields
+
+def command(args):
+    """Returns the full command line for the given git arguments."""
+    return ['git'] + [str(a) for a in args]
+
+def spawn(path, args):
+    """Starts a git process in ``path`` and returns the Popen object."""
+    devnull = open(os.devnull)
+    try:
+        return subprocess.Popen(command(args),
+                                cwd=path,
+                                stdin=devnull,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+    finally:
+        devnull.close()
+
+def git(path, *args):
+    """Runs git with the given arguments in ``path`` and returns a Result."""
+    process = spawn(path, args)
+    stdout, stderr = process.communicate()
+    return Result(process.returncode, stdout, stderr)
+
+def max_processes():
+    """Returns the number of git processes whose pipes fit within the file
+    descriptor limit, leaving room for the other files gitctl has open.
+    """
+    try:
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ValueError, resource.error):
+        soft = 1024
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    # Two pipes per process and a pipe while it is being spawned
+    return max(1, (soft - RESERVED_FDS) // 4)
+
+def run_many(calls, limit=None):
+    """Runs the given ``(path, args)`` git calls concurrently and returns a
+    list of Results in the same order.
+
+    At most ``limit`` processes are running at the same time, and never more
+    than ``max_processes()``. All the processes are driven from the calling
+    thread.
+    """
+    calls = list(calls)
+    results = [None] * len(calls)
+    queue = list(reversed(list(enumerate(calls))))
+    cap = max_processes()
+    limit = min(limit or cap, cap)
+    # Maps a pipe file descriptor to (index, pipe, chunks)
+    pipes = {}
+    running = {}
+    # poll() handles file descriptors above FD_SETSIZE unlike select()
+    poller = select.poll()
+
+    def start():
+        while queue and len(running) < limit:
+            index, (path, args) = queue.pop()
+            process = spawn(path, args)
+            running[index] = (process, [], [])
+            for pipe, chunks in ((process.stdout, running[index][1]), (process.stderr, running[index][2])):
+                pipes[pipe.fileno()] = (index, pipe, chunks)
+                poller.register(pipe.fileno(), select.POLLIN | select.POLLPRI)
+
+    def finish(index):
+        process, stdout, stderr = running.pop(index)
+        process.stdout.close()
+        process.stderr.close()
+        results[index] = Result(process.wait(), ''.join(stdout), ''.join(stderr))
+
+    try:
+        start()
+        while pipes:
+            try:
+                events = poller.poll()
+            except select.error, x:
+                if x.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                index, pipe, chunks = pipes[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    chunks.append(data)
+                    continue
+                poller.unregister(fd)
+                del pipes[fd]
+                process = running[index][0]
+                if process.stdout.fileno() not in pipes and process.stderr.fileno() not in pipes:
+                    finish(index)
+            start()
+    except:
+        for process, stdout, stderr in running.values():
+            try:
+                process.kill()
+            except OSError:
+                pass
+        raise
+
+    return results
+
+def parse_version(output):
+    """Parses the output of ``git --version`` into a tuple of integers, or
+    returns None if it is not recognized.
+    """
+    match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', output)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+def version():
+    """Returns the version of the installed git as a tuple of integers or
+    None if git cannot be run.
+    """
+    try:
+        result = git(os.curdir, '--version')
+    except OSError:
+        return None
+    return result.ok and parse_version(result.stdout) or None
+
+class Repository(object):
+    """A git working directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def git_dir(self):
+        """The path of the .git directory."""
+        path = os.path.join(self.path, '.git')
+        if os.path.isfile(path):
+            # A gitfile pointing to the actual repository
+            data = open(path).read().strip()
+            if data.startswith('gitdir:'):
+                path = os.path.normpath(os.path.join(self.path, data[len('gitdir:'):].strip()))
+        return path
+
+    @property
+    def common_dir(self):
+        """The path of the .git directory shared by all the worktrees of the
+        repository.
+        """
+        path = os.path.join(self.git_dir, 'commondir')
+        if os.path.isfile(path):
+            return os.path.normpath(os.path.join(self.git_dir, open(path).read().strip()))
+        return self.git_dir
+
+    def git(self, *args):
+        """Runs a git command and returns the Result."""
+        return git(self.path, *args)
+
+    def call(self, *args):
+        """Runs a git command and returns its output with the trailing
+        whitespace removed. Raises GitError on failure.
+        """
+        result = self.git(*args)
+        if result.status != 0:
+            raise GitError(command(args), result)
+        return result.stdout.rstrip()
+
+    def stream(self, *args):
+        """Runs a git command and yields the lines of its output as they are
+        produced. Git is stopped if the iteration stops early. Raises
+        GitError on failure.
+        """
+        process = spawn(self.path, args)
+        try:
+            for line in process.stdout:
+                yield line.rstrip('\n')
+            stderr = process.stderr.read()
+            if process.wait() != 0:
+                raise GitError(command(args), Result(process.returncode, '', stderr))
+        finally:
+            if process.poll() is None:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+            process.stdout.close()
+            process.stderr.close()
+            process.wait()
+
+    def config(self):
+        """Returns the configuration of the repository as a list of
+        ``(key, value)`` pairs. The value of a key without a value is None.
+        """
+        items = gitctl.gitconfig.read_config(self.git_dir, self.common_dir)
+        if items is not None:
+            return items
+        items = []
+        for entry in self.call('config', '--null', '--list').split('\0'):
+            if entry:
+                key, separator, value = entry.partition('\n')
+                items.append((key, separator and value or None))
+        return items
+
+    def is_shallow(self):
+        """Returns True if the history of the repository is truncated."""
+        return os.path.exists(os.path.join(self.git_dir, 'shallow'))
+
+    def state(self, untracked=False, upstream=False):
+        """Returns the State of the repository.
+
+        When the index is known to match HEAD and the stat data of the files
+        matches the index, the state is read without spawning git. Otherwise,
+        or if the untracked files or the ahead/behind counts of the upstream
+        branch are asked for, a single ``git status`` call is made. It is
+        limited to the files whose stat data changed when the index is known
+        to match HEAD.
+        """
+        refs = self.refs()
+        index_state = gitctl.index.index_state(self)
+        known_clean = gitctl.index.is_known_clean(self, index_state)
+        changed = None
+        if known_clean and not untracked:
+            changed = gitctl.index.stat_changes(self)
+            if changed == [] and not upstream:
+                return State(index_state.split()[0], self.active_branch(), False, False, refs)
+        started = time.time()
+        # Git would otherwise refresh the index and invalidate the stamp.
+        args = ('--no-optional-locks', 'status', '--porcelain=v2', '--branch',
+                '--untracked-files=%s' % (untracked and 'normal' or 'no'),
+                upstream and '--ahead-behind' or '--no-ahead-behind')
+        if changed and len(changed) <= MAX_CHANGED_PATHS:
+            # Only the changed files can differ from the index and from HEAD
+            args = ('--literal-pathspecs',) + args + ('--',) + tuple(changed)
+        fields = parse_status(self.call(*args))
+        if not known_clean and not fields['staged']:
+            gitctl.index.mark_clean(self, index_state, started)
+        if not untracked:
+            fields['untracked'] = None
+        if not upstream:
+            fields['ahead'] = fields['behind'] = None
+        return State(refs=refs, **fields)
+
+    def refs(self):
+        """Returns a dictionary mapping the ref names of the repository to
+        SHA1s. The refs are read directly from the repository when possible.
+        """
+        refs = gitctl.refs.read_refs(self.common_dir)
+        if refs is not None:
+            return refs
+        output = self.call('for-each-ref', '--format=%(objectname) %(refname)')
+        return dict(reversed(line.split(' ', 1)) for line in output.splitlines())
+
+    def active_branch(self):
+        """Returns the name of the checked out branch or None if HEAD is
+        detached.
+        """
+        head = gitctl.refs.read_head(self.git_dir)
+        if head is not None and gitctl.refs.read_refs(self.common_dir) is not None:
+            if not head.startswith('ref:'):
+                return None
+            branch = head[len('ref:'):].strip()
+            if branch.startswith('refs/heads/'):
+                branch = branch[len('refs/heads/'):]
+            return branch
+        result = self.git('symbolic-ref', '-q', 'HEAD')
+        if result.status != 0:
+            return None
+        branch = result.stdout.strip()
+        if branch.startswith('refs/heads/'):
+            branch = branch[len('refs/heads/'):]
+        return branch
+
+    def worktree_branches(self):
+        """Returns a dictionary mapping the branches checked out in the
+        worktrees of the repository to the worktree paths.
+        """
+        if not os.path.isdir(os.path.join(self.common_dir, 'worktrees')):
+            # No linked worktrees, no need to ask git.
+            return {}
+        branches = {}
+        path = None
+        for line in self.call('worktree', 'list', '--porcelain').splitlines():
+            if line.startswith('worktree '):
+                path = line[len('worktree '):]
+            elif line.startswith('branch refs/heads/'):
+                branches[line[len('branch refs/heads/'):]] = path
+        return branches
+
+    def rev_parse(self, rev):
+        """Returns the SHA1 checksum of the given revision."""
+        refs = gitctl.refs.read_refs(self.common_dir)
+        if refs is not None:
+            sha1 = gitctl.refs.lookup(refs, gitctl.refs.read_head(self.git_dir), rev)
+            if sha1 is not None:
+                return sha1
+        # Revision expressions and unknown names
+        return self.call('rev-parse', rev)
+
+    def has_commit(self, sha1):
+        """Returns True if the commit ``sha1`` exists in the local object
+        database.
+        """
+        return self.git('cat-file', '-e', '%s^{commit}' % sha1).status == 0
+
+    def is_ancestor(self, ancestor, descendant):
+        """Returns True if ``ancestor`` is reachable from ``descendant``. The
+        commit-graph is used when it contains both commits.
+        """
+        graph = gitctl.commitgraph.load(self)
+        if graph is not None:
+            positions = [graph.lookup(self.rev_parse(rev)) for rev in (ancestor, descendant)]
+            if None not in positions:
+                try:
+                    return graph.is_ancestor(*positions)
+                except gitctl.commitgraph.GraphError:
+                    pass
+        result = self.git('merge-base', '--is-ancestor', ancestor, descendant)
+        if result.status not in (0, 1):
+            raise GitError(command(('merge-base', '--is-ancestor', ancestor, descendant)), result)
+        return result.status == 0
+
+    def sparse_patterns(self):
+        """Returns the list of sparse checkout patterns or None if the
+        working directory is not sparse.
+        """
+        if not os.path.exists(os.path.join(self.git_dir, 'info', 'sparse-checkout')):
+            # Never been sparse, no need to ask git.
+            return None
+        result = self.git('sparse-checkout', 'list')
+        if result.status != 0:
+            return None
+        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+    def set_sparse_patterns(self, patterns):
+        """Restricts the working directory to the given directories using a
+        cone mode sparse checkout, or disables the sparse checkout if
+        ``patterns`` is None.
+        """
+        if patterns is None:
+            self.call('sparse-checkout', 'disable')
+        else:
+            self.call('sparse-checkout', 'set', '--cone', *patterns)
+
+    def branches(self, remote=False):
+        """Returns the set of local branch names or remote branch names if
+        ``remote`` is True.
+        """
+        prefix = remote and 'refs/remotes/' or 'refs/heads/'
+        return set(name[len(prefix):] for name in self.refs() if name.startswith(prefix))
+
+__all__ = ['GitError', 'MAX_CHANGED_PATHS', 'MIN_VERSION', 'Repository', 'Result', 'State', 'git', 'max_processes',
+           'parse_status', 'parse_version', 'run_many', 'spawn', 'version']
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Git bundles for provisioning workspaces without network access.
+
+A bundle directory contains a ``<project>.bundle`` file for each project
+with the remote branches of the configured branches, optionally followed by
+incremental ``<project>.<N>.bundle`` files that only contain the commits
+added since the previous export. The refs of the latest export are recorded
+in ``<project>.refs`` so that unchanged projects can be skipped.
+"""
+import os
+import re
+
+import gitctl.fetch
+import gitctl.utils
+
+def base_path(directory, name):
+    """Returns the path of the full bundle of the project ``name``."""
+    return os.path.join(directory, '%s.bundle' % name)
+
+def refs_path(directory, name):
+    """Returns the path of the file recording the last exported refs."""
+    return os.path.join(directory, '%s.refs' % name)
+
+def bundle_files(directory, name):
+    """Returns the bundle files of the project ``name`` in the order they
+    need to be applied.
+    """
+    if not os.path.exists(base_path(directory, name)):
+        return []
+    pattern = re.compile(r'^%s\.(\d+)\.bundle$' % re.escape(name))
+    increments = []
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match is not None:
+            increments.append((int(match.group(1)), os.path.join(directory, filename)))
+    return [base_path(directory, name)] + [path for number, path in sorted(increments)]
+
+def exported_refs(repository, config):
+    """Returns the ``(sha1, refname)`` pairs of the remote branches of the
+    configured branches.
+    """
+    prefix = 'refs/remotes/%s/' % config['upstream']
+    wanted = set('%s%s' % (prefix, local) for remote, local in config['branches'])
+    output = repository.call('for-each-ref', '--format=%(objectname) %(refname)', prefix)
+    return sorted(tuple(line.split()) for line in output.splitlines()
+                  if line.split()[1] in wanted)
+
+def read_refs(directory, name):
+    """Returns the recorded refs of the last export, the pinned treeish of
+    the project at the time and the bundle sequence number, or None.
+    """
+    try:
+        lines = open(refs_path(directory, name)).read().splitlines()
+    except IOError:
+        return None
+    sequence, treeish = lines[0].split()
+    return int(sequence), treeish, sorted(tuple(line.split()) for line in lines[1:] if line.strip())
+
+def write_refs(directory, name, sequence, treeish, refs):
+    """Records the refs of an export."""
+    data = open(refs_path(directory, name), 'w')
+    try:
+        data.write('%s %s\n' % (sequence, treeish))
+        for sha1, ref in refs:
+            data.write('%s %s\n' % (sha1, ref))
+    finally:
+        data.close()
+
+def export(repository, config, proj, directory):
+    """Writes the bundle of the project into ``directory``.
+
+    The bundle is incremental on top of the previous export if there is
+    one. Returns 'unchanged' if the pinned revision of the project, or the
+    remote branches of an unpinned project, have not changed since the
+    previous export. Returns 'incremental' or 'full' otherwise.
+    """
+    name = proj['name']
+    refs = exported_refs(repository, config)
+    if not refs:
+        raise ValueError('No remote branches to export')
+    previous = read_refs(directory, name)
+    if previous is not None and os.path.exists(base_path(directory, name)):
+        sequence, treeish, previous_refs = previous
+        if gitctl.utils.is_sha1(proj['treeish']) and treeish == proj['treeish']:
+            return 'unchanged'
+        if previous_refs == refs:
+            if treeish != proj['treeish']:
+                # The new pin is within the exported branches already.
+                write_refs(directory, name, sequence, proj['treeish'], refs)
+            return 'unchanged'
+        # The receiving end already has the previously exported commits.
+        prerequisites = [sha1 for sha1, ref in previous_refs if repository.has_commit(sha1)]
+        path = os.path.join(directory, '%s.%s.bundle' % (name, sequence + 1))
+        result = repository.git('bundle', 'create', path, *([ref for sha1, ref in refs] + ['--not'] + prerequisites))
+        if result.ok:
+            write_refs(directory, name, sequence + 1, proj['treeish'], refs)
+            return 'incremental'
+        # For example the branches were reset to older commits and there is
+        # nothing new to bundle. Start over with a full bundle.
+        if os.path.exists(path):
+            os.remove(path)
+
+    for path in bundle_files(directory, name):
+        os.remove(path)
+    repository.call('bundle', 'create', base_path(directory, name), *[ref for sha1, ref in refs])
+    write_refs(directory, name, 0, proj['treeish'], refs)
+    return 'full'
+
+def apply(repository, config, directory, name):
+    """Fetches the remote branches from the bundles of the project ``name``
+    in ``directory``. Bundles that have been applied already are skipped.
+    Returns the number of bundles applied.
+    """
+    stamp = gitctl.fetch.stamp_path(repository, config['upstream'], 'bundles')
+    try:
+        applied = set(open(stamp).read().splitlines())
+    except IOError:
+        applied = set()
+    refspec = '+refs/remotes/%(upstream)s/*:refs/remotes/%(upstream)s/*' % config
+    count = 0
+    for path in bundle_files(directory, name):
+        # A rewritten bundle has a new modification time.
+        key = '%s %s %s' % (os.path.basename(path), int(os.path.getmtime(path)), os.path.getsize(path))
+        if key in applied:
+            continue
+        repository.call('fetch', '--no-tags', '--quiet', os.path.abspath(path), refspec)
+        applied.add(key)
+        count += 1
+    if count:
+        if not os.path.isdir(os.path.dirname(stamp)):
+            os.makedirs(os.path.dirname(stamp))
+        open(stamp, 'w').write(''.join('%s\n' % key for key in sorted(applied)))
+    return count
+
+__all__ = ['apply', 'base_path', 'bundle_files', 'export', 'exported_refs', 'read_refs',
+           'refs_path', 'write_refs']
@@ -2,10 +2,21 @@
 """Command handlers."""
 import os
 import sys
-import git
+import time
+import shutil
+import signal
 import logging
+import threading
+import subprocess
 
 import gitctl.notification
+import gitctl.backend
+import gitctl.bundle
+import gitctl.executor
+import gitctl.fetch
+import gitctl.maintenance
+import gitctl.mirror
+import gitctl.snapshot
 import gitctl.utils
 import gitctl.wtf
 
@@ -57,37 +68,45 @@ def gitctl_create(args):
             'commit_email_prefix' : config['commit-email-prefix'] }
     
     gitctl.utils.run(' '.join([l.strip() for l in initialize_remote.splitlines()]))
+    if config['manifest']:
+        # Replace the post-receive hook with one that also records the ref
+        # updates in the change manifest.
+        host, manifest_path = gitctl.fetch.manifest_location(config['manifest'])
+        hook = '%s.git/hooks/post-receive' % project_name
+        process = subprocess.Popen(['ssh', config['upstream-url'], 'cat > %s && chmod a+x %s' % (hook, hook)],
+                                   stdin=subprocess.PIPE)
+        process.communicate(gitctl.fetch.manifest_hook(project_name, manifest_path))
     LOG.info('Created new remote repository: %s', project_url)
     
     # Initialize the local directory.
-    repository = git.Git(project_path)
-    repository.init()
+    repository = gitctl.backend.Repository(project_path)
+    repository.call('init')
 
     # Create the initial commit
-    repository.add('.')
-    repository.commit('-m', args.message)
+    repository.call('add', '.')
+    repository.call('commit', '-m', args.message)
     
     # Create local branches
     for remote, local in config['branches']:
-        repository.branch(local)
+        repository.call('branch', local)
 
     # Push the initial structure to upstream
-    repository.remote('add', config['upstream'], project_url)
+    repository.call('remote', 'add', config['upstream'], project_url)
     for remote, local in config['branches']:
-        repository.push(config['upstream'], local)
-    repository.fetch(config['upstream'])
+        repository.call('push', config['upstream'], local)
+    repository.call('fetch', config['upstream'])
     
     LOG.info('Created new local repository: %s', project_path)
     
     # Set up the local branches to track the remote ones
     for remote, local in config['branches']:
-        repository.branch('-f', '--track', local, remote)
+        repository.call('branch', '-f', '--track', local, remote)
         LOG.info('Branch ``%s`` is tracking ``%s``', local, remote)
         
     # Checkout the development branch 
-    repository.checkout(config['development-branch'])
+    repository.call('checkout', config['development-branch'])
     # Get rid of the default master branch
-    repository.branch('-d', 'master')
+    repository.call('branch', '-d', 'master')
     
     # Fix the HEAD ref in the upstream repo so cloning does not give an error
     gitctl.utils.run('ssh %(upstream)s "echo ref: refs/heads/%(devbranch)s > %(project)s.git/HEAD"' % {
@@ -103,35 +122,118 @@ def gitctl_fetch(args):
     projects = gitctl.utils.parse_externals(args.externals)
     config = gitctl.utils.parse_config(args.config)
     
-    for proj in gitctl.utils.selected_projects(args, projects):
-        repository = git.Git(gitctl.utils.project_path(proj))
-        repository.fetch(config['upstream'])
-        LOG.info('%s Fetched', gitctl.utils.pretty(proj['name']))
+    ttl = gitctl.fetch.fetch_ttl(args, config)
+    manifest = gitctl.fetch.load_manifest(config)
+    selected = []
+    unchanged = set()
+    projects = list(gitctl.utils.selected_projects(args, projects))
+    for proj in projects:
+        repository = gitctl.backend.Repository(gitctl.utils.project_path(proj))
+        if gitctl.utils.fetched_with_primary(proj, projects):
+            # Worktrees share the repository of the primary project.
+            selected.append((proj, repository, None))
+            continue
+        if manifest is not None and manifest.unchanged(repository, config['upstream'], gitctl.fetch.upstream_name(proj['url'])):
+            unchanged.add(repository)
+            selected.append((proj, repository, None))
+        else:
+            selected.append((proj, repository, gitctl.fetch.fetch_command(repository, config, ttl)))
+    stale = [(repository, planned) for proj, repository, planned in selected if planned is not None]
+    if args.probe:
+        # Copying the prefetched refs does not use the network
+        unchanged.update(probe(config, [repository for repository, (kind, command) in stale if kind != 'prefetched'],
+                               args.jobs))
+        stale = [(repository, planned) for repository, planned in stale if repository not in unchanged]
+    # Fetching is a single git command per project so all the fetches are
+    # driven from one thread.
+    results = dict(zip([repository for repository, planned in stale],
+                       gitctl.backend.run_many([(repository.path, command) for repository, (kind, command) in stale],
+                                               args.jobs)))
+    for proj, repository, planned in selected:
+        result = results.get(repository)
+        if result is not None:
+            kind, command = planned
+            result = gitctl.fetch.retry_missing(repository, config, command, result)
+        if gitctl.utils.fetched_with_primary(proj, projects):
+            if args.verbose:
+                LOG.info('%s Shares the repository of ``%s``', gitctl.utils.pretty(proj['name']), proj['worktree-of'])
+        elif repository in unchanged:
+            if args.verbose:
+                LOG.info('%s Unchanged', gitctl.utils.pretty(proj['name']))
+        elif result is None:
+            if args.verbose:
+                LOG.info('%s Fetched recently', gitctl.utils.pretty(proj['name']))
+        elif result.ok:
+            gitctl.fetch.record(repository, config['upstream'], kind, manifest)
+            LOG.info('%s Fetched', gitctl.utils.pretty(proj['name']))
+        else:
+            LOG.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
+
+def probe(config, repositories, jobs):
+    """Probes the upstream of the given repositories and returns the set of
+    repositories whose configured branches have not changed.
+    """
+    repositories = list(repositories)
+    changed = gitctl.fetch.probe(repositories, config['upstream'],
+                                 [local for remote, local in config['branches']], jobs)
+    if repositories:
+        LOG.info('Probed %s project(s): %s changed, %s unchanged',
+                 len(repositories), len(changed), len(repositories) - len(changed))
+    return set(repositories) - changed
+
+def gitctl_prefetch(args):
+    """Prefetches all projects without touching the remote-tracking branches."""
+    projects = gitctl.utils.parse_externals(args.externals)
+    config = gitctl.utils.parse_config(args.config)
+    selected = [(proj, gitctl.backend.Repository(gitctl.utils.project_path(proj)))
+                for proj in gitctl.utils.selected_projects(args, projects)]
+
+    while True:
+        results = gitctl.backend.run_many(
+            [(repository.path, gitctl.fetch.prefetch_command(config))
+             for proj, repository in selected],
+            args.jobs)
+        for (proj, repository), result in zip(selected, results):
+            result = gitctl.fetch.retry_missing(repository, config, gitctl.fetch.prefetch_command(config), result)
+            if result.ok:
+                gitctl.fetch.mark_fetched(repository, config['upstream'], kind='prefetched')
+                if args.verbose:
+                    LOG.info('%s Prefetched', gitctl.utils.pretty(proj['name']))
+            else:
+                LOG.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
+        if not args.interval:
+            break
+        time.sleep(args.interval)
 
 def gitctl_branch(args):
     """Operates on the project branches."""
     projects = gitctl.utils.parse_externals(args.externals)
     config = gitctl.utils.parse_config(args.config)
     
-    for proj in gitctl.utils.selected_projects(args, projects):
-        repository = git.Repo(gitctl.utils.project_path(proj))
+    def branch_project(proj, log):
+        repository = gitctl.backend.Repository(gitctl.utils.project_path(proj))
         if not args.checkout and args.list:
-            LOG.info('%s %s' % (gitctl.utils.pretty(proj['name']),
-                                repository.active_branch))
+            log.info('%s %s' % (gitctl.utils.pretty(proj['name']),
+                                repository.active_branch() or '(no branch)'))
         
         if args.checkout:
             branch = args.checkout[0]
-            if repository.is_dirty:
-                LOG.info('%s Dirty working directory. Please commit or stash and try again.' % gitctl.utils.pretty(proj['name']))
+            state = repository.state()
+            if state.dirty:
+                log.info('%s Dirty working directory. Please commit or stash and try again.' % gitctl.utils.pretty(proj['name']))
             else:
-                branches = set([b.name for b in repository.branches])
-                if branch not in branches:
-                    LOG.warning('%s No such branch: ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
-                elif branch == repository.active_branch and args.verbose:
-                    LOG.info('%s Already at ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
+                worktrees = repository.worktree_branches()
+                if branch not in state.branches():
+                    log.warning('%s No such branch: ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
+                elif branch in worktrees and os.path.realpath(worktrees[branch]) != os.path.realpath(repository.path):
+                    log.warning('%s Branch ``%s`` is checked out in the worktree %s' % (gitctl.utils.pretty(proj['name']), branch, worktrees[branch]))
+                elif branch == state.branch and args.verbose:
+                    log.info('%s Already at ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
                 else:
-                    repository.git.checkout(branch)
-                    LOG.info('%s Checked out ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
+                    repository.call('checkout', branch)
+                    log.info('%s Checked out ``%s``' % (gitctl.utils.pretty(proj['name']), branch))
+
+    gitctl.executor.run(branch_project, gitctl.utils.selected_projects(args, projects), args.jobs)
 
 def gitctl_update(args):
     """Updates the external projects.
@@ -141,116 +243,369 @@ def gitctl_update(args):
     """
     config = gitctl.utils.parse_config(args.config)
     projects = gitctl.utils.parse_externals(args.externals)
-
-    summary = {'total' : 0}
-
-    for proj in gitctl.utils.selected_projects(args, projects):
-        summary['total'] += 1
+    ttl = gitctl.fetch.fetch_ttl(args, config)
+    manifest = gitctl.fetch.load_manifest(config)
+    mirrors = config['mirror-cache'] and gitctl.mirror.MirrorCache(config['mirror-cache']) or None
+    selected = list(gitctl.utils.selected_projects(args, projects))
+
+    unchanged = set()
+    if args.probe:
+        stale = []
+        for proj in selected:
+            path = gitctl.utils.project_path(proj)
+            # Pinned projects are only fetched when the pinned revision is
+            # missing, so there is no point in probing them.
+            if not os.path.exists(path) or gitctl.utils.is_sha1(proj['treeish']) \
+                    or gitctl.utils.fetched_with_primary(proj, selected):
+                continue
+            repository = gitctl.backend.Repository(path)
+            if manifest is not None and manifest.unchanged(repository, config['upstream'],
+                                                           gitctl.fetch.upstream_name(proj['url'])):
+                continue
+            # Projects fetched within the TTL are not fetched at all and
+            # copying the prefetched refs does not use the network.
+            planned = gitctl.fetch.fetch_command(repository, config, ttl)
+            if planned is not None and planned[0] != 'prefetched':
+                stale.append(repository)
+        unchanged = set(repository.path for repository in probe(config, stale, args.jobs))
+
+    def update_project(proj, log):
+        """Updates a single project and returns the name of the summary
+        category it belongs to, or None if nothing changed.
+        """
         path = gitctl.utils.project_path(proj)
         if os.path.exists(path):
-            repository = git.Repo(path)
-            try:
-                repository.git.fetch()
-            except git.errors.GitCommandError, x:
-                LOG.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x)
+            repository = gitctl.backend.Repository(path)
+            pinned = gitctl.utils.is_sha1(proj['treeish'])
+            if path in unchanged:
+                # The probe showed that the upstream branches have not moved.
+                pass
+            elif gitctl.utils.fetched_with_primary(proj, selected):
+                # The shared repository was updated with the primary project.
+                pass
+            elif args.from_bundles:
+                try:
+                    gitctl.bundle.apply(repository, config, args.from_bundles, proj['name'])
+                except gitctl.backend.GitError, x:
+                    log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x.result.stderr.strip())
+            elif pinned and gitctl.utils.fetch_options(proj) and not repository.has_commit(proj['treeish']):
+                # Shallow and partial clones fetch only the pinned revision.
+                result = repository.git('fetch', *(gitctl.utils.fetch_options(proj) + (config['upstream'], proj['treeish'])))
+                if not result.ok:
+                    log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
+            elif not pinned or not repository.has_commit(proj['treeish']):
+                # A pinned revision that already exists locally can be checked
+                # out without talking to the upstream.
+                result = gitctl.fetch.fetch(repository, config, ttl, manifest, gitctl.fetch.upstream_name(proj['url']))
+                if result is not None and not result.ok:
+                    log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
             
-            if repository.is_dirty:
-                LOG.info('%s Dirty working directory. Please commit or stash and try again.', gitctl.utils.pretty(proj['name']))
-                summary.setdefault('dirty', set()).add(proj['name'])
-                continue
+            state = repository.state()
+            if state.dirty:
+                log.info('%s Dirty working directory. Please commit or stash and try again.', gitctl.utils.pretty(proj['name']))
+                return 'dirty'
 
             ok = True
             updated = False
 
-            if gitctl.utils.is_sha1(proj['treeish']):
+            sparse = proj.get('sparse')
+            resparsed = not gitctl.utils.same_sparse_patterns(sparse, repository.sparse_patterns())
+            if resparsed:
+                # The sparse checkout patterns have changed in the externals
+                # configuration.
+                repository.set_sparse_patterns(sparse)
+                log.info('%s Sparse checkout updated', gitctl.utils.pretty(proj['name']))
+
+            if pinned:
                 # We're dealing with an explicit version pin.
-                pinned_at = repository.git.rev_parse('HEAD').strip()
+                pinned_at = state.head
                 treeish = proj['treeish']
-                # Simply do a hard reset to the requested revision
-                repository.git.reset('--hard', treeish)
+                if pinned_at != treeish:
+                    # Simply do a hard reset to the requested revision
+                    repository.call('reset', '--hard', treeish)
             else:
                 # We're dealing with a dynamic branch pointer
                 pinned_at = None
-                treeish = repository.active_branch
+                treeish = state.branch
 
-                remote_branches = set(repository.git.branch('-r').split())
-                local_branches = set(repository.git.branch().split())
+                remote_branches = state.branches(remote=True)
+                local_branches = state.branches()
+                # Branches checked out in the other worktrees are updated
+                # together with their working directories.
+                elsewhere = set(branch for branch, worktree in repository.worktree_branches().iteritems()
+                                if os.path.realpath(worktree) != os.path.realpath(path))
 
                 for remote, local in config['branches']:
+                    if local in elsewhere:
+                        continue
                     if remote in remote_branches and local in local_branches:
-                        if repository.git.rev_parse(remote) == repository.git.rev_parse(local):
+                        local_sha1 = state.refs['refs/heads/%s' % local]
+                        remote_sha1 = state.refs['refs/remotes/%s' % remote]
+                        if local_sha1 == remote_sha1:
                             # Skip branches that have not changed.
                             continue
 
-                        # Switch to the branch to avoid implicit merge commits
-                        repository.git.checkout(local)
+                        if not repository.is_ancestor(local_sha1, remote_sha1):
+                            # Fast-forward merge was not possible, we'll
+                            # bail out for now. We could attempt a normal merge but that
+                            # might leave multiple branch in an inconsistent state at the same time.
+                            ok = False
+                            log.warning('%s Fast forward merge not possible for branch ``%s``. Try syncing with upstream manually (pull, push or merge).', gitctl.utils.pretty(proj['name']), local)
+                            continue
 
-                        # Use a remote:local refspec to pull the given branch. We omit the + from the
-                        # refspec to attempt a fast-forward merge.
-                        status, stdout, stderr = repository.git.pull(
-                            config['upstream'],
-                            '%s:%s' % (local, local),
-                            with_exceptions=False,
-                            with_extended_output=True)
+                        if local == treeish:
+                            # Only the checked out branch needs to touch the working directory.
+                            result = repository.git('merge', '--ff-only', remote_sha1)
+                        else:
+                            # Move the branch ref directly. The old value guards
+                            # against concurrent modifications.
+                            result = repository.git('update-ref', '-m', 'gitctl: fast-forward from %s' % remote,
+                                                    'refs/heads/%s' % local, remote_sha1, local_sha1)
 
-                        if status != 0:
+                        if result.status != 0:
                             ok = False
-                            if 'non fast forward' in stderr.lower():
-                                # Fast-forward merge was not possible, we'll
-                                # bail out for now. We could attempt a normal 'git pull' operation but that
-                                # might leave multiple branch in an inconsistent state at the same time.
-                                LOG.warning('%s Fast forward merge not possible for branch ``%s``. Try syncing with upstream manually (pull, push or merge).', gitctl.utils.pretty(proj['name']), local)
-                                summary.setdefault('failed', set()).add(proj['name'])
-                            else:
-                                # Some other kind of error.
-                                LOG.critical('%s Update failure: %s', gitctl.utils.pretty(proj['name']), stderr)
-                                summary.setdefault('failed', set()).add(proj['name'])
+                            log.critical('%s Update failure: %s', gitctl.utils.pretty(proj['name']), result.stderr.rstrip())
                         else:
                             updated = True
 
-                repository.git.checkout(treeish)
-
-            if ok:
-                if gitctl.utils.is_sha1(treeish) and pinned_at is not None:
-                    # If we're using pinned down revisions we only report changes when the
-                    # explicit revision was changed, even if the branches were updated.
-                    if pinned_at == proj['treeish']:
-                        if args.verbose:
-                            LOG.info('%s OK', gitctl.utils.pretty(proj['name']))
-                    else:
-                        LOG.info('%s Checked out revision ``%s``', gitctl.utils.pretty(proj['name']), treeish)
-                        summary.setdefault('updated', set()).add(proj['name'])
-                elif updated:
-                    LOG.info('%s Updated', gitctl.utils.pretty(proj['name']))
-                    summary.setdefault('updated', set()).add(proj['name'])
-                elif args.verbose:
-                    LOG.info('%s OK', gitctl.utils.pretty(proj['name']))
+            if not ok:
+                return 'failed'
 
+            if gitctl.utils.is_sha1(treeish) and pinned_at is not None:
+                # If we're using pinned down revisions we only report changes when the
+                # explicit revision was changed, even if the branches were updated.
+                if pinned_at == proj['treeish']:
+                    if args.verbose:
+                        log.info('%s OK', gitctl.utils.pretty(proj['name']))
+                else:
+                    log.info('%s Checked out revision ``%s``', gitctl.utils.pretty(proj['name']), treeish)
+                    return 'updated'
+            elif updated:
+                log.info('%s Updated', gitctl.utils.pretty(proj['name']))
+                return 'updated'
+            elif args.verbose:
+                log.info('%s OK', gitctl.utils.pretty(proj['name']))
+            if resparsed:
+                return 'updated'
+
+        elif 'worktree-of' in proj:
+            primary = [p for p in projects if p['name'] == proj['worktree-of']][0]
+            if not os.path.exists(gitctl.utils.project_path(primary)):
+                log.error('%s The primary project ``%s`` is not cloned', gitctl.utils.pretty(proj['name']), primary['name'])
+                return 'failed'
+            repository = gitctl.backend.Repository(gitctl.utils.project_path(primary))
+            result = repository.git('worktree', 'add', '--quiet', path, proj['treeish'])
+            if not result.ok:
+                log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
+                return 'failed'
+            log.info('%s Added worktree of ``%s`` and checked out ``%s``',
+                     gitctl.utils.pretty(proj['name']), primary['name'], proj['treeish'])
+            return 'cloned'
         else:
             # Clone the repository
-            temp = git.Git('/tmp')
-            temp.clone('--no-checkout', '--origin', config['upstream'],  proj['url'], path)
+            options = gitctl.utils.clone_options(proj)
+            mirror = mirrors is not None and mirrors.get(proj['url']) or None
+            if mirror is not None:
+                options += ('--reference', mirror)
+                if config['mirror-dissociate']:
+                    options += ('--dissociate',)
+            if args.from_bundles:
+                if not gitctl.bundle.bundle_files(args.from_bundles, proj['name']):
+                    log.error('%s No bundle in %s', gitctl.utils.pretty(proj['name']), args.from_bundles)
+                    return 'failed'
+                os.makedirs(path)
+                repository = gitctl.backend.Repository(path)
+                try:
+                    repository.call('init', '--quiet')
+                    repository.call('remote', 'add', config['upstream'], proj['url'])
+                    gitctl.bundle.apply(repository, config, args.from_bundles, proj['name'])
+                except gitctl.backend.GitError, x:
+                    # Do not leave a half initialized project behind.
+                    shutil.rmtree(path, ignore_errors=True)
+                    log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x.result.stderr.strip())
+                    return 'failed'
+            else:
+                temp = gitctl.backend.Repository('/tmp')
+                temp.call('clone', '--no-checkout', '--origin', config['upstream'], *(options + (proj['url'], path)))
+                repository = gitctl.backend.Repository(path)
+                if gitctl.utils.is_sha1(proj['treeish']) and gitctl.utils.fetch_options(proj) \
+                        and not repository.has_commit(proj['treeish']):
+                    # The pinned revision is not within the truncated history.
+                    repository.call('fetch', *(gitctl.utils.fetch_options(proj) + (config['upstream'], proj['treeish'])))
+                gitctl.fetch.mark_fetched(repository, config['upstream'])
+                if manifest is not None:
+                    manifest.mark_synced(repository, config['upstream'])
 
             # Set up the local tracking branches
-            repository = git.Git(path)
-            remote_branches = set(repository.branch('-r').split())
-            local_branches = set(repository.branch().split())
+            remote_branches = repository.branches(remote=True)
+            local_branches = repository.branches()
             for remote, local in config['branches']:
                 if remote in remote_branches and local not in local_branches:
-                    repository.branch('-f', '--track', local, remote)
+                    repository.call('branch', '-f', '--track', local, remote)
+            if 'sparse' in proj:
+                # Set up before the first checkout so that only the selected
+                # directories are ever written to the working directory.
+                repository.set_sparse_patterns(proj['sparse'])
             # Check out the given treeish
-            repository.checkout(proj['treeish'])
-            LOG.info('%s Cloned and checked out ``%s``', gitctl.utils.pretty(proj['name']), proj['treeish'])
-            summary.setdefault('cloned', set()).add(proj['name'])
+            repository.call('checkout', proj['treeish'])
+            log.info('%s Cloned and checked out ``%s``', gitctl.utils.pretty(proj['name']), proj['treeish'])
+            return 'cloned'
+
+    # The worktrees wait for their primary projects so that they can be added
+    # and the shared repository is fetched only once.
+    results = gitctl.executor.run(update_project, selected, args.jobs,
+                                  after=lambda proj: gitctl.utils.primary_project(proj, selected))
 
     LOG_SUMMARY.info(UPDATE_SUMMARY_TMPL % {
-        'total' : summary['total'],
-        'updated' : len(summary.get('updated', [])),
-        'cloned' : len(summary.get('cloned', [])),
-        'failed' : len(summary.get('failed', [])),
-        'dirty' : len(summary.get('dirty', [])),
+        'total' : len(selected),
+        'updated' : results.count('updated'),
+        'cloned' : results.count('cloned'),
+        'failed' : results.count('failed'),
+        'dirty' : results.count('dirty'),
      })
 
+def gitctl_dedupe(args):
+    """Makes the projects borrow their objects from the mirror cache."""
+    config = gitctl.utils.parse_config(args.config)
+    projects = gitctl.utils.parse_externals(args.externals)
+    if not config['mirror-cache']:
+        LOG.critical('The ``mirror-cache`` option is not configured.')
+        sys.exit(1)
+    mirrors = gitctl.mirror.MirrorCache(config['mirror-cache'])
+
+    def dedupe_project(proj, log):
+        path = gitctl.utils.project_path(proj)
+        if not os.path.exists(path):
+            log.warning('%s Not cloned', gitctl.utils.pretty(proj['name']))
+            return
+        mirror = mirrors.get(proj['url'])
+        if mirror is None:
+            log.error('%s No mirror available', gitctl.utils.pretty(proj['name']))
+            return
+        repository = gitctl.backend.Repository(path)
+        objects = os.path.join(repository.common_dir, 'objects')
+        before = gitctl.mirror.disk_usage(objects)
+        if gitctl.mirror.borrow(repository, mirror):
+            freed = before - gitctl.mirror.disk_usage(objects)
+            log.info('%s Deduplicated, %.1f MiB freed', gitctl.utils.pretty(proj['name']),
+                     max(freed, 0) / 1048576.0)
+        elif args.verbose:
+            log.info('%s Deduplicated already', gitctl.utils.pretty(proj['name']))
+
+    gitctl.executor.run(dedupe_project, gitctl.utils.selected_projects(args, projects), args.jobs)
+
+def gitctl_bundle(args):
+    """Exports the projects as git bundles."""
+    config = gitctl.utils.parse_config(args.config)
+    projects = gitctl.utils.parse_externals(args.externals)
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+
+    def bundle_project(proj, log):
+        path = gitctl.utils.project_path(proj)
+        if not os.path.exists(path):
+            log.warning('%s Not cloned', gitctl.utils.pretty(proj['name']))
+            return 'failed'
+        repository = gitctl.backend.Repository(path)
+        try:
+            kind = gitctl.bundle.export(repository, config, proj, args.directory)
+        except (gitctl.backend.GitError, ValueError), x:
+            log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x)
+            return 'failed'
+        if kind == 'full':
+            log.info('%s Exported', gitctl.utils.pretty(proj['name']))
+        elif kind == 'incremental':
+            log.info('%s Exported incrementally', gitctl.utils.pretty(proj['name']))
+        elif args.verbose:
+            log.info('%s Unchanged', gitctl.utils.pretty(proj['name']))
+        return kind
+
+    results = gitctl.executor.run(bundle_project, gitctl.utils.selected_projects(args, projects), args.jobs)
+    if 'failed' in results:
+        sys.exit(1)
+
+def gitctl_export(args):
+    """Writes the trees of the project treeishes as plain files."""
+    config = gitctl.utils.parse_config(args.config)
+    projects = gitctl.utils.parse_externals(args.externals)
+    mirrors = config['mirror-cache'] and gitctl.mirror.MirrorCache(config['mirror-cache']) or None
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    state = gitctl.snapshot.read_state(args.directory)
+
+    def export_project(proj, log):
+        path = gitctl.utils.project_path(proj)
+        if os.path.exists(path):
+            repository = gitctl.backend.Repository(path)
+        elif mirrors is not None and mirrors.get(proj['url']) is not None:
+            repository = gitctl.backend.Repository(mirrors.get(proj['url']))
+        else:
+            log.warning('%s Not cloned', gitctl.utils.pretty(proj['name']))
+            return None
+        target = gitctl.snapshot.snapshot_path(args.directory, proj)
+        try:
+            if state.get(proj['name']) == repository.rev_parse('%s^{tree}' % proj['treeish']) \
+                    and os.path.isdir(target):
+                if args.verbose:
+                    log.info('%s Unchanged', gitctl.utils.pretty(proj['name']))
+                return state[proj['name']]
+            tree, cached = gitctl.snapshot.snapshot(repository, proj['treeish'], target, config['artifact-cache'])
+        except (gitctl.backend.GitError, OSError), x:
+            log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x)
+            return None
+        if cached:
+            log.info('%s Exported ``%s`` from the artifact cache', gitctl.utils.pretty(proj['name']), proj['treeish'])
+        else:
+            log.info('%s Exported ``%s``', gitctl.utils.pretty(proj['name']), proj['treeish'])
+        return tree
+
+    selected = list(gitctl.utils.selected_projects(args, projects))
+    trees = gitctl.executor.run(export_project, selected, args.jobs)
+    for proj, tree in zip(selected, trees):
+        if tree is None:
+            state.pop(proj['name'], None)
+        else:
+            state[proj['name']] = tree
+    gitctl.snapshot.write_state(args.directory, state)
+    if None in trees:
+        sys.exit(1)
+
+def gitctl_maintenance(args):
+    """Runs maintenance tasks in the projects and reports the effect on a
+    status probe.
+    """
+    config = gitctl.utils.parse_config(args.config)
+    projects = gitctl.utils.parse_externals(args.externals)
+    tasks = gitctl.maintenance.parse_tasks(args.task or config['maintenance-tasks'])
+    if 'fsmonitor' in tasks and not gitctl.maintenance.supports_fsmonitor():
+        LOG.warning('Skipping the fsmonitor task, git has no builtin file system monitor on this platform.')
+        tasks.remove('fsmonitor')
+
+    def maintain_project(proj, log):
+        path = gitctl.utils.project_path(proj)
+        if not os.path.exists(path):
+            log.warning('%s Not cloned', gitctl.utils.pretty(proj['name']))
+            return None
+        repository = gitctl.backend.Repository(path)
+        before = gitctl.maintenance.status_probe(repository, config)
+        for task in tasks:
+            try:
+                gitctl.maintenance.run_task(repository, task)
+            except gitctl.backend.GitError, x:
+                log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), x)
+                return None
+        after = gitctl.maintenance.status_probe(repository, config)
+        log.info('%s Status probe %.3fs -> %.3fs', gitctl.utils.pretty(proj['name']), before, after)
+        return before, after
+
+    timings = [timing for timing
+               in gitctl.executor.run(maintain_project, gitctl.utils.selected_projects(args, projects), args.jobs)
+               if timing is not None]
+    if timings:
+        LOG.info('Ran %s in %s project(s). Status probe total %.3fs -> %.3fs',
+                 ', '.join(tasks), len(timings),
+                 sum(before for before, after in timings), sum(after for before, after in timings))
+
 def gitctl_path(args):
     """Give the path to project directory."""
     config = gitctl.utils.parse_config(args.config)
@@ -264,24 +619,96 @@ def gitctl_path(args):
     return paths
 
 def gitctl_sh(args):
-    """Execute shell command in the projects' directories."""
+    """Execute shell command in the projects' directories.
+
+    Returns the highest exit status of the commands.
+    """
     config = gitctl.utils.parse_config(args.config)
     projects = gitctl.utils.parse_externals(args.externals)
-    result = 0
 
-    for proj in gitctl.utils.selected_projects(args, projects):
-        project_path = gitctl.utils.project_path(proj)
-        subresult = os.system("cd %s; PROJECT='%s'; %s" % (project_path, proj['name'], args.command))
-        if subresult != 0:
-            LOG.error('%s Error while doing %s', proj["name"], args.command)
-        result += subresult
+    running = set()
+    output_lock = threading.Lock()
 
-    return result
+    def kill(process):
+        # The command runs in its own process group so that any processes it
+        # spawned are terminated as well.
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def stream(proj, pipe, target):
+        for line in iter(pipe.readline, ''):
+            output_lock.acquire()
+            try:
+                target.write('%s: %s' % (proj['name'], line))
+                target.flush()
+            finally:
+                output_lock.release()
+
+    def sh_project(proj, log):
+        process = subprocess.Popen(args.command,
+                                   shell=True,
+                                   cwd=gitctl.utils.project_path(proj),
+                                   env=dict(os.environ, PROJECT=proj['name']),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   preexec_fn=os.setpgrp)
+        running.add(process)
+        timed_out = []
+        timer = None
+        if args.timeout:
+            def expire():
+                timed_out.append(True)
+                kill(process)
+            timer = threading.Timer(args.timeout, expire)
+            timer.start()
+        try:
+            if args.stream:
+                stderr_reader = threading.Thread(target=stream, args=(proj, process.stderr, sys.stderr))
+                stderr_reader.start()
+                stream(proj, process.stdout, sys.stdout)
+                stderr_reader.join()
+                process.wait()
+            else:
+                stdout, stderr = process.communicate()
+                log.write(stdout)
+                log.write(stderr, sys.stderr)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            running.discard(process)
+
+        if timed_out:
+            log.error('%s Timed out after %s seconds while doing %s', proj['name'], args.timeout, args.command)
+            return 'timeout', 124
+        if process.returncode != 0:
+            log.error('%s Error while doing %s', proj["name"], args.command)
+        if process.returncode < 0:
+            # Terminated by a signal
+            return 'signal %s' % -process.returncode, 128 - process.returncode
+        return str(process.returncode), process.returncode
+
+    selected = list(gitctl.utils.selected_projects(args, projects))
+    try:
+        results = gitctl.executor.run(sh_project, selected, args.jobs)
+    except KeyboardInterrupt:
+        for process in list(running):
+            kill(process)
+        raise
+
+    if len(selected) > 0:
+        LOG_SUMMARY.info('\n'.join(['Exit status:'] + ['%s %s' % (gitctl.utils.pretty(proj['name']), status)
+                                                        for proj, (status, code) in zip(selected, results)]))
+
+    return max([code for status, code in results] or [0])
 
 def gitctl_status(args):
     """Checks the status of all external projects."""
     config = gitctl.utils.parse_config(args.config)
     projects = gitctl.utils.parse_externals(args.externals)
+    ttl = gitctl.fetch.fetch_ttl(args, config)
+    manifest = gitctl.fetch.load_manifest(config)
     
     # By default do not show commits
     commit_limit = 0
@@ -290,30 +717,50 @@ def gitctl_status(args):
         if args.limit > 0:
             commit_limit = args.limit
 
-    for proj in gitctl.utils.selected_projects(args, projects):
-        repository = git.Repo(gitctl.utils.project_path(proj))
-        if not args.no_fetch:
+    selected = list(gitctl.utils.selected_projects(args, projects))
+
+    def status_project(proj, log):
+        repository = gitctl.backend.Repository(gitctl.utils.project_path(proj))
+        if not args.no_fetch and not gitctl.utils.fetched_with_primary(proj, selected):
             # Fetch upstream
-            repository.git.fetch(config['upstream'])
+            result = gitctl.fetch.fetch(repository, config, ttl, manifest, gitctl.fetch.upstream_name(proj['url']))
+            if result is not None and not result.ok:
+                log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
 
         output = []
-        branches = gitctl.wtf.branch_structure(repository)
+        state = repository.state()
+        branches = gitctl.wtf.branch_structure(repository, state.refs)
         for branch_name in config['development-branch'], config['staging-branch'], config['production-branch']:
-            if branch_name in branches:
-                output.extend(gitctl.wtf.show_branch(repository, branches[branch_name], branches, verbose=args.verbose, commit_limit=commit_limit))
+            if branch_name not in branches:
+                continue
+            if 'local_branch' not in branches[branch_name] or 'remote_branch' not in branches[branch_name]:
+                # Single branch clones do not have all the branches.
+                continue
+            try:
+                output.extend(gitctl.wtf.show_branch(repository, branches[branch_name], branches, verbose=args.verbose, commit_limit=commit_limit,
+                                                     feature_days=args.feature_days, feature_limit=args.feature_limit))
+            except gitctl.backend.GitError:
+                output.append('[!] Branch ``%s`` could not be compared because the history is incomplete' % branch_name)
 
-        if repository.is_dirty:
+        if repository.is_shallow() and args.verbose:
+            output.append('[!] Shallow clone, the commit counts only cover the fetched history')
+
+        if state.dirty:
             output.append('[!] Working directory has uncommitted changes')
 
-        if len(repository.git.diff_index('--cached', 'HEAD').strip()) > 0:
+        if state.staged:
             output.append('[!] Working directory has added but uncommitted files')
         
         if len(output) > 0:
-            LOG.info('')
-            LOG.info('-' * len(proj['name']))
-            LOG.info(proj['name'])
-            LOG.info('-' * len(proj['name']))
-            LOG.info('\n'.join(output))
+            log.info('')
+            log.info('-' * len(proj['name']))
+            log.info(proj['name'])
+            log.info('-' * len(proj['name']))
+            log.info('\n'.join(output))
+
+    # Worktrees are handled after their primary projects have been fetched.
+    gitctl.executor.run(status_project, selected, args.jobs,
+                        after=lambda proj: gitctl.utils.primary_project(proj, selected))
 
 def gitctl_pending(args):
     """Checks for pending changes between two consecutive states in our
@@ -321,20 +768,25 @@ def gitctl_pending(args):
     """
     config = gitctl.utils.parse_config(args.config)
     projects = gitctl.utils.parse_externals(args.externals)
+    ttl = gitctl.fetch.fetch_ttl(args, config)
+    manifest = gitctl.fetch.load_manifest(config)
 
-    for proj in gitctl.utils.selected_projects(args, projects):
+    selected = list(gitctl.utils.selected_projects(args, projects))
+
+    def pending_project(proj, log):
         project_path = gitctl.utils.project_path(proj)
-        repository = git.Repo(project_path)
-        
-        local_branches = set(repository.git.branch().split())
-        remote_branches = set(repository.git.branch('-r').split())
+        repository = gitctl.backend.Repository(project_path)
+        state = repository.state()
+
+        local_branches = state.branches()
+        remote_branches = state.branches(remote=True)
         
         def assert_branch(branch, quiet=False):
             if branch in local_branches:
                 return True
             else:
                 if not quiet:
-                    LOG.warning('%s Branch %s does not exist', gitctl.utils.pretty(proj['name']), branch)
+                    log.warning('%s Branch %s does not exist', gitctl.utils.pretty(proj['name']), branch)
                 return False
                 
         
@@ -342,24 +794,32 @@ def gitctl_pending(args):
             # This looks to be a package that does not share our common repository layout
             # which is possible with 3rd party packages etc. We can safely ignore it.
             if not args.show_config and args.verbose:
-                LOG.info('%s Skipping.', gitctl.utils.pretty(proj['name']))
-            continue
+                log.info('%s Skipping.', gitctl.utils.pretty(proj['name']))
+            return
 
         # Check for dirty working directory
-        if repository.is_dirty:
-            LOG.info('%s Uncommitted local changes.', gitctl.utils.pretty(proj['name']))
-            continue
+        if state.dirty:
+            log.info('%s Uncommitted local changes.', gitctl.utils.pretty(proj['name']))
+            return
         
         # Update the remotes
-        if not args.no_fetch:
-            repository.git.fetch(config['upstream'])
+        if not args.no_fetch and not gitctl.utils.fetched_with_primary(proj, selected):
+            result = gitctl.fetch.fetch(repository, config, ttl, manifest, gitctl.fetch.upstream_name(proj['url']))
+            if result is not None and not result.ok:
+                log.error('%s ERROR %s', gitctl.utils.pretty(proj['name']), result.stderr.strip())
 
         if not gitctl.utils.is_sha1(proj['treeish']):
-            LOG.warning('%s Treeish is not a SHA1 revision: %s', gitctl.utils.pretty(proj['name']), proj['treeish'])
-            continue
+            log.warning('%s Treeish is not a SHA1 revision: %s', gitctl.utils.pretty(proj['name']), proj['treeish'])
+            return
     
-        from_ = repository.git.rev_parse(proj['treeish'])
-        to = repository.git.rev_parse('%s/%s' % (config['upstream'], config['production-branch']))
+        try:
+            from_ = repository.rev_parse(proj['treeish'])
+            to = repository.rev_parse('%s/%s' % (config['upstream'], config['production-branch']))
+        except gitctl.backend.GitError:
+            # Shallow and single branch clones may lack either side.
+            log.warning('%s Cannot compare ``%s`` with the pinned revision, the history is incomplete',
+                        gitctl.utils.pretty(proj['name']), config['production-branch'])
+            return
         
         if from_ != to:
             # The comparison branch has advanced.
@@ -367,15 +827,25 @@ def gitctl_pending(args):
                 # Update the treeish to the latest version in the comparison branch.
                 proj['treeish'] = to
             else:
-                commits = len(repository.git.log('--pretty=oneline', '%s..%s' % (from_, to)).splitlines())
-                LOG.info('%s Branch ``%s`` is %s commit(s) ahead at revision %s',
-                         gitctl.utils.pretty(proj['name']), config['production-branch'], commits, to)
+                commits = gitctl.wtf.format_count(gitctl.wtf.count_commits(repository, from_, to, gitctl.wtf.COUNT_CAP),
+                                                  gitctl.wtf.COUNT_CAP)
+                if repository.is_shallow():
+                    log.info('%s Branch ``%s`` is at least %s commit(s) ahead at revision %s (shallow clone)',
+                             gitctl.utils.pretty(proj['name']), config['production-branch'], commits, to)
+                else:
+                    log.info('%s Branch ``%s`` is %s commit(s) ahead at revision %s',
+                             gitctl.utils.pretty(proj['name']), config['production-branch'], commits, to)
         else:
             if args.verbose and not args.show_config:
-                LOG.info('%s OK', gitctl.utils.pretty(proj['name']))
+                log.info('%s OK', gitctl.utils.pretty(proj['name']))
+
+    # Worktrees are handled after their primary projects have been fetched.
+    gitctl.executor.run(pending_project, selected, args.jobs,
+                        after=lambda proj: gitctl.utils.primary_project(proj, selected))
         
     if args.show_config:
         LOG.info(gitctl.utils.generate_externals(projects))
 
-__all__ = ['gitctl_create', 'gitctl_fetch', 'gitctl_update', 'gitctl_path', 'gitctl_sh',  'gitctl_status',
-           'gitctl_pending', 'gitctl_branch']
+__all__ = ['gitctl_create', 'gitctl_fetch', 'gitctl_prefetch', 'gitctl_update', 'gitctl_path', 'gitctl_sh',  'gitctl_status',
+           'gitctl_pending', 'gitctl_branch', 'gitctl_dedupe', 'gitctl_bundle',
+           'gitctl_export', 'gitctl_maintenance']
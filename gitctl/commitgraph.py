@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Reading the commit-graph files of a repository.
+
+The commit-graph (written by ``git commit-graph write`` or ``gitctl
+maintenance``) stores the parents and the generation number of every commit
+in a memory mappable table. The files are read in place, either the single
+``objects/info/commit-graph`` file or the layers listed in
+``objects/info/commit-graphs/commit-graph-chain``, which lets the ancestry
+questions of gitctl be answered without spawning git.
+
+Generation numbers order the commits so that every commit comes after its
+descendants. The walks use them to stop as soon as the answer is known.
+``load`` returns None when there is no usable commit-graph, and the methods
+raise GraphError for commits without a generation number. The callers fall
+back to git in both cases.
+"""
+import os
+import mmap
+import heapq
+import struct
+import binascii
+import threading
+
+# The parent value of a commit without the parent
+PARENT_NONE = 0x70000000
+# Set in the second parent value when the parents continue in the EDGE chunk
+# and in the last EDGE entry of a commit
+PARENT_EXTRA = 0x80000000
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+class GraphError(Exception):
+    """Raised for commit-graphs the reader does not handle."""
+
+class GraphFile(object):
+    """A single commit-graph file or a layer of a commit-graph chain."""
+
+    def __init__(self, path):
+        handle = open(path, 'rb')
+        try:
+            try:
+                self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                raise GraphError('Cannot map %s' % path)
+        finally:
+            handle.close()
+        data = self.data
+        if data.size() < 8 or data[:4] != 'CGPH' or ord(data[4]) != 1:
+            raise GraphError('Unsupported commit-graph file: %s' % path)
+        self.hash_size = {1: 20, 2: 32}.get(ord(data[5]))
+        if self.hash_size is None:
+            raise GraphError('Unsupported hash version in %s' % path)
+        chunks = {}
+        for i in range(ord(data[6])):
+            chunk_id, offset = struct.unpack_from('>4sQ', data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+        for chunk_id in ('OIDF', 'OIDL', 'CDAT'):
+            if chunk_id not in chunks:
+                raise GraphError('Missing %s chunk in %s' % (chunk_id, path))
+        self.fanout = struct.unpack_from('>256I', data, chunks['OIDF'])
+        self.count = self.fanout[255]
+        self.oids = chunks['OIDL']
+        self.commits = chunks['CDAT']
+        self.edges = chunks.get('EDGE')
+        # Set by Graph to the number of commits in the layers below
+        self.offset = 0
+
+    def find(self, oid):
+        """Returns the position of the binary object name ``oid`` in the
+        file or None.
+        """
+        first = ord(oid[0])
+        low = first and self.fanout[first - 1] or 0
+        high = self.fanout[first]
+        size = self.hash_size
+        while low < high:
+            middle = (low + high) // 2
+            start = self.oids + middle * size
+            current = self.data[start:start + size]
+            if current == oid:
+                return middle
+            if current < oid:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def oid(self, position):
+        """Returns the binary object name at ``position``."""
+        start = self.oids + position * self.hash_size
+        return self.data[start:start + self.hash_size]
+
+    def parents(self, position):
+        """Returns the global positions of the parents of the commit."""
+        first, second = struct.unpack_from('>II', self.data, self.commits + position * (self.hash_size + 16) + self.hash_size)
+        if first == PARENT_NONE:
+            return ()
+        if second == PARENT_NONE:
+            return (first,)
+        if not second & PARENT_EXTRA:
+            return (first, second)
+        if self.edges is None:
+            raise GraphError('Missing EDGE chunk')
+        parents = [first]
+        index = second & ~PARENT_EXTRA
+        while True:
+            value = struct.unpack_from('>I', self.data, self.edges + 4 * index)[0]
+            parents.append(value & ~PARENT_EXTRA)
+            if value & PARENT_EXTRA:
+                return tuple(parents)
+            index += 1
+
+    def generation(self, position):
+        """Returns the topological level of the commit, 0 if unknown."""
+        offset = self.commits + position * (self.hash_size + 16) + self.hash_size + 8
+        return struct.unpack_from('>I', self.data, offset)[0] >> 2
+
+class Graph(object):
+    """The commit-graph of a repository, made of one or more GraphFiles.
+
+    Commits are identified by their global position: the positions of a
+    layer follow the positions of the layers below it.
+    """
+
+    def __init__(self, layers):
+        # The base layer first
+        self.layers = layers
+        offset = 0
+        for layer in layers:
+            layer.offset = offset
+            offset += layer.count
+
+    def layer(self, position):
+        for layer in reversed(self.layers):
+            if position >= layer.offset:
+                return layer
+        raise GraphError('Invalid position %s' % position)
+
+    def lookup(self, sha1):
+        """Returns the position of the commit ``sha1`` or None if it is not
+        in the graph.
+        """
+        oid = binascii.unhexlify(sha1)
+        for layer in reversed(self.layers):
+            if len(oid) == layer.hash_size:
+                position = layer.find(oid)
+                if position is not None:
+                    return layer.offset + position
+        return None
+
+    def sha1(self, position):
+        """Returns the SHA1 of the commit at ``position``."""
+        layer = self.layer(position)
+        return binascii.hexlify(layer.oid(position - layer.offset))
+
+    def parents(self, position):
+        layer = self.layer(position)
+        return layer.parents(position - layer.offset)
+
+    def generation(self, position):
+        """Returns the generation number of the commit. Raises GraphError if
+        the commit does not have one.
+        """
+        layer = self.layer(position)
+        generation = layer.generation(position - layer.offset)
+        if generation == 0:
+            raise GraphError('No generation number for %s' % self.sha1(position))
+        return generation
+
+    def is_ancestor(self, ancestor, descendant):
+        """Returns True if the commit at position ``ancestor`` is reachable
+        from the commit at position ``descendant``.
+        """
+        if ancestor == descendant:
+            return True
+        # Commits at or below the generation of the ancestor cannot reach it
+        cutoff = self.generation(ancestor)
+        seen = set([descendant])
+        stack = [descendant]
+        while stack:
+            for parent in self.parents(stack.pop()):
+                if parent == ancestor:
+                    return True
+                if parent not in seen:
+                    seen.add(parent)
+                    if self.generation(parent) > cutoff:
+                        stack.append(parent)
+        return False
+
+    def histogram(self, positions, stop=None):
+        """Walks the commits reachable from the commits at ``positions`` and
+        tags each with the bitmask of the positions (bit ``i`` for
+        ``positions[i]``) it is reachable from. Returns a dictionary mapping
+        the masks to the numbers of commits. The commits reachable from all
+        the positions are not counted.
+
+        ``stop`` is an optional ``(mask, count)`` pair. The walk then stops
+        once ``count`` commits with ``mask`` have been counted, leaving the
+        other counts incomplete.
+        """
+        full = (1 << len(positions)) - 1
+        masks = {}
+        for i, position in enumerate(positions):
+            masks[position] = masks.get(position, 0) | (1 << i)
+        queue = [(-self.generation(position), position) for position in masks]
+        heapq.heapify(queue)
+        active = len([mask for mask in masks.values() if mask != full])
+        histogram = {}
+        while queue and active:
+            # The descendants have larger generation numbers, so the mask of
+            # the commit is complete when it is popped.
+            position = heapq.heappop(queue)[1]
+            mask = masks[position]
+            if mask != full:
+                active -= 1
+                histogram[mask] = histogram.get(mask, 0) + 1
+                if stop is not None and stop == (mask, histogram[mask]):
+                    break
+            for parent in self.parents(position):
+                previous = masks.get(parent)
+                if previous is None:
+                    masks[parent] = mask
+                    heapq.heappush(queue, (-self.generation(parent), parent))
+                    if mask != full:
+                        active += 1
+                elif previous | mask != previous:
+                    masks[parent] = previous | mask
+                    if previous | mask == full:
+                        active -= 1
+        return histogram
+
+def graph_files(objects):
+    """Returns the paths of the commit-graph files in the ``objects``
+    directory, the base layer first.
+    """
+    single = os.path.join(objects, 'info', 'commit-graph')
+    if os.path.exists(single):
+        return [single]
+    chain = os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain')
+    try:
+        hashes = [line.strip() for line in open(chain) if line.strip()]
+    except IOError:
+        return []
+    return [os.path.join(objects, 'info', 'commit-graphs', 'graph-%s.graph' % value) for value in hashes]
+
+def is_usable(repository):
+    """Returns True if git would use the commit-graph of the repository.
+    Grafts, replace refs and shallow clones change the parents of commits.
+    """
+    for key, value in reversed(repository.config()):
+        if key == 'core.commitgraph':
+            if value is not None and value.lower() in ('false', 'no', 'off', '0'):
+                return False
+            break
+    if repository.is_shallow() or os.path.exists(os.path.join(repository.common_dir, 'info', 'grafts')):
+        return False
+    return not [name for name in repository.refs() if name.startswith('refs/replace/')]
+
+def load(repository):
+    """Returns the Graph of the repository or None if there is no usable
+    commit-graph. The graph is cached until the files change.
+    """
+    if not is_usable(repository):
+        return None
+    objects = os.path.join(repository.common_dir, 'objects')
+    try:
+        paths = graph_files(objects)
+        key = tuple((path, os.stat(path).st_mtime, os.stat(path).st_size) for path in paths)
+    except OSError:
+        return None
+    if not paths:
+        return None
+    _cache_lock.acquire()
+    try:
+        cached = _cache.get(objects)
+    finally:
+        _cache_lock.release()
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    try:
+        graph = Graph([GraphFile(path) for path in paths])
+    except (IOError, GraphError, struct.error):
+        return None
+    _cache_lock.acquire()
+    try:
+        _cache[objects] = (key, graph)
+    finally:
+        _cache_lock.release()
+    return graph
+
+def clear_cache():
+    """Forgets all the cached graphs."""
+    _cache_lock.acquire()
+    try:
+        _cache.clear()
+    finally:
+        _cache_lock.release()
+
+__all__ = ['Graph', 'GraphError', 'GraphFile', 'clear_cache', 'graph_files', 'is_usable', 'load']
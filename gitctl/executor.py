@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Concurrent execution of per-project work."""
+import sys
+import Queue
+import logging
+import threading
+import multiprocessing
+
+LOG = logging.getLogger('gitctl')
+
+def default_jobs():
+    """Returns the default number of concurrent jobs."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class ProjectLog(object):
+    """Buffers the log messages of a single project so that they can be
+    emitted later in a deterministic order.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, msg, *args):
+        self.records.append((level, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def critical(self, msg, *args):
+        self.log(logging.CRITICAL, msg, *args)
+
+    def write(self, data, stream=None):
+        """Buffers raw ``data`` that will be written to ``stream`` (defaults
+        to sys.stdout) instead of the logger.
+        """
+        self.records.append((None, data, stream))
+
+    def flush(self, logger=LOG):
+        """Emits the buffered messages to ``logger``."""
+        for level, msg, args in self.records:
+            if level is None:
+                stream = args or sys.stdout
+                stream.write(msg)
+                stream.flush()
+            else:
+                logger.log(level, msg, *args)
+        self.records = []
+
+def run(func, projects, jobs=None, logger=LOG, after=None):
+    """Calls ``func(proj, log)`` for each project using up to ``jobs``
+    concurrent worker threads and returns a list of the results in the order
+    of ``projects``.
+
+    Each call receives its own ``ProjectLog`` instance. The buffered messages
+    are flushed to ``logger`` in the order of ``projects`` as soon as all the
+    preceding projects have finished, so the output is identical to a serial
+    run. An exception raised by ``func`` is re-raised in the calling thread
+    after the output of the preceding projects has been flushed.
+
+    ``after(proj)`` may return another project of ``projects`` that must
+    have finished before ``proj`` is started, e.g. the primary project of a
+    worktree. That project must not depend on another one itself.
+
+    On KeyboardInterrupt the projects that have not been started yet are
+    cancelled and the interrupt is propagated to the caller.
+    """
+    projects = list(projects)
+    if jobs is None:
+        jobs = default_jobs()
+    jobs = max(1, min(jobs, len(projects)))
+
+    # Maps the index of a project to the index of the project it waits for
+    dependencies = {}
+    if after is not None:
+        for index, proj in enumerate(projects):
+            dependency = after(proj)
+            if dependency is not None and dependency in projects:
+                dependencies[index] = projects.index(dependency)
+    completed = [threading.Event() for proj in projects]
+
+    pending = Queue.Queue()
+    # The waiting projects are queued last so that a worker never waits for
+    # a project that has not been started.
+    for index in sorted(range(len(projects)), key=lambda index: index in dependencies):
+        pending.put((index, projects[index]))
+    finished = Queue.Queue()
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                index, proj = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if index in dependencies:
+                completed[dependencies[index]].wait()
+            log = ProjectLog()
+            try:
+                finished.put((index, log, func(proj, log), None))
+            except:
+                finished.put((index, log, None, sys.exc_info()))
+            completed[index].set()
+
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    results = [None] * len(projects)
+    done = {}
+    next_index = 0
+    try:
+        while next_index < len(projects):
+            # Use a timeout so that a KeyboardInterrupt can be delivered to
+            # the main thread while waiting.
+            try:
+                index, log, result, exc_info = finished.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            done[index] = (log, result, exc_info)
+            while next_index in done:
+                log, result, exc_info = done.pop(next_index)
+                log.flush(logger)
+                if exc_info is not None:
+                    cancelled.set()
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                results[next_index] = result
+                next_index += 1
+    except KeyboardInterrupt:
+        cancelled.set()
+        logger.warning('Interrupted, cancelled %s remaining project(s).',
+                       len(projects) - next_index)
+        raise
+
+    return results
+
+__all__ = ['default_jobs', 'ProjectLog', 'run']
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Fetching from the upstream repository.
+
+Besides regular fetches the upstream branches can be prefetched into the
+``refs/prefetch/<upstream>/`` namespace (see ``gitctl prefetch``). Prefetching
+leaves the remote-tracking branches untouched. When the prefetched refs are
+fresh enough they are copied over the remote-tracking branches locally
+instead of fetching from the network.
+
+The upstream server may also keep a change manifest (see ``manifest_hook``)
+where every pushed ref update is appended. Projects with no new manifest
+entries since their last fetch are not fetched at all.
+"""
+import os
+import re
+import time
+import logging
+import subprocess
+
+import gitctl.backend
+
+LOG = logging.getLogger('gitctl')
+
+MANIFEST_HOOK_TMPL = """\
+#!/bin/sh
+# Installed by gitctl. Appends each ref update to the gitctl change manifest.
+input=$(cat)
+now=$(date +%%s)
+printf '%%s\\n' "$input" | while read old new ref; do
+    [ -n "$ref" ] && echo "$now %(project)s $ref $old $new" >> "%(manifest)s"
+done
+"""
+
+MANIFEST_HOOK_EMAIL = """\
+printf '%s\\n' "$input" | . /usr/share/doc/git-core/contrib/hooks/post-receive-email
+"""
+
+def stamp_path(repository, upstream, kind='fetched'):
+    """Returns the path of the file where gitctl records the state of the
+    given ``kind`` (fetched, prefetched or manifest) for ``upstream``.
+    """
+    return os.path.join(repository.common_dir, 'gitctl', '%s-%s' % (kind, upstream))
+
+def last_fetched(repository, upstream, kind='fetched'):
+    """Returns the time of the last successful fetch from ``upstream`` or
+    None if the repository has not been fetched by gitctl.
+    """
+    try:
+        return os.path.getmtime(stamp_path(repository, upstream, kind))
+    except OSError:
+        return None
+
+def mark_fetched(repository, upstream, kind='fetched', when=None):
+    """Records a successful fetch from ``upstream`` that happened at ``when``
+    (defaults to now).
+    """
+    path = stamp_path(repository, upstream, kind)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    if when is None:
+        os.utime(path, None)
+    else:
+        os.utime(path, (when, when))
+
+def is_fresh(repository, upstream, ttl, kind='fetched'):
+    """Returns True if the repository was fetched from ``upstream`` less than
+    ``ttl`` seconds ago.
+    """
+    if not ttl or ttl <= 0:
+        return False
+    fetched = last_fetched(repository, upstream, kind)
+    return fetched is not None and time.time() - fetched < ttl
+
+def fetch_ttl(args, config):
+    """Returns the fetch TTL given on the command line or in the
+    configuration.
+    """
+    if args.fetch_ttl is not None:
+        return args.fetch_ttl
+    return config['fetch-ttl']
+
+def policy_options(config):
+    """Returns the git options of the configured fetch policy that come
+    before the ``fetch`` subcommand.
+    """
+    if config['fetch-policy'] == 'narrow':
+        return ('-c', 'protocol.version=2')
+    return ()
+
+def refspecs(config, namespace):
+    """Returns an ``(options, refspecs)`` tuple for fetching the upstream
+    branches into ``namespace`` according to the configured fetch policy.
+
+    The full policy fetches all the branches and tags. The narrow policy
+    fetches only the configured branches, prunes deleted ones and fetches
+    tags only if ``fetch-tags`` is enabled.
+    """
+    if config['fetch-policy'] != 'narrow':
+        return (), ('+refs/heads/*:%s/*' % namespace,)
+    options = ('--prune',)
+    if not config['fetch-tags']:
+        options += ('--no-tags',)
+    return options, tuple('+refs/heads/%s:%s/%s' % (local, namespace, local)
+                          for remote, local in config['branches'])
+
+def retry_missing(repository, config, command, result):
+    """Retries a narrow fetch ``command`` that failed because the upstream
+    lacks some of the configured branches, which git refuses to fetch by
+    exact refspecs. The branches are listed with ``git ls-remote``, the ones
+    the upstream has are fetched again and the refs of the others are
+    deleted like ``--prune`` would. Returns the Result of the retry, or
+    ``result`` if the fetch succeeded or failed for another reason.
+    """
+    if result.ok or "couldn't find remote ref refs/heads/" not in result.stderr:
+        return result
+    listed = repository.git(*(policy_options(config) + ('ls-remote', config['upstream'])
+                              + tuple('refs/heads/%s' % local for remote, local in config['branches'])))
+    if not listed.ok:
+        return result
+    present = set(line.split()[1] for line in listed.stdout.splitlines() if len(line.split()) == 2)
+    missing = [part for part in command
+               if part.startswith('+refs/heads/') and part[1:].split(':', 1)[0] not in present]
+    for spec in missing:
+        repository.git('update-ref', '-d', spec.split(':', 1)[1])
+    if len(missing) == len([part for part in command if part.startswith('+refs/heads/')]):
+        # Nothing left to fetch
+        return gitctl.backend.Result(0, '', '')
+    return repository.git(*[part for part in command if part not in missing])
+
+def prefetch_command(config):
+    """Returns the git arguments that prefetch the upstream branches."""
+    upstream = config['upstream']
+    options, specs = refspecs(config, 'refs/prefetch/%s' % upstream)
+    options = tuple(option for option in options if option != '--no-tags')
+    # The empty --refmap prevents git from updating the remote-tracking
+    # branches opportunistically.
+    return (policy_options(config) + ('fetch', '--no-tags', '--refmap=')
+            + options + (upstream,) + specs)
+
+def fetch_command(repository, config, ttl):
+    """Returns a ``(kind, args)`` tuple with the git arguments that bring the
+    remote-tracking branches of the upstream up to date, or None if they are
+    fresh already. ``kind`` is ``'fetched'`` for a fetch from the upstream.
+
+    Prefetched refs younger than ``ttl`` are used instead of the network, the
+    kind is then ``'prefetched'``.
+    """
+    upstream = config['upstream']
+    if is_fresh(repository, upstream, ttl):
+        return None
+    if is_fresh(repository, upstream, ttl, kind='prefetched'):
+        return 'prefetched', ('fetch', '--no-tags', '.',
+                              '+refs/prefetch/%s/*:refs/remotes/%s/*' % (upstream, upstream))
+    if config['fetch-policy'] == 'narrow':
+        options, specs = refspecs(config, 'refs/remotes/%s' % upstream)
+        return 'fetched', policy_options(config) + ('fetch',) + options + (upstream,) + specs
+    return 'fetched', ('fetch', upstream)
+
+def record(repository, upstream, kind, manifest=None):
+    """Records the successful execution of a ``fetch_command`` of the given
+    ``kind``.
+    """
+    if kind == 'prefetched':
+        # The data is as old as the prefetch it came from.
+        mark_fetched(repository, upstream,
+                     when=last_fetched(repository, upstream, kind='prefetched'))
+    else:
+        mark_fetched(repository, upstream)
+        if manifest is not None:
+            manifest.mark_synced(repository, upstream)
+
+def fetch(repository, config, ttl=None, manifest=None, name=None):
+    """Fetches the upstream unless it was fetched less than ``ttl`` seconds
+    ago or the ``manifest`` has no changes for the upstream repository
+    ``name``. Returns the ``gitctl.backend.Result`` of the fetch or None if it
+    was skipped.
+    """
+    if manifest is not None and manifest.unchanged(repository, config['upstream'], name):
+        return None
+    planned = fetch_command(repository, config, ttl)
+    if planned is None:
+        return None
+    kind, command = planned
+    result = retry_missing(repository, config, command, repository.git(*command))
+    if result.ok:
+        record(repository, config['upstream'], kind, manifest)
+    return result
+
+def manifest_hook(project, manifest, email=True):
+    """Returns a post-receive hook script that appends the ref updates of the
+    upstream repository ``project`` to the ``manifest`` file on the server.
+    """
+    script = MANIFEST_HOOK_TMPL % {'project' : project, 'manifest' : manifest}
+    if email:
+        script += MANIFEST_HOOK_EMAIL
+    return script
+
+def manifest_location(location):
+    """Splits a manifest location into a (host, path) tuple. The host is None
+    for local paths.
+    """
+    if os.path.isabs(location) or ':' not in location:
+        return None, location
+    return tuple(location.split(':', 1))
+
+def upstream_name(url):
+    """Returns the name the manifest uses for the upstream repository at
+    ``url``.
+    """
+    name = re.split(r'[:/]', url.rstrip('/'))[-1]
+    if name.endswith('.git'):
+        name = name[:-len('.git')]
+    return name
+
+class Manifest(object):
+    """The upstream change manifest.
+
+    Each line records a ref update as ``<time> <project> <ref> <old> <new>``.
+    The manifest is append-only so the byte offset at which it was read is
+    recorded in each repository after a fetch. A project has changed if it
+    has entries beyond that offset.
+    """
+
+    def __init__(self, data):
+        self.size = len(data)
+        # Maps a project name to the offset after its latest entry
+        self.changes = {}
+        offset = 0
+        for line in data.splitlines(True):
+            offset += len(line)
+            parts = line.split()
+            if len(parts) == 5:
+                self.changes[parts[1]] = offset
+
+    def synced(self, repository, upstream):
+        """Returns the manifest offset at which the repository was last
+        fetched, or None.
+        """
+        try:
+            return int(open(stamp_path(repository, upstream, 'manifest')).read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def unchanged(self, repository, upstream, name):
+        """Returns True if there are no changes for the upstream repository
+        ``name`` since the repository was last fetched.
+        """
+        synced = self.synced(repository, upstream)
+        if synced is None or synced > self.size:
+            # Never synced or the manifest has been truncated
+            return False
+        return self.changes.get(name, 0) <= synced
+
+    def mark_synced(self, repository, upstream):
+        """Records that the repository is up to date with the manifest."""
+        path = stamp_path(repository, upstream, 'manifest')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('%s\n' % self.size)
+
+def load_manifest(config):
+    """Reads the change manifest configured in ``config``. Returns a Manifest
+    or None if the manifest is not configured or cannot be read.
+    """
+    if not config.get('manifest'):
+        return None
+    host, path = manifest_location(config['manifest'])
+    if host is None:
+        try:
+            return Manifest(open(path).read())
+        except IOError, x:
+            LOG.warning('Could not read the change manifest %s: %s', path, x)
+            return None
+    process = subprocess.Popen(['ssh', host, 'cat %s' % path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        LOG.warning('Could not read the change manifest %s: %s', config['manifest'], stderr.strip())
+        return None
+    return Manifest(stdout)
+
+def probe(repositories, upstream, branches, limit=None):
+    """Compares the upstream ``branches`` (a list of branch names) with the
+    remote-tracking branches of each repository using ``git ls-remote``.
+
+    Returns the set of repositories whose upstream branches have moved. A
+    repository whose probe fails is considered changed. All the probes are
+    run concurrently with at most ``limit`` processes at a time.
+    """
+    repositories = list(repositories)
+    heads = tuple('refs/heads/%s' % branch for branch in branches)
+    prefix = 'refs/remotes/%s/' % upstream
+    calls = []
+    for repository in repositories:
+        calls.append((repository.path, ('ls-remote', upstream) + heads))
+        calls.append((repository.path, ('for-each-ref', '--format=%(objectname) %(refname)', prefix)))
+    results = gitctl.backend.run_many(calls, limit)
+
+    def tips(output, prefix):
+        refs = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].startswith(prefix):
+                refs[parts[1][len(prefix):]] = parts[0]
+        return refs
+
+    changed = set()
+    for index, repository in enumerate(repositories):
+        remote, local = results[2 * index], results[2 * index + 1]
+        if not remote.ok or not local.ok:
+            changed.add(repository)
+            continue
+        remote_tips = tips(remote.stdout, 'refs/heads/')
+        local_tips = tips(local.stdout, prefix)
+        for branch in branches:
+            if remote_tips.get(branch) != local_tips.get(branch):
+                changed.add(repository)
+                break
+    return changed
+
+__all__ = ['Manifest', 'fetch', 'fetch_command', 'fetch_ttl', 'is_fresh', 'last_fetched',
+           'load_manifest', 'manifest_hook', 'manifest_location', 'mark_fetched',
+           'policy_options', 'prefetch_command', 'probe', 'record', 'refspecs', 'retry_missing',
+           'stamp_path', 'upstream_name']
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Reading the repository configuration without spawning git.
+
+The repository ``config`` file (and ``config.worktree`` when enabled) is
+parsed into ``(key, value)`` pairs in the same form ``git config --list``
+prints them. ``include.path`` and the ``gitdir:``, ``gitdir/i:`` and
+``onbranch:`` conditions of ``includeIf`` are followed. The parsed
+configuration is cached until one of the files it was read from changes.
+
+The global and system configuration files are not read. ``read_config``
+returns None for files using syntax or include conditions it does not
+handle, and the callers fall back to git.
+"""
+import os
+import re
+import time
+import threading
+
+import gitctl.refs
+
+# The limit git uses to catch include loops
+MAX_INCLUDE_DEPTH = 10
+
+RE_SECTION = re.compile(r'\[([-.A-Za-z0-9]+)(?:[ \t]+"((?:[^"\\\n]|\\.)*)")?\]')
+RE_NAME = re.compile(r'[A-Za-z][-A-Za-z0-9]*')
+
+ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '\\': '\\', '"': '"'}
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+class ConfigError(Exception):
+    """Raised for configuration the parser does not handle."""
+
+def parse_value(data, pos):
+    """Parses the value starting at ``pos`` like git does. Returns the value
+    and the position after the end of the line.
+    """
+    value = []
+    quoted = comment = False
+    spaces = 0
+    while pos < len(data):
+        c = data[pos]
+        pos += 1
+        if c == '\n':
+            if quoted:
+                raise ConfigError('Unterminated quoted value')
+            break
+        if comment:
+            continue
+        if c in ' \t\r' and not quoted:
+            # Leading and trailing whitespace is dropped, internal
+            # whitespace is kept.
+            if value:
+                spaces += 1
+            continue
+        if c in '#;' and not quoted:
+            comment = True
+            continue
+        if spaces:
+            value.append(' ' * spaces)
+            spaces = 0
+        if c == '\\':
+            if pos >= len(data):
+                raise ConfigError('Incomplete escape sequence')
+            c = data[pos]
+            pos += 1
+            if c == '\n':
+                # Line continuation
+                continue
+            if c not in ESCAPES:
+                raise ConfigError('Invalid escape sequence: \\%s' % c)
+            value.append(ESCAPES[c])
+        elif c == '"':
+            quoted = not quoted
+        else:
+            value.append(c)
+    if quoted:
+        raise ConfigError('Unterminated quoted value')
+    return ''.join(value), pos
+
+def parse_section(data, pos):
+    """Parses the section header starting at ``pos``. Returns the section
+    prefix of the keys and the position after the header.
+    """
+    match = RE_SECTION.match(data, pos)
+    if match is None:
+        raise ConfigError('Invalid section header at offset %s' % pos)
+    name, subsection = match.groups()
+    if subsection is not None:
+        # Subsection names are case sensitive
+        return '%s.%s' % (name.lower(), re.sub(r'\\(.)', r'\1', subsection)), match.end()
+    # The deprecated [section.subsection] syntax is case insensitive
+    return name.lower(), match.end()
+
+def parse(data):
+    """Parses the contents of a git configuration file into a list of
+    ``(key, value)`` pairs. The value of a key without ``=`` is None.
+    """
+    items = []
+    section = None
+    pos = 0
+    while pos < len(data):
+        c = data[pos]
+        if c in ' \t\r\n':
+            pos += 1
+        elif c in '#;':
+            end = data.find('\n', pos)
+            pos = end == -1 and len(data) or end + 1
+        elif c == '[':
+            section, pos = parse_section(data, pos)
+        else:
+            match = RE_NAME.match(data, pos)
+            if match is None or section is None:
+                raise ConfigError('Invalid variable at offset %s' % pos)
+            key = '%s.%s' % (section, match.group(0).lower())
+            pos = match.end()
+            while pos < len(data) and data[pos] in ' \t':
+                pos += 1
+            if pos < len(data) and data[pos] == '=':
+                value, pos = parse_value(data, pos + 1)
+            elif pos >= len(data) or data[pos] in '\r\n#;':
+                value = None
+            else:
+                raise ConfigError('Invalid variable at offset %s' % pos)
+            items.append((key, value))
+    return items
+
+def wildmatch(pattern, ignore_case=False):
+    """Compiles a git wildmatch pattern where ``*`` does not match slashes
+    and ``**`` matches across directories.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i) and i + 2 == len(pattern) and i > 0 and pattern[i - 1] == '/':
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += pattern.startswith('**', i) and 2 or 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile('^%s$' % ''.join(regex), ignore_case and re.I or 0)
+
+def include_matches(condition, path, git_dir, files):
+    """Returns True if the ``includeIf`` condition holds for the repository.
+    Raises ConfigError for conditions that are not supported.
+    """
+    if condition.startswith('gitdir:') or condition.startswith('gitdir/i:'):
+        pattern = condition.split(':', 1)[1]
+        if pattern.startswith('~/'):
+            pattern = os.path.expanduser(pattern)
+        elif pattern.startswith('./'):
+            pattern = os.path.join(os.path.dirname(path), pattern[2:])
+        elif not os.path.isabs(pattern):
+            pattern = '**/' + pattern
+        if pattern.endswith('/'):
+            pattern += '**'
+        regex = wildmatch(pattern, condition.startswith('gitdir/i:'))
+        return any(regex.match(candidate) is not None
+                   for candidate in (os.path.abspath(git_dir), os.path.realpath(git_dir)))
+    if condition.startswith('onbranch:'):
+        pattern = condition[len('onbranch:'):]
+        if pattern.endswith('/'):
+            pattern += '**'
+        head_path = os.path.join(git_dir, 'HEAD')
+        files.append((head_path, mtime(head_path)))
+        head = gitctl.refs.read_head(git_dir)
+        if head is None or not head.startswith('ref: refs/heads/'):
+            return False
+        return wildmatch(pattern).match(head[len('ref: refs/heads/'):]) is not None
+    raise ConfigError('Unsupported include condition: %s' % condition)
+
+def mtime(path):
+    """Returns the modification time of ``path`` or None if it is missing."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def read_file(path, git_dir, files, depth=0):
+    """Parses the configuration file ``path`` and the files it includes.
+    The paths and modification times of the files read are appended to
+    ``files``. A missing file is treated as empty, like git does.
+    """
+    files.append((path, mtime(path)))
+    try:
+        data = open(path).read()
+    except IOError:
+        return []
+    items = []
+    for key, value in parse(data):
+        items.append((key, value))
+        if key == 'include.path':
+            pass
+        elif key.startswith('includeif.') and key.endswith('.path'):
+            if value is not None and not include_matches(key[len('includeif.'):-len('.path')], path, git_dir, files):
+                continue
+        else:
+            continue
+        if value is None:
+            raise ConfigError('Missing include path in %s' % path)
+        if depth >= MAX_INCLUDE_DEPTH:
+            raise ConfigError('Include depth exceeded in %s' % path)
+        included = os.path.expanduser(value)
+        if not os.path.isabs(included):
+            included = os.path.join(os.path.dirname(path), included)
+        items.extend(read_file(included, git_dir, files, depth + 1))
+    return items
+
+def is_true(value):
+    """Returns True if the configuration value is a true boolean."""
+    return value is None or value.lower() in ('true', 'yes', 'on', '1')
+
+def read_config(git_dir, common_dir):
+    """Returns the repository configuration as a list of ``(key, value)``
+    pairs in the order git reads them, or None if the configuration cannot
+    be parsed. The list is shared and must not be modified.
+    """
+    cache_key = (git_dir, common_dir)
+    _cache_lock.acquire()
+    try:
+        cached = _cache.get(cache_key)
+    finally:
+        _cache_lock.release()
+    if cached is not None and all(mtime(path) == modified for path, modified in cached[0]):
+        return cached[1]
+
+    started = time.time()
+    files = []
+    try:
+        items = read_file(os.path.join(common_dir, 'config'), git_dir, files)
+        worktree_config = [value for key, value in items if key == 'extensions.worktreeconfig']
+        if worktree_config and is_true(worktree_config[-1]):
+            items.extend(read_file(os.path.join(git_dir, 'config.worktree'), git_dir, files))
+    except ConfigError:
+        return None
+
+    # Not trusted if a change within the same timestamp tick is possible
+    modified = [value for path, value in files if value is not None]
+    if not modified or started > max(modified) + gitctl.refs.RACY_WINDOW:
+        _cache_lock.acquire()
+        try:
+            _cache[cache_key] = (files, items)
+        finally:
+            _cache_lock.release()
+    return items
+
+def clear_cache():
+    """Forgets all the cached configurations."""
+    _cache_lock.acquire()
+    try:
+        _cache.clear()
+    finally:
+        _cache_lock.release()
+
+__all__ = ['ConfigError', 'MAX_INCLUDE_DEPTH', 'clear_cache', 'include_matches', 'is_true', 'parse',
+           'parse_section', 'parse_value', 'read_config', 'read_file', 'wildmatch']
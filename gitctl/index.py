@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Checking the working directory against the git index without spawning git.
+
+The index records the stat data of every tracked file as of the time it was
+last known to match the index. Comparing that against ``os.lstat`` of the
+files tells which files may have changed. Only those need to be compared by
+content, so for a clean working directory the check is a stat sweep.
+
+Whether the index itself matches HEAD cannot be told from the stat data. A
+stamp records the HEAD commit and the identity of the index file the last
+time git found them to match, and git is only asked again when either
+changes.
+"""
+import os
+import mmap
+import stat
+import struct
+
+import gitctl.refs
+import gitctl.gitconfig
+
+STAMP = 'index-clean'
+
+# The entry flags
+FLAG_ASSUME_VALID = 0x8000
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE = 0x3000
+FLAG_NAME_LENGTH = 0x0fff
+# The extended flags of version 3 and later
+FLAG_SKIP_WORKTREE = 0x4000
+FLAG_INTENT_TO_ADD = 0x2000
+
+MODE_SYMLINK = 0120000
+MODE_GITLINK = 0160000
+
+# The stat fields that precede the object name of an entry: ctime, ctime
+# nanoseconds, mtime, mtime nanoseconds, dev, ino, mode, uid, gid and size
+ENTRY_STAT = struct.Struct('>10I')
+
+class IndexFormatError(Exception):
+    """Raised for index files the reader does not handle."""
+
+def decode_varint(data, pos):
+    """Decodes the offset encoded integer used by index version 4. Returns
+    the integer and the position after it.
+    """
+    c = ord(data[pos])
+    pos += 1
+    value = c & 127
+    while c & 128:
+        c = ord(data[pos])
+        pos += 1
+        value = ((value + 1) << 7) + (c & 127)
+    return value, pos
+
+def read_entries(path, hash_size=20):
+    """Returns the entries of the index file ``path`` as a list of ``(name,
+    stat, flags, extended_flags)`` tuples where ``stat`` is the tuple of the
+    ``ENTRY_STAT`` fields. Raises IndexFormatError for unsupported files.
+    """
+    handle = open(path, 'rb')
+    try:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            raise IndexFormatError('Cannot map %s' % path)
+    finally:
+        handle.close()
+    try:
+        if data.size() < 12 + hash_size or data[:4] != 'DIRC':
+            raise IndexFormatError('Not an index file: %s' % path)
+        version, count = struct.unpack('>II', data[4:12])
+        if version not in (2, 3, 4):
+            raise IndexFormatError('Unsupported index version %s' % version)
+
+        entries = []
+        pos = 12
+        name = ''
+        fixed = ENTRY_STAT.size + hash_size + 2
+        for i in xrange(count):
+            start = pos
+            fields = ENTRY_STAT.unpack_from(data, pos)
+            flags = struct.unpack_from('>H', data, pos + fixed - 2)[0]
+            pos += fixed
+            extended_flags = 0
+            if flags & FLAG_EXTENDED:
+                if version < 3:
+                    raise IndexFormatError('Extended flags in a version 2 index')
+                extended_flags = struct.unpack_from('>H', data, pos)[0]
+                pos += 2
+            if version == 4:
+                # The name is prefix compressed against the previous one
+                strip, pos = decode_varint(data, pos)
+                end = data.find('\0', pos)
+                name = name[:len(name) - strip] + data[pos:end]
+                pos = end + 1
+            else:
+                length = flags & FLAG_NAME_LENGTH
+                if length == FLAG_NAME_LENGTH:
+                    length = data.find('\0', pos) - pos
+                name = data[pos:pos + length]
+                # The entries are NUL padded to a multiple of eight bytes
+                pos = start + ((pos - start + length + 8) & ~7)
+            entries.append((name, fields, flags, extended_flags))
+
+        while pos + 8 <= data.size() - hash_size:
+            signature = data[pos:pos + 4]
+            size = struct.unpack_from('>I', data, pos + 4)[0]
+            if signature == 'link':
+                # The entries of a split index are partly in the shared index
+                raise IndexFormatError('Split index is not supported')
+            pos += 8 + size
+        return entries
+    finally:
+        data.close()
+
+def config_value(repository, key, default=None):
+    """Returns the value of the configuration variable ``key``."""
+    for name, value in reversed(repository.config()):
+        if name == key:
+            return value
+    return default
+
+def stat_changes(repository):
+    """Returns the paths of the tracked files whose stat data differs from
+    the index or is too recent to be trusted, i.e. the files that need to be
+    compared by content. Returns None if the index cannot be checked this
+    way, for example during a merge with conflicts.
+    """
+    index = os.path.join(repository.git_dir, 'index')
+    try:
+        index_mtime = os.stat(index)[stat.ST_MTIME]
+        object_format = config_value(repository, 'extensions.objectformat', 'sha1')
+        entries = read_entries(index, object_format == 'sha256' and 32 or 20)
+    except (OSError, IOError, IndexFormatError, struct.error):
+        return None
+
+    trust_ctime = gitctl.gitconfig.is_true(config_value(repository, 'core.trustctime', 'true'))
+    file_mode = gitctl.gitconfig.is_true(config_value(repository, 'core.filemode', 'true'))
+    minimal = config_value(repository, 'core.checkstat') == 'minimal'
+    changed = []
+    for name, fields, flags, extended_flags in entries:
+        if flags & FLAG_STAGE or extended_flags & FLAG_INTENT_TO_ADD:
+            return None
+        if flags & FLAG_ASSUME_VALID or extended_flags & FLAG_SKIP_WORKTREE:
+            # Git does not look at these files either
+            continue
+        ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size = fields
+        if mode == MODE_GITLINK or mtime >= index_mtime:
+            # Submodules and racily clean entries
+            changed.append(name)
+            continue
+        try:
+            st = os.lstat(os.path.join(repository.path, name))
+        except OSError:
+            changed.append(name)
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            same_mode = mode == MODE_SYMLINK
+        else:
+            same_mode = stat.S_ISREG(st.st_mode) and mode != MODE_SYMLINK and \
+                (not file_mode or bool(st.st_mode & 0100) == bool(mode & 0100))
+        if not same_mode \
+                or st[stat.ST_MTIME] & 0xffffffff != mtime \
+                or st.st_size & 0xffffffff != size \
+                or (trust_ctime and not minimal and st[stat.ST_CTIME] & 0xffffffff != ctime) \
+                or (not minimal and (st.st_ino & 0xffffffff != ino
+                                     or st.st_uid & 0xffffffff != uid
+                                     or st.st_gid & 0xffffffff != gid)):
+            changed.append(name)
+    return changed
+
+def stamp_path(repository):
+    """Returns the path of the file recording the last index known to match
+    HEAD. The index is per worktree, so is the stamp.
+    """
+    return os.path.join(repository.git_dir, 'gitctl', STAMP)
+
+def index_state(repository):
+    """Returns a string identifying the HEAD commit and the index file, or
+    None if either cannot be read directly.
+    """
+    refs = gitctl.refs.read_refs(repository.common_dir)
+    if refs is None:
+        return None
+    head = gitctl.refs.lookup(refs, gitctl.refs.read_head(repository.git_dir), 'HEAD')
+    try:
+        # The index is always replaced by renaming a new file into place
+        st = os.stat(os.path.join(repository.git_dir, 'index'))
+    except OSError:
+        return None
+    if head is None:
+        return None
+    return '%s %s %r %s' % (head, st.st_ino, st.st_mtime, st.st_size)
+
+def is_known_clean(repository, state):
+    """Returns True if git found the index matching HEAD in ``state``."""
+    try:
+        return state is not None and open(stamp_path(repository)).read().strip() == state
+    except IOError:
+        return False
+
+def mark_clean(repository, state, started):
+    """Records that the index matched HEAD in ``state`` as of ``started``.
+    An index modified within ``gitctl.refs.RACY_WINDOW`` seconds is not
+    recorded as a later change could keep the same modification time.
+    """
+    if state is None or float(state.split()[2]) + gitctl.refs.RACY_WINDOW >= started:
+        return
+    path = stamp_path(repository)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').write('%s\n' % state)
+
+__all__ = ['IndexFormatError', 'config_value', 'decode_varint', 'index_state', 'is_known_clean',
+           'mark_clean', 'read_entries', 'stamp_path', 'stat_changes']
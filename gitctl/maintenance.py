@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Repository maintenance tasks.
+
+The tasks speed up the git operations gitctl runs most: the commit-graph
+and the multi-pack-index speed up the ahead/behind walks made by ``gitctl
+status`` and ``gitctl pending``, and the untracked cache and the file system
+monitor speed up the working directory scans.
+"""
+import time
+
+import gitctl.backend
+import gitctl.utils
+import gitctl.wtf
+
+# The tasks in the order they are run. Repacking comes first so that the
+# indexes cover the new pack.
+TASKS = ('incremental-repack', 'multi-pack-index', 'commit-graph', 'untracked-cache', 'fsmonitor')
+
+DEFAULT_TASKS = gitctl.utils.DEFAULT_TASKS
+
+def supports_fsmonitor():
+    """Returns True if git has the builtin file system monitor."""
+    result = gitctl.backend.git('.', 'version', '--build-options')
+    return result.ok and 'fsmonitor--daemon' in result.stdout
+
+def run_task(repository, task):
+    """Runs a single maintenance task in the repository."""
+    if task == 'incremental-repack':
+        # Packs the loose objects into a new pack without rewriting the
+        # existing packs.
+        repository.call('repack', '-d', '-q')
+    elif task == 'multi-pack-index':
+        repository.call('multi-pack-index', 'write')
+    elif task == 'commit-graph':
+        repository.call('commit-graph', 'write', '--reachable')
+    elif task == 'untracked-cache':
+        repository.call('config', 'core.untrackedCache', 'true')
+        repository.call('update-index', '--untracked-cache')
+    elif task == 'fsmonitor':
+        repository.call('config', 'core.fsmonitor', 'true')
+    else:
+        raise ValueError('Unknown maintenance task: %s' % task)
+
+def parse_tasks(tasks):
+    """Validates the task names and returns them in the order they need to
+    be run.
+    """
+    unknown = set(tasks) - set(TASKS)
+    if unknown:
+        raise ValueError('Unknown maintenance task(s): %s. Supported tasks are: %s.'
+                         % (', '.join(sorted(unknown)), ', '.join(TASKS)))
+    return [task for task in TASKS if task in tasks]
+
+def status_probe(repository, config):
+    """Inspects the repository like ``gitctl status`` does and returns the
+    elapsed wall clock time in seconds. The inspection is run once untimed
+    first so that the page cache is as warm before the maintenance as it is
+    after it.
+    """
+    def inspect():
+        state = repository.state()
+        branches = gitctl.wtf.branch_structure(repository, state.refs)
+        for branch_name in config['development-branch'], config['staging-branch'], config['production-branch']:
+            branch = branches.get(branch_name, {})
+            if 'local_branch' in branch and 'remote_branch' in branch:
+                try:
+                    gitctl.wtf.show_branch(repository, branch, branches)
+                except gitctl.backend.GitError:
+                    # The history is incomplete
+                    pass
+
+    inspect()
+    started = time.time()
+    inspect()
+    return time.time() - started
+
+__all__ = ['DEFAULT_TASKS', 'TASKS', 'parse_tasks', 'run_task', 'status_probe', 'supports_fsmonitor']
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Shared bare mirrors of the upstream repositories.
+
+The mirrors live in the directory given by the ``mirror-cache`` option, one
+``<sha1 of the url>.git`` mirror per upstream URL. New clones use the mirror
+with ``--reference`` so that only the objects missing from the mirror are
+downloaded, and ``gitctl dedupe`` makes existing checkouts borrow their
+objects from the mirrors through ``objects/info/alternates``.
+
+Repositories borrowing from a mirror break if objects are removed from it,
+so the mirrors are never pruned and automatic garbage collection is disabled
+in them.
+"""
+import os
+import shutil
+import logging
+import threading
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+import gitctl.backend
+
+LOG = logging.getLogger('gitctl')
+
+def mirror_path(cache, url):
+    """Returns the path of the mirror of ``url`` in the ``cache`` directory."""
+    return os.path.join(os.path.expanduser(cache), '%s.git' % sha1(url).hexdigest())
+
+def alternates_path(repository):
+    """Returns the path of the alternates file of the repository."""
+    return os.path.join(repository.common_dir, 'objects', 'info', 'alternates')
+
+def alternates(repository):
+    """Returns the list of object directories the repository borrows from."""
+    try:
+        return [line.strip() for line in open(alternates_path(repository)) if line.strip()]
+    except IOError:
+        return []
+
+def borrow(repository, mirror):
+    """Makes the repository borrow objects from the ``mirror`` repository and
+    removes the local copies of the borrowed objects. Returns False if the
+    repository was borrowing from the mirror already.
+    """
+    objects = os.path.join(mirror, 'objects')
+    if objects in alternates(repository):
+        return False
+    # Pack everything first. Repacking with -l leaves the loose objects that
+    # are available in the alternates alone.
+    repository.call('repack', '-a', '-d', '-q')
+    info = open(alternates_path(repository), 'a')
+    try:
+        info.write('%s\n' % objects)
+    finally:
+        info.close()
+    repository.call('repack', '-a', '-d', '-l', '-q')
+    return True
+
+def disk_usage(path):
+    """Returns the total size of the files under ``path`` in bytes."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+class MirrorCache(object):
+    """The mirror cache directory.
+
+    Each mirror is refreshed at most once per MirrorCache instance, which
+    is meant to live for a single gitctl run. The instance can be shared by
+    concurrent workers.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        # Maps an upstream URL to a lock guarding the refresh of its mirror
+        self.locks = {}
+        # Maps an upstream URL to the path of its refreshed mirror or None
+        self.mirrors = {}
+
+    def get(self, url):
+        """Returns the path of the mirror of ``url`` after refreshing it, or
+        None if the mirror is not available.
+        """
+        self.lock.acquire()
+        try:
+            lock = self.locks.setdefault(url, threading.Lock())
+        finally:
+            self.lock.release()
+        lock.acquire()
+        try:
+            if url not in self.mirrors:
+                self.mirrors[url] = self.refresh(url)
+            return self.mirrors[url]
+        finally:
+            lock.release()
+
+    def refresh(self, url):
+        """Creates or updates the mirror of ``url``. Returns the path of the
+        mirror or None if it could not be created.
+        """
+        path = mirror_path(self.path, url)
+        if os.path.isdir(path):
+            # Deleted upstream refs are kept so that no borrowed objects
+            # become unreachable.
+            result = gitctl.backend.git(path, 'fetch', '--quiet', 'origin')
+            if not result.ok:
+                # A stale mirror is still useful as a reference.
+                LOG.warning('Could not refresh the mirror of %s: %s', url, result.stderr.strip())
+            return path
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Clone into a temporary location so that an interrupted clone does
+        # not leave a broken mirror behind.
+        temp = '%s.tmp-%s' % (path, os.getpid())
+        try:
+            result = gitctl.backend.git(self.path, 'clone', '--quiet', '--mirror', url, temp)
+            if result.ok:
+                result = gitctl.backend.git(temp, 'config', 'gc.auto', '0')
+            if not result.ok:
+                LOG.warning('Could not create a mirror of %s: %s', url, result.stderr.strip())
+                return None
+            os.rename(temp, path)
+            return path
+        finally:
+            # Gone after a successful rename
+            shutil.rmtree(temp, ignore_errors=True)
+
+__all__ = ['MirrorCache', 'alternates', 'alternates_path', 'borrow', 'disk_usage', 'mirror_path']
@@ -4,6 +4,8 @@
 import os
 import argparse
 import gitctl.command
+import gitctl.executor
+import gitctl.maintenance
 import pkg_resources
 
 entrypoint = pkg_resources.iter_entry_points('console_scripts', 'gitctl').next()
@@ -22,8 +24,17 @@ parser.add_argument('--externals',
     help='Location of the externals configuration file. Defaults to '
          '$PWD/gitexternals.cfg')
 parser.add_argument('--verbose', action='store_true', help='Prints more verbose output about repositories.')
+parser.add_argument('--jobs', '-j', type=int, metavar='N',
+    help='Number of projects to process concurrently. Defaults to the number '
+         'of CPUs.')
+parser.add_argument('--fetch-ttl', type=int, metavar='SECONDS',
+    help='Do not fetch projects that have been fetched from upstream less '
+         'than SECONDS ago. Use 0 to always fetch. Overrides the ``fetch-ttl`` '
+         'option in the configuration file.')
 parser.set_defaults(
     verbose=False,
+    fetch_ttl=None,
+    jobs=gitctl.executor.default_jobs(),
     externals='gitexternals.cfg',
     config=[os.path.expanduser('~/.gitctl.cfg'),
             os.path.abspath('gitctl.cfg')])
@@ -53,8 +64,17 @@ parser_update.add_argument('project', nargs='*',
 parser_update.add_argument('--from-file', '-f', 
     type=argparse.FileType('r'), default=None,
     help='the file with a list of projects')
+parser_update.add_argument('--probe', action='store_true',
+    help='List the configured branches of the upstream repositories first and '
+         'only fetch the projects whose branches have moved.')
+parser_update.add_argument('--from-bundles', metavar='DIRECTORY',
+    help='Clone and update the projects from the git bundles created with '
+         '"gitctl bundle create" in DIRECTORY instead of the upstream '
+         'repositories.')
 parser_update.set_defaults(
     func=gitctl.command.gitctl_update,
+    probe=False,
+    from_bundles=None,
     )
 
 # 'gitctl path'
@@ -82,8 +102,20 @@ parser_sh.add_argument('--from-file', '-f',
 parser_sh.add_argument('--command', '-c',
     type=str, default="echo 'no command specified'",
     help='the file with a list of projects')
+parser_sh.add_argument('--jobs', '-j', type=int, metavar='N',
+    default=argparse.SUPPRESS,
+    help='Number of projects to run the command in concurrently. Overrides '
+         'the global --jobs option.')
+parser_sh.add_argument('--timeout', type=float, metavar='SECONDS',
+    help='Kills the command if it does not finish in the given time.')
+parser_sh.add_argument('--stream', action='store_true',
+    help='Prints the output of the commands as it is produced, prefixed '
+         'with the project name. By default the output of each project is '
+         'printed as a contiguous block.')
 parser_sh.set_defaults(
     func=gitctl.command.gitctl_sh,
+    timeout=None,
+    stream=False,
     )
 
 # 'gitctl status'
@@ -101,10 +133,16 @@ parser_status.add_argument('--from-file', '-f',
     help='the file with a list of projects')
 parser_status.add_argument('--commits', action='store_true', help='Displays a summary of the commits that differ a branch from another')
 parser_status.add_argument('--limit', type=int, help='Limits the number of commits shown in the summary. Ignored with --commits.')
+parser_status.add_argument('--feature-days', type=int, metavar='DAYS',
+    help='Only inspects the feature branches with commits within the last DAYS days.')
+parser_status.add_argument('--feature-limit', type=int, metavar='N',
+    help='Only inspects the N feature branches with the most recent commits.')
 parser_status.set_defaults(
     func=gitctl.command.gitctl_status,
     commits=False,
     limit=-1,
+    feature_days=None,
+    feature_limit=None,
     no_fetch=False)
 
 # 'gitctl branch'
@@ -153,6 +191,94 @@ parser_fetch.add_argument('project', nargs='*',
 parser_fetch.add_argument('--from-file', '-f', 
     type=argparse.FileType('r'), default=None,
     help='the file with a list of projects')
-parser_fetch.set_defaults(func=gitctl.command.gitctl_fetch)
+parser_fetch.add_argument('--probe', action='store_true',
+    help='List the configured branches of the upstream repositories first and '
+         'only fetch the projects whose branches have moved.')
+parser_fetch.set_defaults(
+    probe=False,
+    func=gitctl.command.gitctl_fetch)
+
+# 'gitctl prefetch'
+parser_prefetch = cmd_parsers.add_parser('prefetch',
+    help='Fetches the upstream branches of all projects into a separate '
+         'namespace without updating the remote branches. Other commands use '
+         'the prefetched data instead of the network while it is fresh.')
+parser_prefetch.add_argument('project', nargs='*',
+    help='Name of a project to prefetch. If omitted all projects in the '
+         'externals configuration will be prefetched.')
+parser_prefetch.add_argument('--from-file', '-f',
+    type=argparse.FileType('r'), default=None,
+    help='the file with a list of projects')
+parser_prefetch.add_argument('--interval', type=int, metavar='SECONDS',
+    help='Keep running and prefetch again every SECONDS. By default the '
+         'projects are prefetched once, e.g. from cron.')
+parser_prefetch.set_defaults(
+    interval=None,
+    func=gitctl.command.gitctl_prefetch)
+
+# 'gitctl dedupe'
+parser_dedupe = cmd_parsers.add_parser('dedupe',
+    help='Makes the existing projects borrow their objects from the shared '
+         'mirrors in the ``mirror-cache`` directory to save disk space.')
+parser_dedupe.add_argument('project', nargs='*',
+    help='Name of a project to deduplicate. If omitted all projects in the '
+         'externals configuration will be deduplicated.')
+parser_dedupe.add_argument('--from-file', '-f',
+    type=argparse.FileType('r'), default=None,
+    help='the file with a list of projects')
+parser_dedupe.set_defaults(
+    func=gitctl.command.gitctl_dedupe)
+
+# 'gitctl bundle'
+parser_bundle = cmd_parsers.add_parser('bundle',
+    help='Exports the projects as git bundles for updating workspaces '
+         'without access to the upstream repositories.')
+parser_bundle.add_argument('action', choices=['create'],
+    help='The bundle operation.')
+parser_bundle.add_argument('directory',
+    help='Directory of the bundles. Bundles of a previous export in the '
+         'directory are updated incrementally.')
+parser_bundle.add_argument('project', nargs='*',
+    help='Name of a project to export. If omitted all projects in the '
+         'externals configuration will be exported.')
+parser_bundle.add_argument('--from-file', '-f',
+    type=argparse.FileType('r'), default=None,
+    help='the file with a list of projects')
+parser_bundle.set_defaults(
+    func=gitctl.command.gitctl_bundle)
+
+# 'gitctl export'
+parser_export = cmd_parsers.add_parser('export',
+    help='Writes the treeish of each project as plain files without the git '
+         'repository, e.g. for deployments.')
+parser_export.add_argument('directory',
+    help='Directory where the projects are written using the same '
+         'container/name layout as in the workspace.')
+parser_export.add_argument('project', nargs='*',
+    help='Name of a project to export. If omitted all projects in the '
+         'externals configuration will be exported.')
+parser_export.add_argument('--from-file', '-f',
+    type=argparse.FileType('r'), default=None,
+    help='the file with a list of projects')
+parser_export.set_defaults(
+    func=gitctl.command.gitctl_export)
+
+# 'gitctl maintenance'
+parser_maintenance = cmd_parsers.add_parser('maintenance',
+    help='Runs maintenance tasks that speed up git in the projects and '
+         'reports the time of a status probe before and after.')
+parser_maintenance.add_argument('project', nargs='*',
+    help='Name of a project to maintain. If omitted all projects in the '
+         'externals configuration will be maintained.')
+parser_maintenance.add_argument('--from-file', '-f',
+    type=argparse.FileType('r'), default=None,
+    help='the file with a list of projects')
+parser_maintenance.add_argument('--task', action='append',
+    choices=gitctl.maintenance.TASKS,
+    help='A task to run. May be given multiple times. Overrides the '
+         '``maintenance-tasks`` option in the configuration file.')
+parser_maintenance.set_defaults(
+    task=None,
+    func=gitctl.command.gitctl_maintenance)
 
 __all__ = ['parser']
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Reading refs without spawning git.
+
+The refs of a repository are read from the loose ref files and the
+``packed-refs`` file. Git always updates refs by renaming a lock file into
+place, which changes the modification time of the containing directory, so
+the parsed refs are cached until the modification time of ``packed-refs`` or
+of one of the ref directories changes. Like the git index, a cache filled
+within ``RACY_WINDOW`` seconds of the latest modification is not trusted as
+a change in the same file system timestamp tick would go unnoticed.
+
+``read_refs`` returns None for repositories it cannot handle, e.g. ones
+using the reftable ref storage, and the callers fall back to git.
+"""
+import os
+import time
+import threading
+
+# The order in which git resolves a short ref name
+SHORT_REF_PREFIXES = ('', 'refs/', 'refs/tags/', 'refs/heads/', 'refs/remotes/')
+
+# Seconds, covers file systems with a one second timestamp resolution
+RACY_WINDOW = 1.0
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def signature(common_dir):
+    """Returns the modification times of the files and directories whose
+    changes invalidate the cached refs.
+    """
+    parts = []
+    path = os.path.join(common_dir, 'packed-refs')
+    try:
+        parts.append((path, os.stat(path).st_mtime))
+    except OSError:
+        pass
+    for dirpath, dirnames, filenames in os.walk(os.path.join(common_dir, 'refs')):
+        parts.append((dirpath, os.stat(dirpath).st_mtime))
+    return tuple(parts)
+
+def parse_packed_refs(data):
+    """Parses the contents of a ``packed-refs`` file into a dictionary
+    mapping ref names to SHA1s.
+    """
+    refs = {}
+    for line in data.splitlines():
+        if not line or line[0] in '#^':
+            # The header and the peeled tag objects
+            continue
+        sha1, name = line.split(' ', 1)
+        refs[name.strip()] = sha1
+    return refs
+
+def read_loose_refs(common_dir):
+    """Returns a dictionary mapping ref names to the contents of the loose
+    ref files, which is either a SHA1 or ``ref: <name>`` for symbolic refs.
+    """
+    refs = {}
+    root = os.path.join(common_dir, 'refs')
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                data = open(path).read().strip()
+            except IOError:
+                # Deleted while walking
+                continue
+            name = 'refs/' + os.path.relpath(path, root).replace(os.sep, '/')
+            refs[name] = data
+    return refs
+
+def resolve(refs, value, depth=5):
+    """Resolves a ref value that may be symbolic. Returns None for dangling
+    symbolic refs.
+    """
+    while value is not None and value.startswith('ref:') and depth > 0:
+        value = refs.get(value[len('ref:'):].strip())
+        depth -= 1
+    if value is None or value.startswith('ref:'):
+        return None
+    return value
+
+def read_refs(common_dir):
+    """Reads all the refs of the repository into a dictionary mapping ref
+    names to SHA1s, using the cache when nothing has changed. Returns None if
+    the ref storage is not supported. The dictionary is shared and must not
+    be modified.
+    """
+    if os.path.exists(os.path.join(common_dir, 'reftable')):
+        return None
+    key = signature(common_dir)
+    _cache_lock.acquire()
+    try:
+        cached = _cache.get(common_dir)
+    finally:
+        _cache_lock.release()
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    started = time.time()
+    try:
+        raw = parse_packed_refs(open(os.path.join(common_dir, 'packed-refs')).read())
+    except IOError:
+        raw = {}
+    # Loose refs take precedence over the packed ones
+    raw.update(read_loose_refs(common_dir))
+    refs = {}
+    for name, value in raw.iteritems():
+        sha1 = resolve(raw, value)
+        if sha1 is not None:
+            refs[name] = sha1
+
+    if not key or started > max(mtime for path, mtime in key) + RACY_WINDOW:
+        _cache_lock.acquire()
+        try:
+            _cache[common_dir] = (key, refs)
+        finally:
+            _cache_lock.release()
+    return refs
+
+def read_head(git_dir):
+    """Returns the contents of HEAD, either a SHA1 or ``ref: <name>``, or
+    None if it cannot be read.
+    """
+    try:
+        return open(os.path.join(git_dir, 'HEAD')).read().strip()
+    except IOError:
+        return None
+
+def lookup(refs, head, rev):
+    """Returns the SHA1 of ``rev`` if it is a full SHA1, HEAD or a ref name
+    that can be resolved using ``refs`` like git would. Returns None for
+    anything else, which needs to be resolved by git.
+    """
+    if len(rev) == 40 and rev.lower().strip('0123456789abcdef') == '':
+        return rev.lower()
+    if rev == 'HEAD':
+        if head is not None and head.startswith('ref:'):
+            return refs.get(head[len('ref:'):].strip())
+        return head
+    for prefix in SHORT_REF_PREFIXES:
+        if prefix + rev in refs:
+            return refs[prefix + rev]
+    if 'refs/remotes/%s/HEAD' % rev in refs:
+        return refs['refs/remotes/%s/HEAD' % rev]
+    return None
+
+def clear_cache():
+    """Forgets all the cached refs."""
+    _cache_lock.acquire()
+    try:
+        _cache.clear()
+    finally:
+        _cache_lock.release()
+
+__all__ = ['RACY_WINDOW', 'SHORT_REF_PREFIXES', 'clear_cache', 'lookup', 'parse_packed_refs', 'read_head',
+           'read_loose_refs', 'read_refs', 'resolve', 'signature']
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Plain file snapshots of the pinned project trees.
+
+A snapshot is the tree of the project treeish written out without the .git
+directory, as needed for deployments. The extracted trees can be kept in an
+artifact cache keyed by the tree SHA1 so that a tree is extracted only once
+and the snapshots are hard linked from the cache.
+"""
+import os
+import shutil
+import tempfile
+import subprocess
+
+import gitctl.backend
+
+STATE_FILE = '.gitctl-snapshots'
+
+def snapshot_path(directory, proj):
+    """Returns the path of the snapshot of the project in ``directory``,
+    which mirrors the ``container/name`` layout of the workspace.
+    """
+    container = os.path.normpath(proj['container']).lstrip(os.sep)
+    parts = [part for part in container.split(os.sep) if part not in ('', '.', '..')]
+    return os.path.join(directory, *(parts + [proj['name']]))
+
+def read_state(directory):
+    """Returns a dictionary mapping project names to the tree SHA1s of their
+    snapshots in ``directory``.
+    """
+    try:
+        return dict(line.split() for line in open(os.path.join(directory, STATE_FILE)) if line.strip())
+    except IOError:
+        return {}
+
+def write_state(directory, state):
+    """Records the tree SHA1s of the snapshots in ``directory``."""
+    data = open(os.path.join(directory, STATE_FILE), 'w')
+    try:
+        for name in sorted(state):
+            data.write('%s %s\n' % (name, state[name]))
+    finally:
+        data.close()
+
+def temporary_directory(path):
+    """Creates and returns a new directory next to ``path``."""
+    parent, name = os.path.split(path.rstrip(os.sep))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    temp = tempfile.mkdtemp(prefix='%s.tmp-' % name, dir=parent)
+    os.chmod(temp, 0755)
+    return temp
+
+def extract(repository, tree, path):
+    """Writes the files of the ``tree`` into the empty directory ``path``."""
+    archive = gitctl.backend.spawn(repository.path, ('archive', '--format=tar', tree))
+    tar = subprocess.Popen(['tar', '-x', '-f', '-', '-C', path], stdin=archive.stdout,
+                           stderr=subprocess.PIPE, close_fds=True)
+    archive.stdout.close()
+    tar_errors = tar.communicate()[1]
+    archive_errors = archive.stderr.read()
+    archive.stderr.close()
+    if archive.wait() != 0:
+        raise gitctl.backend.GitError(gitctl.backend.command(('archive', tree)),
+                                      gitctl.backend.Result(archive.returncode, '', archive_errors))
+    if tar.returncode != 0:
+        raise OSError('tar failed: %s' % tar_errors.strip())
+
+def link_tree(source, target):
+    """Recreates the ``source`` directory in the empty directory ``target``
+    using hard links, falling back to copying when linking is not possible.
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative = os.path.relpath(dirpath, source)
+        destination = os.path.normpath(os.path.join(target, relative))
+        for dirname in list(dirnames):
+            path = os.path.join(dirpath, dirname)
+            if os.path.islink(path):
+                # os.walk does not descend into symlinked directories
+                filenames.append(dirname)
+            else:
+                os.mkdir(os.path.join(destination, dirname))
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(destination, filename))
+                continue
+            try:
+                os.link(path, os.path.join(destination, filename))
+            except OSError:
+                shutil.copy2(path, os.path.join(destination, filename))
+
+def replace(temp, path):
+    """Moves the directory ``temp`` to ``path`` replacing any existing
+    directory.
+    """
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+    os.rename(temp, path)
+
+def snapshot(repository, treeish, path, cache=None):
+    """Writes the tree of ``treeish`` into ``path``.
+
+    If ``cache`` (a directory) is given the tree is extracted into the cache
+    unless it is there already and ``path`` is hard linked from the cache.
+    Returns a ``(tree, cached)`` tuple where ``cached`` tells whether the
+    tree was found in the cache.
+    """
+    tree = repository.rev_parse('%s^{tree}' % treeish)
+    entry = cached = None
+    if cache is not None:
+        entry = os.path.join(os.path.expanduser(cache), tree[:2], tree[2:])
+        cached = os.path.isdir(entry)
+        if not cached:
+            # Extract into a temporary directory first so that concurrent
+            # runs never see a partial tree.
+            extracting = temporary_directory(entry)
+            try:
+                extract(repository, tree, extracting)
+            except:
+                shutil.rmtree(extracting)
+                raise
+            try:
+                os.rename(extracting, entry)
+            except OSError:
+                # Another process extracted the same tree in the meantime.
+                shutil.rmtree(extracting)
+
+    temp = temporary_directory(path)
+    try:
+        if entry is None:
+            extract(repository, tree, temp)
+        else:
+            link_tree(entry, temp)
+    except:
+        shutil.rmtree(temp)
+        raise
+    replace(temp, path)
+    return tree, bool(cached)
+
+__all__ = ['extract', 'link_tree', 'read_state', 'replace', 'snapshot', 'snapshot_path',
+           'temporary_directory', 'write_state']
@@ -2,13 +2,27 @@ import unittest
 import tempfile
 import logging
 import shutil
+import subprocess
 import mock
 import copy
+import time
 import os
+import resource
 
 import git
 import gitctl
+import gitctl.backend
+import gitctl.bundle
 import gitctl.command
+import gitctl.commitgraph
+import gitctl.executor
+import gitctl.fetch
+import gitctl.gitconfig
+import gitctl.index
+import gitctl.maintenance
+import gitctl.mirror
+import gitctl.refs
+import gitctl.snapshot
 import gitctl.utils
 import gitctl.wtf
 
@@ -120,6 +134,10 @@ class TestCommandBranch(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.from_file = None
     
@@ -179,15 +197,22 @@ class TestCommandBranch(CommandTestCase):
 
 class TestCommandUpdate(CommandTestCase):
     """Tests for the ``update`` command."""
-    
-    def test_update__clone(self):
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
         # Mock some command line arguments
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.from_file = None
-        
+    
+    def test_update__clone(self):
         local_path = join(self.container, 'project.local')
         
         self.failIf(os.path.exists(local_path))
@@ -202,14 +227,94 @@ class TestCommandUpdate(CommandTestCase):
         # Make sure we have the right branch checked out.
         self.assertEquals('* development', [b.strip() for b in repo.branch().splitlines() if b.startswith('*')][0])
 
-    def test_update__pull(self):
-        # Mock some command line arguments
-        self.args = mock.Mock()
-        self.args.config = os.path.join(self.container, 'gitctl.cfg')
-        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
-        self.args.project = []
-        self.args.from_file = None
+    def test_update__clone_with_mirror_cache(self):
+        cache = os.path.join(self.container, 'mirrors')
+        open(self.args.config, 'a').write('\nmirror-cache = %s\n' % cache)
 
+        gitctl.command.gitctl_update(self.args)
+        mirror = gitctl.mirror.mirror_path(cache, self.upstream_path)
+        self.failUnless(os.path.isdir(mirror))
+        repository = gitctl.backend.Repository(join(self.container, 'project.local'))
+        self.assertEquals([os.path.join(mirror, 'objects')], gitctl.mirror.alternates(repository))
+        self.assertEquals(self.upstream.rev_parse('HEAD'), repository.rev_parse('HEAD'))
+
+    def test_update__shallow_clone_of_pinned_revision(self):
+        pinned = self.upstream.rev_parse('HEAD')
+        self.upstream.commit('--allow-empty', '-m', 'Second')
+        self.upstream.commit('--allow-empty', '-m', 'Third')
+        self.upstream.config('uploadpack.allowAnySHA1InWant', 'true')
+        # Local clones ignore --depth
+        open(self.args.externals, 'w').write("""
+[project.local]
+url = file://%s
+container = %s
+type = git
+treeish = %s
+depth = 1
+single-branch = true
+        """.strip() % (self.upstream_path, self.container, pinned))
+
+        gitctl.command.gitctl_update(self.args)
+        repository = gitctl.backend.Repository(join(self.container, 'project.local'))
+        self.assertEquals(pinned, repository.rev_parse('HEAD'))
+        self.failUnless(repository.is_shallow())
+        self.assertEquals(set(['origin/development']), repository.branches(remote=True) - set(['origin/HEAD']))
+
+    def test_update__shallow_clone_with_mirror_cache(self):
+        cache = os.path.join(self.container, 'mirrors')
+        open(self.args.config, 'a').write('\nmirror-cache = %s\n' % cache)
+        self.upstream.commit('--allow-empty', '-m', 'Second')
+        # Local clones ignore --depth
+        open(self.args.externals, 'w').write("""
+[project.local]
+url = file://%s
+container = %s
+type = git
+treeish = development
+depth = 1
+single-branch = true
+        """.strip() % (self.upstream_path, self.container))
+
+        gitctl.command.gitctl_update(self.args)
+        repository = gitctl.backend.Repository(join(self.container, 'project.local'))
+        self.assertEquals(1, len(gitctl.mirror.alternates(repository)))
+        self.failUnless(repository.is_shallow())
+        self.assertEquals(set(['origin/development']), repository.branches(remote=True) - set(['origin/HEAD']))
+
+    def test_update__sparse_checkout(self):
+        self.args.verbose = False
+        for directory in 'docs', 'src', 'tests':
+            os.makedirs(os.path.join(self.upstream_path, directory))
+            open(os.path.join(self.upstream_path, directory, 'file.txt'), 'w').write(directory)
+            self.upstream.add(directory)
+        self.upstream.commit('-m', 'Subdirectories')
+        externals = open(self.args.externals).read()
+        open(self.args.externals, 'w').write(externals + '\nsparse =\n    src\n')
+        local_path = join(self.container, 'project.local')
+
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals(['foobar.txt', 'src'], sorted(f for f in os.listdir(local_path) if f != '.git'))
+
+        # Changed patterns are applied on the next update
+        open(self.args.externals, 'w').write(externals + '\nsparse =\n    src\n    tests\n')
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals('project.local .......................... Sparse checkout updated', self.output[-1])
+        self.assertEquals(['foobar.txt', 'src', 'tests'], sorted(f for f in os.listdir(local_path) if f != '.git'))
+        self.failIf(gitctl.backend.Repository(local_path).state().dirty)
+
+        # The patterns are compared regardless of order and trailing slashes
+        open(self.args.externals, 'w').write(externals + '\nsparse =\n    tests/\n    src\n')
+        del self.output[:]
+        gitctl.command.gitctl_update(self.args)
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals([], [line for line in self.output if line.startswith('project.local')])
+
+        # Removing the option restores the full working directory
+        open(self.args.externals, 'w').write(externals)
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals(['docs', 'foobar.txt', 'src', 'tests'], sorted(f for f in os.listdir(local_path) if f != '.git'))
+
+    def test_update__pull(self):
         local_path = join(self.container, 'project.local')
         local = git.Git(local_path)
 
@@ -239,13 +344,7 @@ class TestCommandUpdate(CommandTestCase):
 
 
     def test_update__fetch_checkout(self):
-        # Mock some command line arguments
-        self.args = mock.Mock()
-        self.args.config = os.path.join(self.container, 'gitctl.cfg')
-        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
-        self.args.project = []
         self.args.verbose = True
-        self.args.from_file = None
 
         # Get the SHA1 checksum for the current head and pin the externals to it.
         sha1_first = self.upstream.rev_parse('HEAD').strip()
@@ -301,13 +400,6 @@ treeish = %s
 
     
     def test_update__rebase(self):
-        # Mock some command line arguments
-        self.args = mock.Mock()
-        self.args.config = os.path.join(self.container, 'gitctl.cfg')
-        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
-        self.args.project = []
-        self.args.from_file = None
-
         local_path = join(self.container, 'project.local')
         local = git.Git(local_path)
 
@@ -336,13 +428,6 @@ treeish = %s
         self.failUnless(log[0].endswith('Second commit'))
 
     def test_update__fast_forward_ok(self):
-        # Mock some command line arguments
-        self.args = mock.Mock()
-        self.args.config = os.path.join(self.container, 'gitctl.cfg')
-        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
-        self.args.project = []
-        self.args.from_file = None
-
         local_path = join(self.container, 'project.local')
         local = git.Git(local_path)
 
@@ -382,15 +467,6 @@ treeish = %s
             self.failUnless(log[0].endswith('Second commit in %s' % branch))
     
     def test_update__fast_forward_failure(self):
-        # Mock some command line arguments
-        self.args = mock.Mock()
-        self.args.config = os.path.join(self.container, 'gitctl.cfg')
-        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
-        self.args.project = []
-        self.args.from_file = None
-        self.args.from_file = None
-        self.args.from_file = None
-
         local_path = join(self.container, 'project.local')
         local = git.Git(local_path)
 
@@ -436,6 +512,114 @@ treeish = %s
             self.assertEquals(2, len(log))
             self.failUnless(log[0].endswith('Second commit in %s' % branch))
 
+    def test_update__fast_forward_without_checkout(self):
+        self.args.verbose = False
+
+        local_path = join(self.container, 'project.local')
+        local = git.Git(local_path)
+        gitctl.command.gitctl_update(self.args)
+        head_log = local.reflog('show', 'HEAD').splitlines()
+
+        # Advance the staging branch only
+        another = self.clone_upstream('another')
+        another.checkout('staging')
+        open(os.path.join(another.git_dir, 'random_addition.txt'), 'w').write('Foobar')
+        another.add('random_addition.txt')
+        another.commit('-m', 'Second commit in staging')
+        another.push()
+
+        gitctl.command.gitctl_update(self.args)
+        self.failUnless('project.local .......................... Updated' in self.output)
+        self.assertEquals(local.rev_parse('origin/staging'), local.rev_parse('staging'))
+        # The working directory was never switched to another branch
+        self.assertEquals(head_log, local.reflog('show', 'HEAD').splitlines())
+        self.assertEquals('development', git.Repo(local_path).active_branch)
+
+    def test_update__fast_forward_failure_without_checkout(self):
+        self.args.verbose = False
+
+        local_path = join(self.container, 'project.local')
+        local = git.Git(local_path)
+        gitctl.command.gitctl_update(self.args)
+
+        # Diverge the local and remote production branches
+        another = self.clone_upstream('another')
+        another.checkout('production')
+        open(os.path.join(another.git_dir, 'remote.txt'), 'w').write('Foobar')
+        another.add('remote.txt')
+        another.commit('-m', 'Remote commit')
+        another.push()
+        local.checkout('production')
+        open(os.path.join(local_path, 'local.txt'), 'w').write('Foobar')
+        local.add('local.txt')
+        local.commit('-m', 'Local commit')
+        local.checkout('development')
+        production = local.rev_parse('production')
+
+        gitctl.command.gitctl_update(self.args)
+        self.failUnless('project.local .......................... Fast forward merge not possible for branch ``production``. Try syncing with upstream manually (pull, push or merge).' in self.output)
+        self.assertEquals(production, local.rev_parse('production'))
+
+    def test_update__pinned_revision_offline(self):
+        self.args.verbose = True
+
+        sha1_first = self.upstream.rev_parse('HEAD').strip()
+        another = self.clone_upstream('another')
+        open(os.path.join(another.git_dir, 'random_addition.txt'), 'w').write('Foobar')
+        another.add('random_addition.txt')
+        another.commit('-m', 'Second commit')
+        another.push()
+        sha1_second = self.upstream.rev_parse('HEAD').strip()
+
+        def pin(sha1):
+            open(os.path.join(self.container, 'gitexternals.cfg'), 'w').write("""
+[project.local]
+url = %s
+container = %s
+type = git
+treeish = %s
+                """.strip() % (self.upstream_path, self.container, sha1))
+
+        pin(sha1_second)
+        gitctl.command.gitctl_update(self.args)
+
+        # Make the upstream unreachable. Both revisions exist locally so
+        # updating must not need the network.
+        shutil.move(self.upstream_path, self.upstream_path + '.offline')
+        gitctl.command.gitctl_update(self.args)
+        pin(sha1_first)
+        gitctl.command.gitctl_update(self.args)
+
+        output = [line for line in self.output if not line.startswith('Update finished')]
+        self.assertEquals(['project.local .......................... Cloned and checked out ``%s``' % sha1_second,
+                           'project.local .......................... OK',
+                           'project.local .......................... Checked out revision ``%s``' % sha1_first],
+                          output)
+        self.assertEquals(sha1_first, git.Git(join(self.container, 'project.local')).rev_parse('HEAD').strip())
+
+    def test_update__probe(self):
+        self.args.probe = True
+        self.args.verbose = False
+
+        local = git.Git(join(self.container, 'project.local'))
+        gitctl.command.gitctl_update(self.args)
+        gitctl.command.gitctl_update(self.args)
+        self.failUnless('Probed 1 project(s): 0 changed, 1 unchanged' in self.output)
+
+        another = self.clone_upstream('another')
+        another.commit('--allow-empty', '-m', 'Second commit')
+        another.push()
+        gitctl.command.gitctl_update(self.args)
+        self.failUnless('Probed 1 project(s): 1 changed, 0 unchanged' in self.output)
+        self.failUnless('project.local .......................... Updated' in self.output)
+        self.assertEquals(another.rev_parse('HEAD'), local.rev_parse('development'))
+
+        # Projects fetched within the TTL are not probed
+        self.args.fetch_ttl = 3600
+        del self.output[:]
+        gitctl.command.gitctl_update(self.args)
+        self.failIf([line for line in self.output if line.startswith('Probed')])
+
 class TestCommandFetch(CommandTestCase):
     """Tests for the ``fetch`` command."""
 
@@ -448,6 +632,10 @@ class TestCommandFetch(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.from_file = None
 
@@ -470,6 +658,498 @@ class TestCommandFetch(CommandTestCase):
         self.failIfEqual(self.local.rev_parse('development'),
                          self.local.rev_parse('origin/development'))
 
+    def test_fetch__ttl(self):
+        self.args.fetch_ttl = 3600
+        self.args.verbose = True
+        another = self.clone_upstream('another')
+        open(os.path.join(another.git_dir, 'random_addition.txt'), 'w').write('Foobar')
+        another.add('random_addition.txt')
+        another.commit('-m', 'Fubu')
+        another.push()
+
+        # The first fetch has no record of previous fetches
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals('project.local .......................... Fetched', self.output[0])
+        fetched = self.local.rev_parse('origin/development')
+
+        another.commit('--allow-empty', '-m', 'Fubu again')
+        another.push()
+
+        # The second one within the TTL is skipped
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals('project.local .......................... Fetched recently', self.output[1])
+        self.assertEquals(fetched, self.local.rev_parse('origin/development'))
+
+        # A zero TTL always fetches
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals('project.local .......................... Fetched', self.output[2])
+        self.failIfEqual(fetched, self.local.rev_parse('origin/development'))
+
+    def test_fetch__probe(self):
+        self.args.probe = True
+        self.args.verbose = True
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['Probed 1 project(s): 0 changed, 1 unchanged',
+                           'project.local .......................... Unchanged'], self.output)
+
+        another = self.clone_upstream('another')
+        another.checkout('staging')
+        another.commit('--allow-empty', '-m', 'Fubu')
+        another.push()
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['Probed 1 project(s): 1 changed, 0 unchanged',
+                           'project.local .......................... Fetched'], self.output[2:])
+        self.assertEquals(another.rev_parse('HEAD'), self.local.rev_parse('origin/staging'))
+
+
+    def test_fetch__narrow(self):
+        config = open(self.args.config).read()
+        open(self.args.config, 'w').write(config + '\nfetch-policy = narrow\n')
+        self.upstream.branch('feature')
+        self.upstream.branch('production-old')
+        self.upstream.tag('v1.0')
+        self.upstream.commit('--allow-empty', '-m', 'Fubu')
+        self.upstream.branch('-D', 'staging')
+
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals('project.local .......................... Fetched', self.output[0])
+        self.assertEquals(self.upstream.rev_parse('development'),
+                          self.local.rev_parse('origin/development'))
+        refs = self.local.for_each_ref('--format=%(refname)').split()
+        # Only the configured branches were fetched and the deleted one pruned
+        self.failIf('refs/remotes/origin/feature' in refs)
+        self.failIf('refs/remotes/origin/production-old' in refs)
+        self.failIf('refs/remotes/origin/staging' in refs)
+        self.failIf('refs/tags/v1.0' in refs)
+        self.failUnless('refs/remotes/origin/production' in refs)
+
+
+class TestCommandPrefetch(CommandTestCase):
+    """Tests for the ``prefetch`` command."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        self.local = self.clone_upstream('project.local')
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 3600
+        self.args.probe = False
+        self.args.from_bundles = None
+        self.args.project = []
+        self.args.from_file = None
+        self.args.interval = None
+        self.args.verbose = False
+
+    def test_prefetch(self):
+        another = self.clone_upstream('another')
+        open(os.path.join(another.git_dir, 'random_addition.txt'), 'w').write('Foobar')
+        another.add('random_addition.txt')
+        another.commit('-m', 'Fubu')
+        another.push()
+        head = another.rev_parse('HEAD')
+        tracking = self.local.rev_parse('origin/development')
+
+        gitctl.command.gitctl_prefetch(self.args)
+        self.assertEquals([], self.output)
+        # The remote-tracking branches were left alone
+        self.assertEquals(tracking, self.local.rev_parse('origin/development'))
+        self.assertEquals(head, self.local.rev_parse('refs/prefetch/origin/development'))
+
+        # Fetching uses the prefetched data without the network
+        shutil.move(self.upstream_path, self.upstream_path + '.offline')
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['project.local .......................... Fetched'], self.output)
+        self.assertEquals(head, self.local.rev_parse('origin/development'))
+
+    def test_prefetch__stale(self):
+        gitctl.command.gitctl_prefetch(self.args)
+        repository = gitctl.backend.Repository(self.local.git_dir)
+        config = gitctl.utils.parse_config([self.args.config])
+        self.assertEquals(('prefetched', ('fetch', '--no-tags', '.', '+refs/prefetch/origin/*:refs/remotes/origin/*')),
+                          gitctl.fetch.fetch_command(repository, config, 3600))
+        # Prefetched data older than the TTL is ignored
+        self.assertEquals(('fetched', ('fetch', 'origin')), gitctl.fetch.fetch_command(repository, config, 0))
+
+class TestCommandFetchManifest(CommandTestCase):
+    """Tests for fetching with an upstream change manifest."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        # A bare repository with the manifest hook stands in for the server
+        self.server_path = os.path.join(self.container, 'server', 'project.git')
+        git.Git(self.container).clone('--bare', self.upstream_path, self.server_path)
+        self.manifest_path = os.path.join(self.container, 'server', 'manifest.log')
+        hook = os.path.join(self.server_path, 'hooks', 'post-receive')
+        open(hook, 'w').write(gitctl.fetch.manifest_hook('project', self.manifest_path, email=False))
+        os.chmod(hook, 0755)
+        open(os.path.join(self.container, 'gitctl.cfg'), 'a').write('\nmanifest = %s\n' % self.manifest_path)
+        open(os.path.join(self.container, 'gitexternals.cfg'), 'w').write("""
+[project.local]
+url = %s
+container = %s
+type = git
+treeish = development
+        """.strip() % (self.server_path, self.container))
+        self.local = git.Git(self.container)
+        self.local.clone(self.server_path, join(self.container, 'project.local'))
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
+        self.args.project = []
+        self.args.from_file = None
+        self.args.verbose = True
+
+    def push(self, name):
+        another = git.Git(self.container)
+        another.clone(self.server_path, join(self.container, name))
+        another = git.Git(join(self.container, name))
+        another.commit('--allow-empty', '-m', 'Fubu')
+        another.push('origin', 'development')
+
+    def test_manifest_hook(self):
+        self.push('another')
+        entries = open(self.manifest_path).read().splitlines()
+        self.assertEquals(1, len(entries))
+        timestamp, project, ref, old, new = entries[0].split()
+        self.assertEquals('project', project)
+        self.assertEquals('refs/heads/development', ref)
+
+    def test_fetch__manifest(self):
+        self.push('another')
+        # Nothing is known about the first fetch
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['project.local .......................... Fetched'], self.output)
+        # No new manifest entries
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['project.local .......................... Unchanged'], self.output[1:])
+        # A push records an entry
+        self.push('yet_another')
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['project.local .......................... Fetched'], self.output[2:])
+
+class TestCommandDedupe(CommandTestCase):
+    """Tests for the ``dedupe`` command."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        self.local = self.clone_upstream('project.local')
+        self.cache = os.path.join(self.container, 'mirrors')
+        open(os.path.join(self.container, 'gitctl.cfg'), 'a').write('\nmirror-cache = %s\n' % self.cache)
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.verbose = False
+        self.args.project = []
+        self.args.from_file = None
+
+    def test_dedupe(self):
+        self.local.commit('--allow-empty', '-m', 'Local change')
+        head = self.local.rev_parse('HEAD')
+
+        gitctl.command.gitctl_dedupe(self.args)
+        self.failUnless(self.output[0].startswith('project.local .......................... Deduplicated, '))
+        repository = gitctl.backend.Repository(self.local.git_dir)
+        mirror = gitctl.mirror.mirror_path(self.cache, self.upstream_path)
+        self.assertEquals([os.path.join(mirror, 'objects')], gitctl.mirror.alternates(repository))
+        # The local objects are intact and the rest are borrowed
+        self.assertEquals(head, repository.rev_parse('HEAD'))
+        self.failUnless(repository.git('fsck').ok)
+        local_objects = []
+        pack_dir = os.path.join(repository.git_dir, 'objects', 'pack')
+        for name in os.listdir(pack_dir):
+            if name.endswith('.idx'):
+                output = subprocess.Popen(['git', 'show-index'], stdin=open(os.path.join(pack_dir, name)),
+                                          stdout=subprocess.PIPE).communicate()[0]
+                local_objects.extend(line.split()[1] for line in output.splitlines())
+        self.failUnless(head in local_objects)
+        self.failIf(self.upstream.rev_parse('HEAD') in local_objects)
+
+        # Running it again does nothing
+        gitctl.command.gitctl_dedupe(self.args)
+        self.assertEquals(1, len(self.output))
+
+
+class TestCommandBundle(CommandTestCase):
+    """Tests for the ``bundle`` command and ``update --from-bundles``."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        self.local = self.clone_upstream('project.local')
+        self.bundles = os.path.join(self.container, 'bundles')
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.verbose = True
+        self.args.project = []
+        self.args.from_file = None
+        self.args.action = 'create'
+        self.args.directory = self.bundles
+
+    def offline_workspace(self):
+        """Returns the path of the externals configuration of a workspace
+        whose upstream is not reachable.
+        """
+        workspace = os.path.join(self.container, 'offline')
+        os.makedirs(workspace)
+        externals = os.path.join(workspace, 'gitexternals.cfg')
+        open(externals, 'w').write("""
+[project.local]
+url = /non/existing/project.git
+container = %s
+type = git
+treeish = development
+        """.strip() % workspace)
+        return externals
+
+    def test_bundle__create_and_update(self):
+        gitctl.command.gitctl_bundle(self.args)
+        self.assertEquals(['project.local .......................... Exported'], self.output)
+        self.assertEquals([os.path.join(self.bundles, 'project.local.bundle')],
+                          gitctl.bundle.bundle_files(self.bundles, 'project.local'))
+
+        # Nothing has changed
+        gitctl.command.gitctl_bundle(self.args)
+        self.assertEquals('project.local .......................... Unchanged', self.output[1])
+
+        # Clone from the bundles
+        update_args = copy.copy(self.args)
+        update_args.externals = self.offline_workspace()
+        update_args.from_bundles = self.bundles
+        gitctl.command.gitctl_update(update_args)
+        offline = gitctl.backend.Repository(os.path.join(self.container, 'offline', 'project.local'))
+        self.assertEquals(self.local.rev_parse('origin/development'), offline.rev_parse('HEAD'))
+        self.assertEquals('development', offline.active_branch())
+
+        # New upstream commits are exported incrementally
+        another = self.clone_upstream('another')
+        another.commit('--allow-empty', '-m', 'Fubu')
+        another.push()
+        self.local.fetch()
+        gitctl.command.gitctl_bundle(self.args)
+        self.assertEquals('project.local .......................... Exported incrementally', self.output[-1])
+        self.assertEquals(2, len(gitctl.bundle.bundle_files(self.bundles, 'project.local')))
+
+        # and fast-forwarded from the bundles
+        gitctl.command.gitctl_update(update_args)
+        self.assertEquals(another.rev_parse('HEAD'), offline.rev_parse('HEAD'))
+
+    def test_bundle__invalid_bundle(self):
+        os.makedirs(self.bundles)
+        open(os.path.join(self.bundles, 'project.local.bundle'), 'w').write('# v2 git bundle\ngarbage\n')
+        update_args = copy.copy(self.args)
+        update_args.externals = self.offline_workspace()
+        update_args.from_bundles = self.bundles
+        gitctl.command.gitctl_update(update_args)
+        self.failUnless(self.output[0].startswith('project.local .......................... ERROR '), self.output)
+        self.failIf(os.path.exists(os.path.join(self.container, 'offline', 'project.local')))
+
+    def test_bundle__pinned_revision_unchanged(self):
+        pinned = self.local.rev_parse('origin/production')
+        externals = open(self.args.externals).read()
+        open(self.args.externals, 'w').write(externals.replace('development', pinned))
+        gitctl.command.gitctl_bundle(self.args)
+
+        # Moving branches do not matter while the pin stays the same
+        another = self.clone_upstream('another')
+        another.commit('--allow-empty', '-m', 'Fubu')
+        another.push()
+        self.local.fetch()
+        gitctl.command.gitctl_bundle(self.args)
+        self.assertEquals(['project.local .......................... Exported',
+                           'project.local .......................... Unchanged'], self.output)
+
+
+class TestCommandExport(CommandTestCase):
+    """Tests for the ``export`` command."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        self.local = self.clone_upstream('project.local')
+        self.cache = os.path.join(self.container, 'artifacts')
+        open(os.path.join(self.container, 'gitctl.cfg'), 'a').write('\nartifact-cache = %s\n' % self.cache)
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.verbose = True
+        self.args.project = []
+        self.args.from_file = None
+        self.args.directory = os.path.join(self.container, 'deploy')
+
+    def test_export(self):
+        gitctl.command.gitctl_export(self.args)
+        self.assertEquals(['project.local .......................... Exported ``development``'], self.output)
+        proj = gitctl.utils.parse_externals(self.args.externals)[0]
+        target = gitctl.snapshot.snapshot_path(self.args.directory, proj)
+        self.assertEquals(['foobar.txt'], os.listdir(target))
+        self.assertEquals('Lorem lipsum', open(os.path.join(target, 'foobar.txt')).read())
+        tree = self.local.rev_parse('development^{tree}')
+        self.assertEquals({'project.local' : tree}, gitctl.snapshot.read_state(self.args.directory))
+
+        # Unchanged trees are left alone
+        gitctl.command.gitctl_export(self.args)
+        self.assertEquals('project.local .......................... Unchanged', self.output[1])
+
+        # Other exports of the same tree are linked from the artifact cache
+        self.args.directory = os.path.join(self.container, 'deploy2')
+        gitctl.command.gitctl_export(self.args)
+        self.assertEquals('project.local .......................... Exported ``development`` from the artifact cache',
+                          self.output[2])
+        other = gitctl.snapshot.snapshot_path(self.args.directory, proj)
+        self.assertEquals(os.stat(os.path.join(target, 'foobar.txt')).st_ino,
+                          os.stat(os.path.join(other, 'foobar.txt')).st_ino)
+
+    def test_snapshot_path(self):
+        self.assertEquals('/deploy/src/my.project',
+                          gitctl.snapshot.snapshot_path('/deploy', {'container' : '../src', 'name' : 'my.project'}))
+        self.assertEquals('/deploy/srv/src/my.project',
+                          gitctl.snapshot.snapshot_path('/deploy', {'container' : '/srv/src', 'name' : 'my.project'}))
+
+
+class TestCommandWorktree(CommandTestCase):
+    """Tests for projects sharing a repository through ``worktree-of``."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        open(os.path.join(self.container, 'gitexternals.cfg'), 'a').write("""
+
+[project.staging]
+worktree-of = project.local
+container = %s
+treeish = staging
+        """ % self.container)
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
+        self.args.verbose = True
+        self.args.project = []
+        self.args.from_file = None
+
+    def test_update(self):
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals(['project.local .......................... Cloned and checked out ``development``',
+                           'project.staging ........................ Added worktree of ``project.local`` and checked out ``staging``'],
+                          self.output)
+        primary = gitctl.backend.Repository(join(self.container, 'project.local'))
+        staging = gitctl.backend.Repository(join(self.container, 'project.staging'))
+        self.assertEquals('staging', staging.active_branch())
+        self.assertEquals(primary.git_dir, staging.common_dir)
+        self.assertEquals({'development' : primary.path, 'staging' : staging.path},
+                          dict((branch, os.path.realpath(path)) for branch, path in primary.worktree_branches().items()))
+
+        # One fetch updates both and the branch is merged in its worktree
+        another = self.clone_upstream('another')
+        another.checkout('staging')
+        another.commit('--allow-empty', '-m', 'Fubu')
+        another.push('origin', 'staging')
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals(another.rev_parse('HEAD'), staging.rev_parse('HEAD'))
+        self.failIf(staging.state().dirty)
+        self.assertEquals('project.staging ........................ Updated', self.output[-1])
+
+    def test_fetch_and_branch(self):
+        gitctl.command.gitctl_update(self.args)
+        self.args.probe = False
+        gitctl.command.gitctl_fetch(self.args)
+        self.assertEquals(['project.local .......................... Fetched',
+                           'project.staging ........................ Shares the repository of ``project.local``'],
+                          self.output[2:])
+
+        self.args.checkout = ['staging']
+        self.args.project = ['project.local']
+        gitctl.command.gitctl_branch(self.args)
+        self.failUnless(self.output[-1].startswith('project.local .......................... Branch ``staging`` is checked out in the worktree'))
+
+    def test_update__externals_order(self):
+        # A worktree listed before its primary project waits for it but is
+        # still reported in the externals order.
+        open(self.args.externals, 'a').write('\n[project.a]\nworktree-of = project.local\ncontainer = %s\ntreeish = production\n'
+                                             % self.container)
+        gitctl.command.gitctl_update(self.args)
+        self.assertEquals(['project.a', 'project.local', 'project.staging'], [line.split()[0] for line in self.output])
+        self.failUnless(os.path.isdir(join(self.container, 'project.a')))
+
+    def test_parse_externals__unknown_primary(self):
+        open(self.args.externals, 'a').write('\n[project.other]\nworktree-of = nothing\ncontainer = src\ntreeish = staging\n')
+        self.assertRaises(ValueError, lambda: gitctl.utils.parse_externals(self.args.externals))
+
+
+class TestCommandMaintenance(CommandTestCase):
+    """Tests for the ``maintenance`` command."""
+
+    def setUp(self):
+        super(self.__class__, self).setUp()
+
+        self.local = self.clone_upstream('project.local')
+
+        # Mock some command line arguments
+        self.args = mock.Mock()
+        self.args.config = os.path.join(self.container, 'gitctl.cfg')
+        self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.verbose = False
+        self.args.project = []
+        self.args.from_file = None
+        self.args.task = None
+
+    def test_maintenance(self):
+        self.local.commit('--allow-empty', '-m', 'Loose objects')
+        gitctl.command.gitctl_maintenance(self.args)
+        self.failUnless(self.output[0].startswith('project.local .......................... Status probe '))
+        self.failUnless(self.output[1].startswith('Ran incremental-repack, multi-pack-index, commit-graph, '
+                                                  'untracked-cache in 1 project(s). Status probe total '))
+        objects = os.path.join(self.local.git_dir, '.git', 'objects')
+        self.failUnless(os.path.exists(os.path.join(objects, 'info', 'commit-graph')))
+        self.failUnless(os.path.exists(os.path.join(objects, 'pack', 'multi-pack-index')))
+        self.assertEquals('true', self.local.config('core.untrackedCache'))
+
+    def test_maintenance__selected_tasks(self):
+        self.args.task = ['commit-graph']
+        gitctl.command.gitctl_maintenance(self.args)
+        objects = os.path.join(self.local.git_dir, '.git', 'objects')
+        self.failUnless(os.path.exists(os.path.join(objects, 'info', 'commit-graph')))
+        self.failIf(os.path.exists(os.path.join(objects, 'pack', 'multi-pack-index')))
+
+    def test_parse_tasks(self):
+        self.assertEquals(['incremental-repack', 'commit-graph'],
+                          gitctl.maintenance.parse_tasks(['commit-graph', 'incremental-repack']))
+        self.assertRaises(ValueError, lambda: gitctl.maintenance.parse_tasks(['gc']))
+
 
 class TestCommandPending(CommandTestCase):
     """Tests for the ``pending`` command."""
@@ -483,6 +1163,10 @@ class TestCommandPending(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.show_config = False
         self.args.diff = False
         self.args.project = []   # we do not have them
@@ -538,6 +1222,23 @@ treeish = master
         gitctl.command.gitctl_pending(self.args)
         self.assertEquals('project.local .......................... Treeish is not a SHA1 revision: development', self.output[0])
 
+    def test_pending__incomplete_history(self):
+        pinned = self.local.rev_parse('production').strip()
+        open(join(self.container, 'gitexternals.cfg'), 'w').write("""
+[project.local]
+url = %s
+container = %s
+type = git
+treeish = %s
+single-branch = true
+        """.strip() % (self.upstream_path, self.container, pinned))
+        # A single branch clone that does not have the production remote branch
+        self.local.update_ref('-d', 'refs/remotes/origin/production')
+        self.local.config('remote.origin.fetch', '+refs/heads/development:refs/remotes/origin/development')
+        gitctl.command.gitctl_pending(self.args)
+        self.assertEquals('project.local .......................... Cannot compare ``production`` '
+                          'with the pinned revision, the history is incomplete', self.output[0])
+
     def test_pending__production_advanced_over_pinned_versions(self):
 
         # Create a new gitexternals.cfg configuration that uses a pinned version
@@ -599,6 +1300,10 @@ class TestCommandStatus(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.no_fetch = False
         self.args.from_file = None
@@ -650,6 +1355,10 @@ class TestCommandPath(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.no_fetch = False
         self.args.from_file = None
@@ -686,9 +1395,15 @@ class TestCommandSh(CommandTestCase):
         self.args = mock.Mock()
         self.args.config = os.path.join(self.container, 'gitctl.cfg')
         self.args.externals = os.path.join(self.container, 'gitexternals.cfg')
+        self.args.jobs = 2
+        self.args.fetch_ttl = 0
+        self.args.probe = False
+        self.args.from_bundles = None
         self.args.project = []
         self.args.no_fetch = False
         self.args.from_file = None
+        self.args.timeout = None
+        self.args.stream = False
 
     def test_sh__ok(self):
         self.args.command = 'ls'
@@ -709,6 +1424,47 @@ class TestCommandSh(CommandTestCase):
         self.failUnless('Error' in self.output[0])
         self.assertEquals(1, len(self.output))
 
+    def test_sh__exit_status_is_not_summed(self):
+        another = self.clone_upstream('another')
+        open(os.path.join(self.container, 'gitexternals.cfg'), 'a').write("""
+
+[another]
+url = %s
+container = %s
+type = git
+treeish = development
+        """ % (self.upstream_path, self.container))
+        self.args.command = 'exit 200'
+        result = gitctl.command.gitctl_sh(self.args)
+        self.assertEquals(200, result)
+        self.assertEquals(2, len(self.output))
+
+    def test_sh__exit_status_table(self):
+        summary = []
+        handler = logging.StreamHandler(mock.Mock(write=summary.append, flush=lambda: None))
+        logging.getLogger('gitctl.summary').addHandler(handler)
+        try:
+            self.args.command = 'exit 3'
+            gitctl.command.gitctl_sh(self.args)
+        finally:
+            logging.getLogger('gitctl.summary').removeHandler(handler)
+        self.assertEquals(['Exit status:', 'project.local .......................... 3'], summary[0].splitlines())
+
+    def test_sh__working_directory_and_project(self):
+        self.args.command = 'echo "$PROJECT $(pwd)" > ../sh_output.txt'
+        result = gitctl.command.gitctl_sh(self.args)
+        self.assertEquals(0, result)
+        self.assertEquals('project.local %s' % join(self.container, 'project.local'),
+                          open(os.path.join(self.container, 'sh_output.txt')).read().strip())
+
+    def test_sh__timeout(self):
+        self.args.command = 'sleep 10; sleep 10'
+        self.args.timeout = 0.2
+        result = gitctl.command.gitctl_sh(self.args)
+        self.assertEquals(124, result)
+        self.assertEquals(1, len(self.output))
+        self.failUnless('Timed out' in self.output[0])
+
 class TestUtils(unittest.TestCase):
     """Tests for the utility functions."""
 
@@ -786,6 +1542,20 @@ commit-email-prefix = [GIT]
         self.assertEquals('production', conf['production-branch'])
         self.assertEquals('commit@non.existing.tld', conf['commit-email'])
         self.assertEquals('[GIT]', conf['commit-email-prefix'])
+        self.assertEquals(300, conf['fetch-ttl'])
+        self.assertEquals(None, conf['manifest'])
+        self.assertEquals('full', conf['fetch-policy'])
+        self.assertEquals(False, conf['fetch-tags'])
+        self.assertEquals(None, conf['mirror-cache'])
+        self.assertEquals(False, conf['mirror-dissociate'])
+        self.assertEquals(None, conf['artifact-cache'])
+        self.assertEquals(['incremental-repack', 'multi-pack-index', 'commit-graph', 'untracked-cache'],
+                          conf['maintenance-tasks'])
+
+    def test_parse_config__invalid_fetch_policy(self):
+        config = os.path.join(self.path, 'gitctl.cfg')
+        open(config, 'w').write("[gitctl]\nfetch-policy = everything\n")
+        self.assertRaises(ValueError, lambda: gitctl.utils.parse_config([config]))
 
 
     def test_parse_externals(self):
@@ -816,6 +1586,28 @@ treeish = master
                             'url': 'git@github.com:dokai/your-project'}],
                            projects)
 
+    def test_parse_externals__partial_clone(self):
+        ext = os.path.join(self.path, 'gitexternals.cfg')
+        open(ext, 'w').write("""
+[my.project]
+url = git@github.com:dokai/my-project
+container = src
+treeish = development
+depth = 10
+filter = blob:none
+single-branch = true
+        """.strip())
+        proj = gitctl.utils.parse_externals(ext)[0]
+        self.assertEquals(10, proj['depth'])
+        self.assertEquals('blob:none', proj['filter'])
+        self.assertEquals(True, proj['single-branch'])
+        self.assertEquals(('--depth', '10', '--filter=blob:none', '--single-branch', '--branch', 'development'),
+                          gitctl.utils.clone_options(proj))
+        self.assertEquals(('--depth', '10', '--filter=blob:none'), gitctl.utils.fetch_options(proj))
+
+        open(ext, 'w').write("[my.project]\nurl = foo\ncontainer = src\ntreeish = master\ndepth = 0\n")
+        self.assertRaises(ValueError, lambda: gitctl.utils.parse_externals(ext))
+
     def test_generate_externals(self):
         projects = [{'container': 'src',
                      'name': 'my.project',
@@ -858,6 +1650,22 @@ treeish = master
 
         self.assertEquals(projects, gitctl.utils.parse_externals(ext))
 
+    def test_externals_roundtrip__partial_clone(self):
+        projects = [{'container': 'src',
+                     'name': 'my.project',
+                     'treeish': 'development',
+                     'type': 'git',
+                     'url': 'git@github.com:dokai/my-project',
+                     'depth': 1,
+                     'filter': 'blob:none',
+                     'single-branch': False,
+                     'sparse': ['src/my', 'docs']}]
+
+        ext = os.path.join(self.path, 'gitexternals.cfg')
+        open(ext, 'w').write(gitctl.utils.generate_externals(copy.deepcopy(projects)))
+
+        self.assertEquals(projects, gitctl.utils.parse_externals(ext))
+
 class TestWTF(unittest.TestCase):
     """Test for the wtf helpers."""
     
@@ -902,7 +1710,7 @@ class TestWTF(unittest.TestCase):
         repo.checkout('-b', 'feature1', 'master')
         repo.checkout('-b', 'feature2', 'master')
         
-        structure = gitctl.wtf.branch_structure(git.Repo(repo_path))
+        structure = gitctl.wtf.branch_structure(gitctl.backend.Repository(repo_path))
         self.assertEquals(structure, {
             'feature1': {
                 'local_branch': 'heads/feature1',
@@ -960,11 +1768,52 @@ class TestWTF(unittest.TestCase):
         repo.add('foobar.py')
         repo.commit('-m', 'third commit')
         
-        commits = gitctl.wtf.commits_between(git.Repo(repo_path), 'HEAD^^', 'HEAD')
+        commits = gitctl.wtf.commits_between(gitctl.backend.Repository(repo_path), 'HEAD^^', 'HEAD')
         self.assertEquals(2, len(commits))
         self.failUnless('third commit' in commits[0])
         self.failUnless('second commit' in commits[1])
     
+    def test_count_commits(self):
+        repo_path = self.tmpdir()
+        repo = git.Git(repo_path)
+        repo.init()
+        for i in range(5):
+            open(join(repo_path, 'foobar.py'), 'w').write(str(i))
+            repo.add('foobar.py')
+            repo.commit('-m', 'commit %s' % i)
+        repository = gitctl.backend.Repository(repo_path)
+        self.assertEquals(4, gitctl.wtf.count_commits(repository, 'HEAD~4', 'HEAD'))
+        self.assertEquals(0, gitctl.wtf.count_commits(repository, 'HEAD', 'HEAD~4'))
+        self.assertEquals(3, gitctl.wtf.count_commits(repository, 'HEAD~4', 'HEAD', cap=2))
+        self.assertEquals('2+', gitctl.wtf.format_count(3, 2))
+        self.assertEquals('2', gitctl.wtf.format_count(2, 2))
+        self.assertEquals('4', gitctl.wtf.format_count(4))
+        # The same answers from the commit-graph
+        repo.commit_graph('write', '--reachable')
+        self.failIf(gitctl.commitgraph.load(repository) is None)
+        self.assertEquals(4, gitctl.wtf.count_commits(repository, 'HEAD~4', 'HEAD'))
+        self.assertEquals(3, gitctl.wtf.count_commits(repository, 'HEAD~4', 'HEAD', cap=2))
+        # The walk stops after the cap
+        graph = gitctl.commitgraph.load(repository)
+        positions = [graph.lookup(repository.rev_parse(rev)) for rev in ('HEAD~4', 'HEAD')]
+        self.assertEquals({2: 3}, graph.histogram(positions, (2, 3)))
+
+    def test_iter_commits(self):
+        repo_path = self.tmpdir()
+        repo = git.Git(repo_path)
+        repo.init()
+        for i in range(3):
+            open(join(repo_path, 'foobar.py'), 'w').write(str(i))
+            repo.add('foobar.py')
+            repo.commit('-m', 'commit %s' % i)
+        repository = gitctl.backend.Repository(repo_path)
+        commits = gitctl.wtf.iter_commits(repository, 'HEAD~2', 'HEAD', verbose=False)
+        self.failUnless(commits.next().endswith('] commit 2'))
+        commits.close()
+        commits = list(gitctl.wtf.iter_commits(repository, 'HEAD~2', 'HEAD', limit=1))
+        self.assertEquals(1, len(commits))
+        self.assertRaises(gitctl.backend.GitError, list, gitctl.wtf.iter_commits(repository, 'nonexistent', 'HEAD'))
+
     def test_show_commits__no_limit(self):
         commits = 'commit1 commit2 commit3 commit4'.split()
         self.assertEquals(gitctl.wtf.show_commits(commits, limit=None),
@@ -998,8 +1847,702 @@ class TestWTF(unittest.TestCase):
     def test_ahead_behind__neither(self):
         self.assertEquals(gitctl.wtf.ahead_behind([], []), '')
     
+    def test_show_commits__count(self):
+        commits = 'commit1 commit2'.split()
+        self.assertEquals(gitctl.wtf.show_commits(commits, limit=2, count=5),
+            ['    commit1', '    commit2', '    ... and 3 more'])
+
+    def test_commit_graph(self):
+        repo_path = self.tmpdir()
+        repo = git.Git(repo_path)
+        repo.init()
+        for branch, count in (('master', 3), ('feature', 2), ('other', 4)):
+            if branch != 'master':
+                repo.checkout('-b', branch, 'master~1')
+            for i in range(count):
+                open(join(repo_path, branch), 'w').write(str(i))
+                repo.add(branch)
+                repo.commit('-m', '%s %s' % (branch, i))
+        repo.checkout('master')
+        repo.merge('--no-ff', '-m', 'merge', 'feature')
+        tips = ['master', 'feature', 'other', 'HEAD', 'other~2']
+        graph = gitctl.wtf.CommitGraph(gitctl.backend.Repository(repo_path), tips)
+        for from_ in tips:
+            for to in tips:
+                expected = int(repo.rev_list('--count', '%s..%s' % (from_, to)))
+                self.assertEquals(expected, graph.count(from_, to), '%s..%s' % (from_, to))
+
+    def test_show_feature_branches(self):
+        repo_path = self.tmpdir()
+        repo = git.Git(repo_path)
+        repo.init()
+        def commit(message):
+            open(join(repo_path, 'foobar.py'), 'w').write(message)
+            repo.add('foobar.py')
+            repo.commit('-m', message)
+        commit('first')
+        repo.branch('development')
+        repo.checkout('-b', 'done')
+        os.environ['GIT_COMMITTER_DATE'] = '2000-01-01T00:00:00'
+        try:
+            commit('done')
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+        repo.checkout('development')
+        repo.merge('done')
+        repo.update_ref('refs/remotes/origin/development', 'development')
+        repo.checkout('-b', 'unpushed')
+        commit('unpushed')
+        repo.checkout('development')
+        repo.merge('unpushed')
+        repo.checkout('-b', 'open')
+        commit('open 1')
+        commit('open 2')
+        repo.update_ref('refs/remotes/origin/remote', 'open')
+        repo.checkout('development')
+        commit('development')
+
+        repository = gitctl.backend.Repository(repo_path)
+        branch_info = {'name': 'development', 'local_branch': 'heads/development', 'remote_branch': 'origin/development'}
+        all_branches = {'done': {'name': 'done', 'local_branch': 'heads/done'},
+                        'unpushed': {'name': 'unpushed', 'local_branch': 'heads/unpushed'},
+                        'open': {'name': 'open', 'local_branch': 'heads/open'},
+                        'origin/remote': {'name': 'origin/remote', 'remote_branch': 'origin/remote'}}
+        features = ['done', 'unpushed', 'open', 'origin/remote']
+        output = gitctl.wtf.show_feature_branches(repository, branch_info, all_branches, features, verbose=True)
+        self.assertEquals([
+            '  - has a completed feature branch ``done`` which is merged and pushed upstream.',
+            '  - has a completed feature branch ``unpushed`` which is waiting to be pushed upstream',
+            '  - has a feature branch ``open`` with 2 commit(s) ahead; 1 commit(s) behind waiting for merge.',
+            '  - has a feature branch ``origin/remote`` with 3 commit(s) ahead; 1 commit(s) behind waiting for merge.'],
+            output)
+
+        output = gitctl.wtf.show_feature_branches(repository, branch_info, all_branches, features, verbose=True,
+                                                  commit_limit=1, days=30)
+        self.assertEquals('  - has 1 older feature branch(es) that were not inspected.', output[0])
+        self.failIf([line for line in output if '``done``' in line])
+        self.assertEquals(['    ... and 1 more'], [line for line in output if 'more' in line][:1])
+        self.assertEquals(3, len(gitctl.wtf.recent_refs(repository, limit=3)))
+
     def test_show_branch(self):
-        pass
+        remote_path = self.tmpdir()
+        remote = git.Git(remote_path)
+        remote.init()
+        open(join(remote_path, 'foobar.py'), 'w').write('import sha')
+        remote.add('foobar.py')
+        remote.commit('-m', 'first commit')
+        repo_path = self.tmpdir()
+        remote.clone(remote_path, repo_path)
+        repo = git.Git(repo_path)
+        for i in range(3):
+            open(join(repo_path, 'foobar.py'), 'w').write(str(i))
+            repo.commit('-a', '-m', 'local %s' % i)
+        repository = gitctl.backend.Repository(repo_path)
+        branches = gitctl.wtf.branch_structure(repository)
+        output = gitctl.wtf.show_branch(repository, branches['master'], branches, commit_limit=2)
+        self.assertEquals('Branch ``master``', output[0])
+        self.assertEquals('  - has 3 new commit(s) that need to be pushed.', output[1])
+        self.failUnless('local 2' in output[2])
+        self.failUnless('local 1' in output[3])
+        self.assertEquals('    ... and 1 more', output[4])
+        self.assertEquals([], gitctl.wtf.show_branch(repository, branches['master'], branches, commit_limit=0)[2:])
+
+class TestExecutor(unittest.TestCase):
+    """Tests for the concurrent project executor."""
+
+    def setUp(self):
+        self.output = output = []
+        stream = mock.Mock()
+        stream.write = lambda *args: output.append((args[0] % args[1:]).strip())
+        stream.flush = lambda:None
+        self.handler = logging.StreamHandler(stream)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger('gitctl.test.executor')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_run__results_in_order(self):
+        import time
+        def func(proj, log):
+            # Make the earlier projects finish last
+            time.sleep(0.01 * (5 - proj))
+            log.info('project %s', proj)
+            return proj * 2
+        results = gitctl.executor.run(func, range(5), jobs=5, logger=self.logger)
+        self.assertEquals([0, 2, 4, 6, 8], results)
+        self.assertEquals(['project 0', 'project 1', 'project 2', 'project 3', 'project 4'], self.output)
+
+    def test_run__exception_is_reraised(self):
+        def func(proj, log):
+            log.info('project %s', proj)
+            if proj == 1:
+                raise ValueError(proj)
+        self.assertRaises(ValueError, lambda: gitctl.executor.run(func, range(2), jobs=2, logger=self.logger))
+        self.assertEquals(['project 0', 'project 1'], self.output)
+
+    def test_run__after(self):
+        import time
+        started = []
+        def func(proj, log):
+            started.append(proj)
+            if proj == 3:
+                time.sleep(0.05)
+            log.info('project %s', proj)
+        # Project 0 waits for project 3 but is still reported first
+        gitctl.executor.run(func, range(4), jobs=1, logger=self.logger, after=lambda proj: proj == 0 and 3 or None)
+        self.assertEquals([1, 2, 3, 0], started)
+        self.assertEquals(['project 0', 'project 1', 'project 2', 'project 3'], self.output)
+        del started[:]
+        gitctl.executor.run(func, range(4), jobs=4, logger=self.logger, after=lambda proj: proj == 0 and 3 or None)
+        self.failUnless(started.index(3) < started.index(0))
+
+    def test_run__no_projects(self):
+        self.assertEquals([], gitctl.executor.run(lambda proj, log: proj, [], jobs=4))
+
+    def test_project_log__flush(self):
+        log = gitctl.executor.ProjectLog()
+        log.info('%s info', 'foo')
+        log.debug('debug')
+        log.warning('warning')
+        log.flush(self.logger)
+        self.assertEquals(['foo info', 'warning'], self.output)
+        self.assertEquals([], log.records)
+
+class TestBackend(unittest.TestCase):
+    """Tests for the git backend."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = git.Git(self.path)
+        self.repo.init()
+        open(join(self.path, 'foobar.py'), 'w').write('import sha')
+        self.repo.add('foobar.py')
+        self.repo.commit('-m', 'first commit')
+        self.repo.branch('other')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_version(self):
+        self.assertEquals((2, 39, 5), gitctl.backend.parse_version('git version 2.39.5\n'))
+        self.assertEquals((2, 35), gitctl.backend.parse_version('git version 2.35.GIT'))
+        self.assertEquals((2, 24, 3), gitctl.backend.parse_version('git version 2.24.3 (Apple Git-128)'))
+        self.assertEquals(None, gitctl.backend.parse_version('unknown'))
+        self.failUnless(gitctl.backend.version() >= gitctl.backend.MIN_VERSION)
+
+    def test_git__result(self):
+        result = gitctl.backend.git(self.path, 'rev-parse', 'HEAD')
+        self.failUnless(result.ok)
+        self.assertEquals(self.repo.rev_parse('HEAD').strip(), result.stdout.strip())
+        result = gitctl.backend.git(self.path, 'rev-parse', 'no-such-rev')
+        self.failIf(result.ok)
+        self.failUnless(len(result.stderr) > 0)
+
+    def test_call__raises_on_failure(self):
+        repository = gitctl.backend.Repository(self.path)
+        self.assertRaises(gitctl.backend.GitError, lambda: repository.call('rev-parse', 'no-such-rev'))
+
+    def test_run_many(self):
+        calls = [(self.path, ('rev-parse', 'HEAD')),
+                 (self.path, ('rev-parse', 'no-such-rev')),
+                 (self.path, ('log', '--pretty=%s'))] * 5
+        results = gitctl.backend.run_many(calls, limit=4)
+        self.assertEquals(15, len(results))
+        for i in range(5):
+            self.assertEquals(self.repo.rev_parse('HEAD').strip(), results[i * 3].stdout.strip())
+            self.failIf(results[i * 3 + 1].ok)
+            self.assertEquals('first commit\n', results[i * 3 + 2].stdout)
+
+    def test_run_many__high_fds(self):
+        # Push the pipes of the git processes above FD_SETSIZE
+        fds = [os.open(os.devnull, os.O_RDONLY) for i in range(1100)]
+        try:
+            results = gitctl.backend.run_many([(self.path, ('rev-parse', 'HEAD'))] * 3)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.assertEquals([self.repo.rev_parse('HEAD').strip()] * 3, [result.stdout.strip() for result in results])
+
+    def test_max_processes(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+        try:
+            self.assertEquals(48, gitctl.backend.max_processes())
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_state__dirty(self):
+        repository = gitctl.backend.Repository(self.path)
+        self.failIf(repository.state().dirty)
+        open(join(self.path, 'foobar.py'), 'w').write('import md5')
+        self.failUnless(repository.state().dirty)
+        self.repo.add('foobar.py')
+        self.failUnless(repository.state().dirty)
+
+    def test_active_branch(self):
+        repository = gitctl.backend.Repository(self.path)
+        self.assertEquals('master', repository.active_branch())
+        self.repo.checkout(self.repo.rev_parse('HEAD').strip())
+        self.assertEquals(None, repository.active_branch())
+
+    def test_branches(self):
+        repository = gitctl.backend.Repository(self.path)
+        self.assertEquals(set(['master', 'other']), repository.branches())
+        self.assertEquals(set(), repository.branches(remote=True))
+
+    def test_refs__packed_and_loose(self):
+        repository = gitctl.backend.Repository(self.path)
+        head = self.repo.rev_parse('HEAD').strip()
+        self.repo.tag('-a', '-m', 'annotated', 'v1')
+        self.repo.pack_refs('--all')
+        open(join(self.path, 'foobar.py'), 'w').write('import md5')
+        self.repo.commit('-a', '-m', 'second commit')
+        second = self.repo.rev_parse('HEAD').strip()
+        self.repo.symbolic_ref('refs/remotes/origin/HEAD', 'refs/heads/other')
+
+        refs = repository.refs()
+        self.assertEquals(second, refs['refs/heads/master'])
+        self.assertEquals(head, refs['refs/heads/other'])
+        self.assertEquals(self.repo.rev_parse('v1').strip(), refs['refs/tags/v1'])
+        self.assertEquals(head, refs['refs/remotes/origin/HEAD'])
+        self.assertEquals(set(['origin/HEAD']), repository.branches(remote=True))
+        for rev in ('HEAD', 'master', 'other', 'v1', 'origin', 'refs/heads/other', head):
+            self.assertEquals(self.repo.rev_parse(rev).strip(), repository.rev_parse(rev))
+        # Expressions are left to git
+        self.assertEquals(head, repository.rev_parse('master^'))
+
+    def test_refs__cache(self):
+        repository = gitctl.backend.Repository(self.path)
+        gitctl.refs.clear_cache()
+        # Refs modified just now are re-read every time
+        past = time.time() - 10
+        for dirpath, dirnames, filenames in os.walk(join(self.path, '.git', 'refs')):
+            os.utime(dirpath, (past, past))
+        refs = repository.refs()
+        self.failUnless(refs is repository.refs())
+        # Creating a branch renames a lock file into place
+        self.repo.branch('third')
+        self.failIf(refs is repository.refs())
+        self.failUnless('refs/heads/third' in repository.refs())
+
+    def test_parse_status(self):
+        output = '\n'.join([
+                '# branch.oid 4d1f3e8b4d1f3e8b4d1f3e8b4d1f3e8b4d1f3e8b',
+                '# branch.head development',
+                '# branch.upstream origin/development',
+                '# branch.ab +2 -3',
+                '1 .M N... 100644 100644 100644 abc abc foobar.py',
+                '? new.py',
+                '? other.py'])
+        self.assertEquals(dict(head='4d1f3e8b4d1f3e8b4d1f3e8b4d1f3e8b4d1f3e8b', branch='development',
+                               upstream='origin/development', ahead=2, behind=3,
+                               staged=False, unstaged=True, untracked=2),
+                          gitctl.backend.parse_status(output))
+        fields = gitctl.backend.parse_status('# branch.oid (initial)\n# branch.head (detached)\n'
+                                             'u UU N... 100644 100644 100644 100644 a b c foobar.py\n')
+        self.assertEquals((None, None, True, True), (fields['head'], fields['branch'], fields['staged'], fields['unstaged']))
+
+    def test_rev_parse__unknown(self):
+        repository = gitctl.backend.Repository(self.path)
+        self.assertRaises(gitctl.backend.GitError, lambda: repository.rev_parse('no-such-rev'))
+
+class TestGitConfig(unittest.TestCase):
+    """Tests for the git configuration parser."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = git.Git(self.path)
+        self.repo.init()
+        self.repository = gitctl.backend.Repository(self.path)
+        self.config = join(self.path, '.git', 'config')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def git_config(self):
+        output = self.repo.config('--local', '--includes', '--null', '--list')
+        return [tuple(entry.split('\n', 1)) for entry in output.split('\0') if entry]
+
+    def test_parse(self):
+        data = '\n'.join([
+                '# comment',
+                '[Core]',
+                '\tBare = false ; comment',
+                '[remote "Origin"]',
+                '\turl = "git://example.com/a b.git"  # comment',
+                '\tpushurl = one  two \\',
+                '\t  three',
+                '\tescaped = "quote \\" and \\\\ \\t"',
+                '\tflag',
+                '[branch.Master]',
+                'merge=refs/heads/master'])
+        self.assertEquals([('core.bare', 'false'),
+                           ('remote.Origin.url', 'git://example.com/a b.git'),
+                           ('remote.Origin.pushurl', 'one  two    three'),
+                           ('remote.Origin.escaped', 'quote " and \\ \t'),
+                           ('remote.Origin.flag', None),
+                           ('branch.master.merge', 'refs/heads/master')],
+                          gitctl.gitconfig.parse(data))
+
+    def test_parse__invalid(self):
+        for data in ('[core\n', 'bare = true\n', '[core]\n\tname = "unterminated\n', '[core]\n\tname = \\q\n'):
+            self.assertRaises(gitctl.gitconfig.ConfigError, lambda: gitctl.gitconfig.parse(data))
+
+    def test_read_config__matches_git(self):
+        open(join(self.path, 'included'), 'w').write('[remote "included"]\n\turl = /tmp/included\n')
+        open(join(self.path, 'branch'), 'w').write('[remote "onbranch"]\n\turl = /tmp/onbranch\n')
+        open(join(self.path, 'skipped'), 'w').write('[remote "skipped"]\n\turl = /tmp/skipped\n')
+        self.repo.config('include.path', '../included')
+        self.repo.config('includeIf.gitdir:%s/.path' % self.path, '../branch')
+        self.repo.config('includeIf.onbranch:no-such-branch.path', '../skipped')
+        self.repo.config('remote.origin.url', 'git://example.com/repo.git')
+        self.repo.config('branch.master.remote', 'origin')
+        items = gitctl.gitconfig.read_config(self.repository.git_dir, self.repository.common_dir)
+        self.assertEquals(self.git_config(), [(key, value) for key, value in items])
+        self.failUnless(('remote.onbranch.url', '/tmp/onbranch') in items)
+        self.failIf(('remote.skipped.url', '/tmp/skipped') in items)
+
+    def test_read_config__unsupported(self):
+        self.repo.config('includeIf.hasconfig:remote.*.url:foo.path', 'other')
+        self.repo.config('remote.origin.url', 'git://example.com/repo.git')
+        self.assertEquals(None, gitctl.gitconfig.read_config(self.repository.git_dir, self.repository.common_dir))
+        self.failUnless(('remote.origin.url', 'git://example.com/repo.git') in self.repository.config())
+
+    def test_read_config__cache(self):
+        gitctl.gitconfig.clear_cache()
+        past = time.time() - 10
+        os.utime(self.config, (past, past))
+        items = self.repository.config()
+        self.failUnless(items is self.repository.config())
+        self.repo.config('remote.origin.url', 'git://example.com/repo.git')
+        self.failUnless(('remote.origin.url', 'git://example.com/repo.git') in self.repository.config())
+
+    def test_wildmatch(self):
+        regex = gitctl.gitconfig.wildmatch('**/work/**')
+        self.failUnless(regex.match('/home/user/work/project/.git'))
+        self.failIf(regex.match('/home/user/workspace/project/.git'))
+        self.failUnless(gitctl.gitconfig.wildmatch('feature/*').match('feature/foo'))
+        self.failIf(gitctl.gitconfig.wildmatch('feature/*').match('feature/foo/bar'))
+        self.failUnless(gitctl.gitconfig.wildmatch('/Work/', True).match('/work/'))
+
+class TestIndex(unittest.TestCase):
+    """Tests for the index reader."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = git.Git(self.path)
+        self.repo.init()
+        os.mkdir(join(self.path, 'package'))
+        self.names = ['foobar.py', 'package/%s.py' % ('x' * 200), 'package/module.py']
+        for name in self.names:
+            open(join(self.path, name), 'w').write('import sha')
+        os.symlink('foobar.py', join(self.path, 'link'))
+        self.names = sorted(self.names + ['link'])
+        self.repo.add('.')
+        self.repo.commit('-m', 'first commit')
+        self.repository = gitctl.backend.Repository(self.path)
+        self.index = join(self.path, '.git', 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def age(self):
+        """Makes the stat data of the files trustworthy."""
+        past = time.time() - 100
+        for name in self.names:
+            subprocess.check_call(['touch', '-h', '-d', '@%d' % past, os.path.join(self.path, name)])
+        self.repo.update_index('--refresh')
+        os.utime(self.index, (past + 90, past + 90))
+
+    def test_read_entries(self):
+        self.assertEquals(self.names, [entry[0] for entry in gitctl.index.read_entries(self.index)])
+        self.repo.update_index('--skip-worktree', 'foobar.py')
+        entries = gitctl.index.read_entries(self.index)
+        self.assertEquals(self.names, [entry[0] for entry in entries])
+        self.failUnless(entries[0][3] & gitctl.index.FLAG_SKIP_WORKTREE)
+        self.repo.update_index('--index-version', '4')
+        self.assertEquals(self.names, [entry[0] for entry in gitctl.index.read_entries(self.index)])
+
+    def test_read_entries__invalid(self):
+        open(self.index, 'w').write('')
+        self.assertRaises(gitctl.index.IndexFormatError, lambda: gitctl.index.read_entries(self.index))
+        open(self.index, 'w').write('DIRC' + '\0' * 40)
+        self.assertRaises(gitctl.index.IndexFormatError, lambda: gitctl.index.read_entries(self.index))
+
+    def test_stat_changes(self):
+        entries = gitctl.index.read_entries(self.index)
+        newest = max(entry[1][2] for entry in entries)
+        # Files modified in the same second as the index are racily clean.
+        os.utime(self.index, (newest, newest))
+        self.assertEquals([entry[0] for entry in entries if entry[1][2] == newest],
+                          gitctl.index.stat_changes(self.repository))
+        os.utime(self.index, (newest + 1, newest + 1))
+        self.assertEquals([], gitctl.index.stat_changes(self.repository))
+        self.age()
+        self.assertEquals([], gitctl.index.stat_changes(self.repository))
+        self.failIf(self.repository.state().unstaged)
+        # Touching a file is not a change
+        os.utime(join(self.path, 'foobar.py'), None)
+        self.assertEquals(['foobar.py'], gitctl.index.stat_changes(self.repository))
+        self.failIf(self.repository.state().unstaged)
+        open(join(self.path, 'package', 'module.py'), 'w').write('import md5')
+        self.failUnless(self.repository.state().unstaged)
+        os.remove(join(self.path, 'package', 'module.py'))
+        self.assertEquals(['foobar.py', 'package/module.py'], gitctl.index.stat_changes(self.repository))
+        self.failUnless(self.repository.state().dirty)
+
+    def test_stat_changes__unmerged(self):
+        self.repo.checkout('-b', 'other')
+        open(join(self.path, 'foobar.py'), 'w').write('import other')
+        self.repo.commit('-a', '-m', 'other')
+        self.repo.checkout('master')
+        open(join(self.path, 'foobar.py'), 'w').write('import master')
+        self.repo.commit('-a', '-m', 'master')
+        self.assertRaises(git.GitCommandError, lambda: self.repo.merge('other'))
+        self.assertEquals(None, gitctl.index.stat_changes(self.repository))
+        self.failUnless(self.repository.state().dirty)
+
+    def test_state__staged(self):
+        self.age()
+        self.failIf(self.repository.state().staged)
+        self.failUnless(os.path.exists(gitctl.index.stamp_path(self.repository)))
+        # The stamp answers without git
+        self.repository.git = None
+        self.failIf(self.repository.state().dirty)
+        del self.repository.git
+
+        open(join(self.path, 'foobar.py'), 'w').write('import md5')
+        self.repo.add('foobar.py')
+        self.failUnless(self.repository.state().staged)
+        self.repo.commit('-m', 'second commit')
+        self.failIf(self.repository.state().staged)
+
+    def test_state__changed_paths(self):
+        self.age()
+        self.repository.state()
+        open(join(self.path, 'package', 'module.py'), 'w').write('import md5')
+        # Only the changed file is passed to git status
+        call = mock.Mock(wraps=self.repository.call)
+        self.repository.call = call
+        self.failUnless(self.repository.state().unstaged)
+        args = call.call_args[0]
+        self.assertEquals(('--', 'package/module.py'), args[-2:])
+        self.failUnless('--literal-pathspecs' in args)
+
+    def test_state(self):
+        self.age()
+        head = self.repo.rev_parse('HEAD').strip()
+        state = self.repository.state()
+        self.assertEquals((head, 'master', False, False), (state.head, state.branch, state.staged, state.unstaged))
+        self.assertEquals(set(['master']), state.branches())
+        # The index is now known to match HEAD and the state is read without git.
+        self.repository.git = None
+        state = self.repository.state()
+        self.assertEquals((head, 'master', False), (state.head, state.branch, state.dirty))
+        del self.repository.git
+
+        open(join(self.path, 'foobar.py'), 'w').write('import md5')
+        state = self.repository.state()
+        self.assertEquals((False, True), (state.staged, state.unstaged))
+        self.repo.add('foobar.py')
+        open(join(self.path, 'new.py'), 'w').write('')
+        state = self.repository.state(untracked=True)
+        self.assertEquals((True, False, 1), (state.staged, state.unstaged, state.untracked))
+        self.assertEquals(None, self.repository.state().untracked)
+
+class TestCommitGraph(unittest.TestCase):
+    """Tests for the commit-graph reader."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = git.Git(self.path)
+        self.repo.init()
+        for branch, count in (('master', 3), ('feature', 2), ('other', 4)):
+            if branch != 'master':
+                self.repo.checkout('-b', branch, 'master~1')
+            self.commit(branch, count)
+        self.repo.checkout('master')
+        # An octopus merge has its parents in the EDGE chunk
+        self.repo.merge('--no-ff', '-m', 'merge', 'feature', 'other')
+        self.repository = gitctl.backend.Repository(self.path)
+        self.tips = ['master', 'feature', 'other', 'master~1', 'other~2']
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def commit(self, branch, count):
+        for i in range(count):
+            open(join(self.path, branch), 'w').write(str(i))
+            self.repo.add(branch)
+            self.repo.commit('-m', '%s %s' % (branch, i))
+
+    def check(self, graph):
+        """Compares the answers of the graph with git."""
+        for line in self.repo.rev_list('--parents', '--all').splitlines():
+            commits = line.split()
+            self.assertEquals(commits[1:], [graph.sha1(p) for p in graph.parents(graph.lookup(commits[0]))])
+        sha1s = [self.repository.rev_parse(tip) for tip in self.tips]
+        positions = [graph.lookup(sha1) for sha1 in sha1s]
+        for one, one_position in zip(sha1s, positions):
+            for two, two_position in zip(sha1s, positions):
+                expected = self.repository.git('merge-base', '--is-ancestor', one, two).status == 0
+                self.assertEquals(expected, graph.is_ancestor(one_position, two_position))
+        commit_graph = gitctl.wtf.CommitGraph(self.repository, self.tips)
+        for from_ in self.tips:
+            for to in self.tips:
+                expected = int(self.repo.rev_list('--count', '%s..%s' % (from_, to)))
+                self.assertEquals(expected, commit_graph.count(from_, to), '%s..%s' % (from_, to))
+
+    def test_load(self):
+        self.assertEquals(None, gitctl.commitgraph.load(self.repository))
+        self.repo.commit_graph('write', '--reachable')
+        graph = gitctl.commitgraph.load(self.repository)
+        self.assertEquals(len(self.repo.rev_list('--all').split()), graph.layers[0].count)
+        self.failUnless(graph is gitctl.commitgraph.load(self.repository))
+        self.assertEquals(None, graph.lookup('0' * 40))
+        self.check(graph)
+
+    def test_load__split(self):
+        self.repo.commit_graph('write', '--reachable', '--split')
+        self.commit('master', 2)
+        self.repo.commit_graph('write', '--reachable', '--split=no-merge')
+        graph = gitctl.commitgraph.load(self.repository)
+        self.assertEquals(2, len(graph.layers))
+        self.tips.append('master~2')
+        self.check(graph)
+
+    def test_load__unusable(self):
+        self.repo.commit_graph('write', '--reachable')
+        self.repo.replace('other', 'feature')
+        self.assertEquals(None, gitctl.commitgraph.load(self.repository))
+
+    def test_commit_graph__without_git(self):
+        self.repo.commit_graph('write', '--reachable')
+        expected = int(self.repo.rev_list('--count', 'feature..other'))
+        base = self.repo.rev_parse('master~2').strip()
+        self.repository.git = self.repository.call = None
+        graph = gitctl.wtf.CommitGraph(self.repository, ['master', 'feature', 'other'])
+        self.assertEquals(expected, graph.count('feature', 'other'))
+        self.failUnless(self.repository.is_ancestor(base, 'other'))
+        self.failIf(self.repository.is_ancestor('other', 'feature'))
+
+    def test_commit_graph__outside_graph(self):
+        self.repo.commit_graph('write', '--reachable')
+        self.commit('master', 2)
+        self.tips.append('master~2')
+        graph = gitctl.commitgraph.load(self.repository)
+        self.assertEquals(None, graph.lookup(self.repository.rev_parse('master')))
+        commit_graph = gitctl.wtf.CommitGraph(self.repository, self.tips)
+        self.assertEquals(2, commit_graph.count('master~2', 'master'))
+        self.failUnless(self.repository.is_ancestor('other', 'master'))
+
+class TestFetch(unittest.TestCase):
+    """Tests for the fetch helpers."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        git.Git(self.path).init()
+        self.repository = gitctl.backend.Repository(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_is_fresh__never_fetched(self):
+        self.failIf(gitctl.fetch.is_fresh(self.repository, 'origin', 3600))
+        self.assertEquals(None, gitctl.fetch.last_fetched(self.repository, 'origin'))
+
+    def test_is_fresh(self):
+        gitctl.fetch.mark_fetched(self.repository, 'origin')
+        self.failUnless(gitctl.fetch.is_fresh(self.repository, 'origin', 3600))
+        self.failIf(gitctl.fetch.is_fresh(self.repository, 'origin', 0))
+        self.failIf(gitctl.fetch.is_fresh(self.repository, 'upstream', 3600))
+
+    def test_is_fresh__expired(self):
+        gitctl.fetch.mark_fetched(self.repository, 'origin')
+        stamp = gitctl.fetch.stamp_path(self.repository, 'origin')
+        os.utime(stamp, (os.path.getatime(stamp), os.path.getmtime(stamp) - 120))
+        self.failIf(gitctl.fetch.is_fresh(self.repository, 'origin', 60))
+        self.failUnless(gitctl.fetch.is_fresh(self.repository, 'origin', 600))
+
+    def test_upstream_name(self):
+        self.assertEquals('my.project', gitctl.fetch.upstream_name('git@myserver.com:my.project.git'))
+        self.assertEquals('my.project', gitctl.fetch.upstream_name('/srv/git/my.project.git/'))
+        self.assertEquals('my.project', gitctl.fetch.upstream_name('ssh://myserver.com/my.project'))
+
+    def test_manifest_location(self):
+        self.assertEquals((None, '/srv/git/manifest.log'), gitctl.fetch.manifest_location('/srv/git/manifest.log'))
+        self.assertEquals(('git@myserver.com', 'manifest.log'), gitctl.fetch.manifest_location('git@myserver.com:manifest.log'))
+
+    def test_manifest__unchanged(self):
+        data = '1 foo refs/heads/a 0 1\n2 bar refs/heads/a 0 1\n'
+        manifest = gitctl.fetch.Manifest(data)
+        # Never synced
+        self.failIf(manifest.unchanged(self.repository, 'origin', 'foo'))
+        manifest.mark_synced(self.repository, 'origin')
+        self.failUnless(manifest.unchanged(self.repository, 'origin', 'foo'))
+        self.failUnless(manifest.unchanged(self.repository, 'origin', 'baz'))
+        manifest = gitctl.fetch.Manifest(data + '3 foo refs/heads/a 1 2\n')
+        self.failIf(manifest.unchanged(self.repository, 'origin', 'foo'))
+        self.failUnless(manifest.unchanged(self.repository, 'origin', 'bar'))
+        # A truncated manifest is not trusted
+        manifest = gitctl.fetch.Manifest('')
+        self.failIf(manifest.unchanged(self.repository, 'origin', 'bar'))
+
+    def test_refspecs__full(self):
+        config = {'fetch-policy' : 'full', 'fetch-tags' : False, 'branches' : []}
+        self.assertEquals(((), ('+refs/heads/*:refs/remotes/origin/*',)),
+                          gitctl.fetch.refspecs(config, 'refs/remotes/origin'))
+        self.assertEquals((), gitctl.fetch.policy_options(config))
+
+    def test_refspecs__narrow(self):
+        config = {'fetch-policy' : 'narrow', 'fetch-tags' : False,
+                  'branches' : [('origin/development', 'development'), ('origin/production', 'production')]}
+        self.assertEquals((('--prune', '--no-tags'),
+                           ('+refs/heads/development:refs/remotes/origin/development',
+                            '+refs/heads/production:refs/remotes/origin/production')),
+                          gitctl.fetch.refspecs(config, 'refs/remotes/origin'))
+        config['fetch-tags'] = True
+        self.assertEquals(('--prune',), gitctl.fetch.refspecs(config, 'refs/remotes/origin')[0])
+        self.assertEquals(('-c', 'protocol.version=2'), gitctl.fetch.policy_options(config))
+
+    def test_mirror_path(self):
+        path = gitctl.mirror.mirror_path('/cache', 'git@myserver.com:my.project.git')
+        self.assertEquals('/cache', os.path.dirname(path))
+        self.failUnless(path.endswith('.git'))
+        self.failIfEqual(path, gitctl.mirror.mirror_path('/cache', 'git@myserver.com:other.git'))
+
+    def test_mirror_cache__failed_clone(self):
+        cache = tempfile.mkdtemp()
+        url = 'git@myserver.com:my.project.git'
+        failures = [gitctl.backend.Result(128, '', 'fatal: the remote end hung up'), KeyboardInterrupt()]
+        def clone(path, *args):
+            # The clone fails after creating the temporary mirror
+            os.mkdir(args[-1])
+            failure = failures.pop(0)
+            if isinstance(failure, BaseException):
+                raise failure
+            return failure
+        git = gitctl.backend.git
+        gitctl.backend.git = clone
+        try:
+            self.assertEquals(None, gitctl.mirror.MirrorCache(cache).get(url))
+            self.assertEquals([], os.listdir(cache))
+            self.assertRaises(KeyboardInterrupt, lambda: gitctl.mirror.MirrorCache(cache).get(url))
+            self.assertEquals([], os.listdir(cache))
+        finally:
+            gitctl.backend.git = git
+            shutil.rmtree(cache)
+
+    def test_fetch_ttl(self):
+        args = mock.Mock()
+        args.fetch_ttl = None
+        self.assertEquals(300, gitctl.fetch.fetch_ttl(args, {'fetch-ttl' : 300}))
+        args.fetch_ttl = 0
+        self.assertEquals(0, gitctl.fetch.fetch_ttl(args, {'fetch-ttl' : 300}))
 
 def test_suite():
     return unittest.TestSuite([
@@ -1008,8 +2551,21 @@ def test_suite():
             unittest.makeSuite(TestCommandSh),
             unittest.makeSuite(TestCommandPending),
             unittest.makeSuite(TestCommandFetch),
+            unittest.makeSuite(TestCommandPrefetch),
+            unittest.makeSuite(TestCommandFetchManifest),
+            unittest.makeSuite(TestCommandDedupe),
+            unittest.makeSuite(TestCommandBundle),
+            unittest.makeSuite(TestCommandExport),
+            unittest.makeSuite(TestCommandWorktree),
+            unittest.makeSuite(TestCommandMaintenance),
             unittest.makeSuite(TestCommandUpdate),
             unittest.makeSuite(TestCommandBranch),
             unittest.makeSuite(TestUtils),
             unittest.makeSuite(TestWTF),
+            unittest.makeSuite(TestExecutor),
+            unittest.makeSuite(TestBackend),
+            unittest.makeSuite(TestGitConfig),
+            unittest.makeSuite(TestIndex),
+            unittest.makeSuite(TestCommitGraph),
+            unittest.makeSuite(TestFetch),
             ])
@@ -15,6 +15,9 @@ from ConfigParser import SafeConfigParser
 LOG = logging.getLogger('gitctl')
 RE_SHA1_CHECKSUM = re.compile(r'^[a-fA-F0-9]{40}$')
 
+# The default of the ``maintenance-tasks`` option
+DEFAULT_TASKS = ('incremental-repack', 'multi-pack-index', 'commit-graph', 'untracked-cache')
+
 def is_sha1(treeish):
     """Returns True if the given treeish looks like a SHA1 sum, False
     otherwise
@@ -51,7 +54,15 @@ def run(command, cwd=None):
 
 def parse_config(configs):
     """Parses the gitctl config file."""
-    parser = SafeConfigParser({'upstream' : 'origin'})
+    parser = SafeConfigParser({'upstream' : 'origin',
+                               'fetch-ttl' : '300',
+                               'fetch-policy' : 'full',
+                               'fetch-tags' : 'false',
+                               'manifest' : '',
+                               'mirror-cache' : '',
+                               'mirror-dissociate' : 'false',
+                               'artifact-cache' : '',
+                               'maintenance-tasks' : ' '.join(DEFAULT_TASKS)})
     if len(parser.read(configs)) == 0:
         raise ValueError('Invalid config file(s): %s' % ', '.join(configs))
     
@@ -59,6 +70,9 @@ def parse_config(configs):
         raise ValueError('The [gitctl] section is missing')
     
     upstream = parser.get('gitctl', 'upstream')
+    fetch_policy = parser.get('gitctl', 'fetch-policy').strip()
+    if fetch_policy not in ('full', 'narrow'):
+        raise ValueError('Invalid fetch-policy: %s. Supported policies are "full" and "narrow".' % fetch_policy)
     return {'upstream' : upstream,
             'upstream-url' : parser.get('gitctl', 'upstream-url'),
             'commit-email' : parser.get('gitctl', 'commit-email'),
@@ -69,6 +83,14 @@ def parse_config(configs):
             'staging-branch' : parser.get('gitctl', 'staging-branch'),
             'development-branch' : parser.get('gitctl', 'development-branch'),
             'production-branch' : parser.get('gitctl', 'production-branch'),
+            'fetch-ttl' : parser.getint('gitctl', 'fetch-ttl'),
+            'fetch-policy' : fetch_policy,
+            'fetch-tags' : parser.getboolean('gitctl', 'fetch-tags'),
+            'manifest' : parser.get('gitctl', 'manifest').strip() or None,
+            'mirror-cache' : parser.get('gitctl', 'mirror-cache').strip() or None,
+            'mirror-dissociate' : parser.getboolean('gitctl', 'mirror-dissociate'),
+            'artifact-cache' : parser.get('gitctl', 'artifact-cache').strip() or None,
+            'maintenance-tasks' : parser.get('gitctl', 'maintenance-tasks').split(),
             }
 
 def parse_externals(config):
@@ -80,22 +102,35 @@ def parse_externals(config):
 
     projects = []
     for sec in parser.sections():
-        if not parser.has_option(sec, 'url'):
+        if not parser.has_option(sec, 'url') and not parser.has_option(sec, 'worktree-of'):
             LOG.critical('Section %s is missing the ``url`` option in the externals configuration', sec)
             sys.exit(1)
        
         proj = {
            'name' : sec.strip(),
-           'url' : parser.get(sec, 'url').strip(),
            'type' : parser.get(sec, 'type').strip(),
            'container' : parser.get(sec, 'container').strip(),
            }
+        if parser.has_option(sec, 'url'):
+            proj['url'] = parser.get(sec, 'url').strip()
+        if parser.has_option(sec, 'worktree-of'):
+            proj['worktree-of'] = parser.get(sec, 'worktree-of').strip()
 
         if proj['type'] not in ('git', 'git-svn'):
             raise ValueError('Invalid type: %s. Supported types are "git" and "git-svn".' % proj['type'])
 
         if proj['type'] == 'git':
             proj['treeish'] = parser.get(sec, 'treeish').strip()
+            if parser.has_option(sec, 'depth'):
+                proj['depth'] = parser.getint(sec, 'depth')
+                if proj['depth'] < 1:
+                    raise ValueError('Invalid depth: %s. The depth must be a positive integer.' % proj['depth'])
+            if parser.has_option(sec, 'filter'):
+                proj['filter'] = parser.get(sec, 'filter').strip()
+            if parser.has_option(sec, 'single-branch'):
+                proj['single-branch'] = parser.getboolean(sec, 'single-branch')
+            if parser.has_option(sec, 'sparse'):
+                proj['sparse'] = parser.get(sec, 'sparse').split()
         elif proj['type'] == 'git-svn':
             for opt in 'svn-trunk', 'svn-tags', 'svn-branches':
                 if parser.has_option(sec, opt):
@@ -105,16 +140,79 @@ def parse_externals(config):
 
         projects.append(proj)
     
+    # Worktrees share the repository of their primary project
+    primaries = dict((proj['name'], proj) for proj in projects if 'worktree-of' not in proj)
+    for proj in projects:
+        if 'worktree-of' not in proj:
+            continue
+        primary = primaries.get(proj['worktree-of'])
+        if primary is None or primary['type'] != 'git' or proj['type'] != 'git':
+            raise ValueError('Invalid worktree-of: %s. It must name a git project that is not a worktree itself.' % proj['worktree-of'])
+        proj.setdefault('url', primary['url'])
     
     return sorted(projects, key=itemgetter('name'))
 
+def primary_project(proj, projects):
+    """Returns the primary project of the worktree project ``proj`` if it is
+    among ``projects``, otherwise None.
+    """
+    if 'worktree-of' not in proj:
+        return None
+    for primary in projects:
+        if primary['name'] == proj['worktree-of']:
+            return primary
+    return None
+
+def fetched_with_primary(proj, projects):
+    """Returns True if the project is a worktree whose primary project is
+    among ``projects`` and is fetched with it.
+    """
+    return 'worktree-of' in proj and proj['worktree-of'] in set(p['name'] for p in projects)
+
+def same_sparse_patterns(configured, listed):
+    """Returns True if the sparse checkout patterns of the externals
+    configuration match the ones ``git sparse-checkout list`` printed, which
+    are sorted and have the trailing slashes removed. None stands for a
+    working directory that is not sparse.
+    """
+    if configured is None or listed is None:
+        return configured is None and listed is None
+    return set(p.rstrip('/') for p in configured) == set(p.rstrip('/') for p in listed)
+
+def clone_options(proj):
+    """Returns the git clone options for the shallow and partial clone
+    settings of the project.
+    """
+    options = fetch_options(proj)
+    if 'single-branch' in proj:
+        # A shallow clone is single branch by default.
+        options += (proj['single-branch'] and '--single-branch' or '--no-single-branch',)
+        if proj['single-branch'] and not is_sha1(proj['treeish']):
+            options += ('--branch', proj['treeish'])
+    return options
+
+def fetch_options(proj):
+    """Returns the git fetch options for the shallow and partial clone
+    settings of the project.
+    """
+    options = ()
+    if 'depth' in proj:
+        options += ('--depth', str(proj['depth']))
+    if 'filter' in proj:
+        options += ('--filter=%s' % proj['filter'],)
+    return options
+
 def generate_externals(projects):
     """Generates an externals configuration file."""
     ext = StringIO()
     for project in projects:
         print >> ext, '[%s]' % project.pop('name')
         for key, value in project.iteritems():
-            print >> ext, '%s = %s' % (key, value)
+            if isinstance(value, list):
+                # Multi-line value, one item per line
+                print >> ext, '%s =%s' % (key, ''.join('\n    %s' % item for item in value))
+            else:
+                print >> ext, '%s = %s' % (key, value)
         print >> ext
 
     return ext.getvalue().strip()
@@ -4,43 +4,51 @@ This module is an adaptation of the ``git-wtf`` Ruby script written by William
 Morgan and contributors (see http://git-wt-commit.rubyforge.org/#git-wtf).
 """
 import re
+import time
 
-RE_CONFIG_REMOTE_URL = re.compile(r'^remote\.([^.]+)\.url (.+)$')
-RE_CONFIG_REMOTE_BRANCH = re.compile(r'branch\.([^.]*)\.remote (.+)')
-RE_CONFIG_REMOTE_MERGE = re.compile(r'branch\.([^.]*)\.merge (?:(?:refs/)?heads/)?(.+)')
+import gitctl.commitgraph
+
+RE_CONFIG_REMOTE_URL = re.compile(r'^remote\.(.+)\.url$')
+RE_CONFIG_REMOTE_BRANCH = re.compile(r'^branch\.(.+)\.remote$')
+RE_CONFIG_REMOTE_MERGE = re.compile(r'^branch\.(.+)\.merge$')
+RE_MERGE_BRANCH = re.compile(r'^(?:(?:refs/)?heads/)?(.+)$')
 
 RE_REF_LOCAL_BRANCH = re.compile(r'^heads/(.+)$')
 RE_REF_REMOTE_BRANCH = re.compile(r'^remotes/([^/]+)/(.+)$')
 
-def branch_structure(repository):
+def branch_structure(repository, refs=None):
     """Returns a dictionary containing information about the branch structure
-    in the given ``repository``.
+    in the given ``repository`` (a ``gitctl.backend.Repository``). The refs
+    are read from the repository unless given.
     """
+    if refs is None:
+        refs = repository.refs()
+    config = [(key, value.strip()) for key, value in repository.config() if value and value.strip()]
+
     # A mapping of remote names to remote URLs
     remote_urls = {}
-    for line in repository.git.config('--get-regexp', '^remote.*.url', with_exceptions=False).splitlines():
-        match = RE_CONFIG_REMOTE_URL.search(line.strip())
+    for key, value in config:
+        match = RE_CONFIG_REMOTE_URL.search(key)
         if match is not None:
-            remote_urls[match.group(1)] = match.group(2)
+            remote_urls[match.group(1)] = value
 
     branches = {}
     # A mapping of branches that are tracked
-    for line in repository.git.config('--get-regexp', '^branch.', with_exceptions=False).splitlines():
-        remote_match = RE_CONFIG_REMOTE_BRANCH.search(line.strip())
-        
-        if remote_match is not None and remote_match.group(2) in remote_urls:
+    for key, value in config:
+        remote_match = RE_CONFIG_REMOTE_BRANCH.search(key)
+
+        if remote_match is not None and value in remote_urls:
             branches.setdefault(remote_match.group(1), {}).update(
-                remote=remote_match.group(2),
-                remote_url=remote_urls[remote_match.group(2)])
+                remote=value,
+                remote_url=remote_urls[value])
         else:
-            merge_match = RE_CONFIG_REMOTE_MERGE.search(line.strip())
+            merge_match = RE_CONFIG_REMOTE_MERGE.search(key)
             if merge_match is not None:
                 branches.setdefault(merge_match.group(1), {}).update(
-                    remote_mergepoint=merge_match.group(2))
+                    remote_mergepoint=RE_MERGE_BRANCH.search(value).group(1))
 
     # Add the rest of the branches
-    for line in repository.git.show_ref(with_exceptions=False).splitlines():
-        sha1, ref = [a.strip() for a in line.strip().split(' refs/')][:2]
+    for ref in sorted(name[len('refs/'):] for name in refs if name.startswith('refs/')):
 
         local_branch_match = RE_REF_LOCAL_BRANCH.search(ref)
         if local_branch_match is not None:
@@ -73,38 +81,225 @@ def branch_structure(repository):
     
     return branches
 
-def commits_between(repository, from_, to, verbose=True):
-    """Returns a list of commits in ``to`` that are not in ``from_``.
-    
-    If the return value is an empty list ``to`` has been merged to ``from_``.
+# Counting stops after this many commits and the count is shown as "1000+"
+COUNT_CAP = 1000
+
+def iter_commits(repository, from_, to, verbose=True, limit=None):
+    """Yields the formatted commits in ``to`` that are not in ``from_``, at
+    most ``limit`` of them. The output of ``git log`` is read as it is
+    produced.
     """
     if verbose:
         format = r'--pretty=format:* [%h] %s [%an; %ar]'
     else:
         format = r'--pretty=format:* [%h] %s'
+    options = limit is not None and ('--max-count=%s' % limit,) or ()
+
+    for line in repository.stream('log', format, *(options + ('%s..%s' % (from_, to),))):
+        if line.strip():
+            yield line.strip()
+
+def commits_between(repository, from_, to, verbose=True, limit=None):
+    """Returns a list of commits in ``to`` that are not in ``from_``, at most
+    ``limit`` of them.
     
-    return [line.strip()
-            for line
-            in repository.git.log(format, '%s..%s' % (from_, to)).splitlines()
-            if line.strip()]
+    If the return value is an empty list ``to`` has been merged to ``from_``.
+    """
+    return list(iter_commits(repository, from_, to, verbose, limit))
+
+def count_commits(repository, from_, to, cap=None):
+    """Returns the number of commits in ``to`` that are not in ``from_``
+    without listing them. With ``cap`` the counting stops after ``cap + 1``
+    commits, see ``format_count``.
+    """
+    count = None
+    graph = gitctl.commitgraph.load(repository)
+    if graph is not None:
+        positions = [graph.lookup(repository.rev_parse(rev)) for rev in (from_, to)]
+        if None not in positions:
+            try:
+                # The commits reachable from ``to`` only
+                count = graph.histogram(positions, cap is not None and (2, cap + 1) or None).get(2, 0)
+            except gitctl.commitgraph.GraphError:
+                pass
+    if count is None:
+        options = cap is not None and ('--max-count=%s' % (cap + 1),) or ()
+        count = int(repository.call('rev-list', '--count', *(options + ('%s..%s' % (from_, to),))))
+    if cap is not None:
+        count = min(count, cap + 1)
+    return count
+
+def format_count(count, cap=None):
+    """Describes a count returned by ``count_commits``."""
+    if cap is not None and count > cap:
+        return '%s+' % cap
+    return str(count)
+
+class CommitGraph(object):
+    """The ahead/behind counts between any two of a set of tips.
 
-def show_commits(commits, prefix="    ", limit=None):
-    """Displays commit information with an optional limit."""
+    The commits that are not reachable from all the tips are listed with a
+    single walk and each is tagged with the set of tips it is reachable
+    from. The number of commits in one tip that are not in another is then a
+    lookup. The walk reads the commit-graph of the repository when it
+    contains all the tips and uses ``git rev-list`` otherwise.
+    """
+
+    def __init__(self, repository, tips):
+        self.sha1s = dict((tip, repository.rev_parse(tip)) for tip in tips)
+        unique = sorted(set(self.sha1s.values()))
+        self.bits = dict((sha1, 1 << i) for i, sha1 in enumerate(unique))
+        # Maps a combination of tips to the number of commits reachable
+        # from exactly those tips
+        self.histogram = {}
+        if len(unique) < 2:
+            return
+        graph = gitctl.commitgraph.load(repository)
+        if graph is not None:
+            positions = [graph.lookup(sha1) for sha1 in unique]
+            if None not in positions:
+                try:
+                    self.histogram = graph.histogram(positions)
+                    return
+                except gitctl.commitgraph.GraphError:
+                    pass
+        # Commits reachable from the merge bases are reachable from all the
+        # tips and do not affect the counts.
+        result = repository.git('merge-base', '--octopus', '--all', *unique)
+        bases = result.ok and result.stdout.split() or []
+        masks = dict(self.bits)
+        # Children are listed before their parents
+        output = repository.call('rev-list', '--topo-order', '--parents', *(unique + ['--not'] + bases))
+        for line in output.splitlines():
+            commits = line.split()
+            mask = masks.pop(commits[0], 0)
+            for parent in commits[1:]:
+                masks[parent] = masks.get(parent, 0) | mask
+            self.histogram[mask] = self.histogram.get(mask, 0) + 1
+
+    def count(self, from_, to):
+        """Returns the number of commits in ``to`` that are not in
+        ``from_``.
+        """
+        from_bit, to_bit = self.bits[self.sha1s[from_]], self.bits[self.sha1s[to]]
+        return sum(n for mask, n in self.histogram.iteritems() if mask & to_bit and not mask & from_bit)
+
+def show_commits(commits, prefix="    ", limit=None, count=None):
+    """Displays commit information with an optional limit. ``count`` is the
+    total number of commits if ``commits`` has been limited already.
+    """
     output = []
     if limit is None:
         limit = len(commits)
+    if count is None:
+        count = len(commits)
     for commit in commits[:limit]:
         output.append('%s%s' % (prefix, commit))
-    if len(commits) > limit and len(output) > 0:
-        output.append('%s... and %s more' % (prefix, len(commits) - limit))
+    if count > limit and len(output) > 0:
+        output.append('%s... and %s more' % (prefix, count - limit))
     return output
 
 def ahead_behind(ahead, behind):
+    """Describes the given commit lists or commit counts."""
+    if not isinstance(ahead, (int, long)):
+        ahead = len(ahead)
+    if not isinstance(behind, (int, long)):
+        behind = len(behind)
     return '; '.join(filter(None, (
-        len(ahead) > 0 and '%s commit(s) ahead' % len(ahead) or None,
-        len(behind) > 0 and '%s commit(s) behind' % len(behind) or None)))
+        ahead > 0 and '%s commit(s) ahead' % ahead or None,
+        behind > 0 and '%s commit(s) behind' % behind or None)))
+
+def full_ref(name):
+    """Returns the ref name of a ``local_branch`` or ``remote_branch``
+    value of the branch structure.
+    """
+    if name.startswith('heads/'):
+        return 'refs/%s' % name
+    return 'refs/remotes/%s' % name
+
+def merged_refs(repository, tip):
+    """Returns the set of branch refs whose heads are reachable from
+    ``tip``.
+    """
+    output = repository.call('for-each-ref', '--merged=%s' % tip, '--format=%(refname)', 'refs/heads', 'refs/remotes')
+    return set(output.splitlines())
+
+def recent_refs(repository, days=None, limit=None):
+    """Returns the set of branch refs with a commit within the last ``days``
+    days, at most ``limit`` of them taking the most recent ones.
+    """
+    output = repository.call('for-each-ref', '--sort=-committerdate', '--format=%(committerdate:unix) %(refname)',
+                             'refs/heads', 'refs/remotes')
+    refs = [tuple(line.split(' ', 1)) for line in output.splitlines()]
+    if days is not None:
+        oldest = time.time() - days * 86400
+        refs = [(date, ref) for date, ref in refs if int(date) >= oldest]
+    if limit is not None:
+        refs = refs[:limit]
+    return set(ref for date, ref in refs)
+
+def show_feature_branches(repository, branch_info, all_branches, feature_branches, verbose=False,
+                          commit_limit=0, days=None, limit=None):
+    """Reports the feature branches in relation to the development branch
+    ``branch_info``.
 
-def show_branch(repository, branch_info, all_branches, verbose=False, commit_limit=0):
+    The branches merged into the local and remote development branch are
+    found with one ``git for-each-ref --merged`` call each, and the counts
+    are only computed for the branches that are not merged. ``days`` and
+    ``limit`` restrict the report to the branches with recent commits.
+    """
+    output = []
+    heads = {}
+    for branch_name in feature_branches:
+        branch = all_branches[branch_name]
+        # For remote_only branch we'll compute wrt the remote branch head,
+        # otherwise we'll use the local branch head.
+        heads[branch_name] = 'local_branch' not in branch and branch['remote_branch'] or branch['local_branch']
+
+    if days is not None or limit is not None:
+        recent = recent_refs(repository, days, limit)
+        skipped = [b for b in feature_branches if full_ref(heads[b]) not in recent]
+        feature_branches = [b for b in feature_branches if full_ref(heads[b]) in recent]
+        if skipped and verbose:
+            output.append('  - has %s older feature branch(es) that were not inspected.' % len(skipped))
+
+    local_merged = remote_merged = None
+    if 'local_branch' in branch_info:
+        local_merged = merged_refs(repository, branch_info['local_branch'])
+    if 'remote_branch' in branch_info:
+        remote_merged = merged_refs(repository, branch_info['remote_branch'])
+
+    unmerged = [b for b in feature_branches if local_merged is not None and full_ref(heads[b]) not in local_merged]
+    if unmerged:
+        tips = [heads[b] for b in unmerged] + [branch_info['local_branch']]
+        if remote_merged is not None:
+            tips.append(branch_info['remote_branch'])
+        graph = CommitGraph(repository, tips)
+
+    for branch_name in feature_branches:
+        branch = all_branches[branch_name]
+        head = heads[branch_name]
+        remote_done = remote_merged is None or full_ref(head) in remote_merged
+        if branch_name not in unmerged:
+            if not remote_done:
+                output.append('  - has a completed feature branch ``%s`` which is waiting to be pushed upstream' % branch['name'])
+            elif verbose:
+                output.append('  - has a completed feature branch ``%s`` which is merged and pushed upstream.' % branch['name'])
+            continue
+
+        base = branch_info['local_branch']
+        if 'local_branch' not in branch and not remote_done:
+            base = branch_info['remote_branch']
+        ahead = graph.count(base, head)
+        behind = graph.count(head, branch_info['local_branch'])
+        output.append('  - has a feature branch ``%s`` with %s waiting for merge.' % (branch['name'], ahead_behind(ahead, behind)))
+        if commit_limit != 0:
+            commits = list(iter_commits(repository, base, head, limit=commit_limit))
+            output.extend(show_commits(commits, limit=commit_limit, count=ahead))
+    return output
+
+def show_branch(repository, branch_info, all_branches, verbose=False, commit_limit=0, feature_days=None,
+                feature_limit=None):
     header_printed = False
     output = []
     
@@ -114,71 +309,66 @@ def show_branch(repository, branch_info, all_branches, verbose=False, commit_lim
             output.append('Branch ``%s``' % branch_info['name'])
         return True
 
-    push_commits = commits_between(repository, branch_info['remote_branch'], branch_info['local_branch'])
-    pull_commits = commits_between(repository, branch_info['local_branch'], branch_info['remote_branch'])
-    local_remote_out_of_sync = len(push_commits) > 0 and len(pull_commits) > 0
+    def listing(from_, to):
+        """Lists the commits in ``to`` that are not in ``from_`` as far as
+        they are displayed.
+        """
+        if commit_limit == 0:
+            return []
+        commits = list(iter_commits(repository, from_, to, limit=commit_limit))
+        return show_commits(commits, limit=commit_limit, count=graph.count(from_, to))
+
+    is_feature_branch = lambda b: b not in ('primacontrol/development', 'primacontrol/demo', 'primacontrol/production')
+    feature_branches = [b for b in all_branches if is_feature_branch(b)]
+    main_branches = [b for b in all_branches if not is_feature_branch(b)]
 
-    if len(push_commits) == len(pull_commits) == 0:
+    # The counts between the branch and the main branches come from a
+    # single graph walk.
+    head = branch_info.get('local_branch', branch_info.get('remote_branch'))
+    graph = CommitGraph(repository, [branch_info['local_branch'], branch_info['remote_branch'], head]
+                        + [b for b in main_branches if b != branch_info['name']])
+
+    push_count = graph.count(branch_info['remote_branch'], branch_info['local_branch'])
+    pull_count = graph.count(branch_info['local_branch'], branch_info['remote_branch'])
+    local_remote_out_of_sync = push_count > 0 and pull_count > 0
+
+    if push_count == pull_count == 0:
         if verbose:
             header_printed = header(header_printed)
             output.append('  - is up-to-date and in sync with upstream')
-    elif len(push_commits) > 0:
+    elif push_count > 0:
         header_printed = header(header_printed)
         action = local_remote_out_of_sync and 'pushed after rebase / merge' or 'pushed'
-        output.append('  - has %s new commit(s) that need to be %s.' % (len(push_commits), action))
-        output.extend(show_commits(push_commits, limit=commit_limit))
-    elif len(pull_commits) > 0:
+        output.append('  - has %s new commit(s) that need to be %s.' % (push_count, action))
+        output.extend(listing(branch_info['remote_branch'], branch_info['local_branch']))
+    elif pull_count > 0:
         header_printed = header(header_printed)
-        action = len(push_commits) == 0 and 'merged' or 'rebased / merged'
-        output.append('  - is behind upstream %s commit(s) that need to be %s.' % (len(pull_commits), action))
-        output.extend(show_commits(pull_commits, limit=commit_limit))
-
-    is_feature_branch = lambda b: b not in ('primacontrol/development', 'primacontrol/demo', 'primacontrol/production')
-    feature_branches = [b for b in all_branches if is_feature_branch(b)]
-    main_branches = [b for b in all_branches if not is_feature_branch(b)]
+        action = push_count == 0 and 'merged' or 'rebased / merged'
+        output.append('  - is behind upstream %s commit(s) that need to be %s.' % (pull_count, action))
+        output.extend(listing(branch_info['local_branch'], branch_info['remote_branch']))
 
     # This branch's relation to other main branches
     if len(main_branches) > 0:
         for branch_name in sorted(main_branches):
             if branch_name == branch_info['name']:
                 continue
-            branch = all_branches[branch_name]
-            ahead = commits_between(repository, branch_name, branch_info.get('local_branch', branch_info.get('remote_branch')))
-            if len(ahead) == 0:
+            ahead = graph.count(branch_name, head)
+            if ahead == 0:
                 if verbose:
                     header_printed = header(header_printed)
                     output.append('  - is merged into %s' % branch_name)
             else:
                 header_printed = header(header_printed)
-                output.append('  - is %s commit(s) ahead of ``%s``.' % (len(ahead), branch_name))
-                output.extend(show_commits(ahead, limit=commit_limit))
+                output.append('  - is %s commit(s) ahead of ``%s``.' % (ahead, branch_name))
+                output.extend(listing(branch_name, head))
 
     # Features branches, which are only inspected in relation to the development branch
     if len(feature_branches) > 0 and branch_info['name'] == 'primacontrol/development':
-        for branch_name in feature_branches:
-            branch = all_branches[branch_name]
-            local_only = 'remote_branch' not in branch
-            remote_only = 'local_branch' not in branch
-            # For remote_only branch we'll compute wrt the remote branch head,
-            # otherwise we'll use the local branch head.
-            head = remote_only and branch['remote_branch'] or branch['local_branch']
-            
-            remote_ahead = 'remote_branch' in branch_info and commits_between(repository, branch_info['remote_branch'], head) or []
-            local_ahead = 'local_branch' in branch_info and commits_between(repository, branch_info['local_branch'], head) or []
-            
-            if len(local_ahead) == len(remote_ahead) == 0:
-                if verbose:
-                    header_printed = header(header_printed)
-                    output.append('  - has a completed feature branch ``%s`` which is merged and pushed upstream.' % branch['name'])
-            elif len(local_ahead) == 0:
-                header_printed = header(header_printed)
-                output.append('  - has a completed feature branch ``%s`` which is waiting to be pushed upstream' % branch['name'])
-            else:
-                behind = commits_between(repository, head, branch.get('local_branch', branch.get('remote_branch')))
-                ahead = remote_only and remote_ahead or local_ahead
-                header_printed = header(header_printed)
-                output.append('  - has a feature branch ``%s`` with %s waiting for merge.' % (branch['name'], ahead_behind(ahead, behind)))
-                output.extend(show_commits(ahead, limit=commit_limit))
+        features = show_feature_branches(repository, branch_info, all_branches, feature_branches, verbose,
+                                         commit_limit, feature_days, feature_limit)
+        if features:
+            header_printed = header(header_printed)
+            output.extend(features)
 
     if local_remote_out_of_sync:
         header_printed = header(header_printed)
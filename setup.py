@@ -33,9 +33,11 @@ setup(name='gitctl',
       install_requires=[
         'setuptools',
         'argparse',
-        'GitPython==0.1.7',
         'mock',
         ],
+      tests_require=[
+        'GitPython==0.1.7',
+        ],
       test_suite='gitctl.tests.test_suite',
       entry_points="""
       # -*- Entry points: -*-